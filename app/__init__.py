@@ -5,31 +5,68 @@ from functools import wraps
 from typing import Callable
 
 from app import main
-from app.main import (get_all_currencies, get_all_exchange_rates, get_currency,
-                      get_exchange_rate, update_currency, update_exchange_rate,
-                      add_currency, add_exchange_rate)
+from app.main import (get_all_currencies, get_all_exchange_rates, get_all_exchange_rates_expanded, get_currency,
+                      get_currency_by_code, get_currency_by_id, get_exchange_rate, update_currency,
+                      update_exchange_rate, add_currency, add_exchange_rate, upsert_exchange_rates,
+                      get_exchange_rate_history, get_data_version, iter_exchange_rates_expanded)
 
 from app.data_updates import CurrencyRatesUpdater
+from app.init import migrate_db
+from app.shared_rates import SharedRatesReader, RatesPublisher
 
 COMMIT_IF_SUCCESS = True
 
 pkg_dir = os.path.dirname(__file__)
 
 connection = None
+pool = None
+rates_publisher = None
 
 configs = ConfigParser()
 
 configs.read(os.path.join(pkg_dir, r'configs\dbconfigs.ini'))
 
 
+def get_connection_profile():
+    """Returns pragmas and size of statements cache configured for connections"""
+    if not configs.has_section('connection'):
+        return {}, 128
+    pragmas = {k: v for k, v in configs['connection'].items() if k not in ('db_fname', 'cached_statements')}
+    return pragmas, configs['connection'].getint('cached_statements', 128)
+
+
+def get_shared_rates_path():
+    """Returns path of the file the rate matrix is shared by processes through (None if it isn't shared)"""
+    path = configs.get('shared_rates', 'path', fallback=None)
+    return os.path.join(pkg_dir, path) if path else None
+
+
 def connect_db(db_path):
-    global connection
-    # have to disable same thread checking because apparently the majority of well known wsgi servers
-    # (like waitress, for example) run application in another thread, which causes sqlite API to raise an error
-    # connection = sqlite3.connect(db_path, isolation_level='DEFERRED', check_same_thread=False)
-    connection = sqlite3.connect(db_path, check_same_thread=False)
-    main.set_connection(connection)
-    main.db_cursor.execute('PRAGMA foreign_keys(1)')
+    global connection, pool
+    # DB made before the latest change of schema is brought up to date
+    migrate_db(db_path)
+    pragmas, cached_statements = get_connection_profile()
+    pool = main.ConnectionPool(db_path, pragmas=pragmas, cached_statements=cached_statements)
+    # writer connection, that all the modifications go through
+    connection = pool.writer
+    main.set_pool(pool)
+
+    shared_rates_path = get_shared_rates_path()
+    if shared_rates_path:
+        share_rates(shared_rates_path)
+
+
+def share_rates(path):
+    """
+    Makes rates be resolved through the matrix shared by processes via the file.
+    Every process is ready to publish the matrix, though only one of them does at a time.
+    """
+    global rates_publisher
+    if rates_publisher:
+        rates_publisher.stop()
+    rates_publisher = RatesPublisher(path, pool)
+    rates_publisher.start()
+    main.set_shared_rates(SharedRatesReader(path))
 
 
 connect_db(os.path.join(pkg_dir, configs['DEFAULT']['db_fname']))
@@ -40,14 +77,15 @@ def wrapper_for_transaction(db_procedure):
     def transaction_wrapper(*args, **kwargs):
         global connection
         global COMMIT_IF_SUCCESS
-        try:
-            connection.execute('BEGIN')
-            res = db_procedure(*args, **kwargs)
-            if COMMIT_IF_SUCCESS:
-                connection.execute('COMMIT')
-        except:
-            connection.execute('ROLLBACK')
-            raise
+        with pool.writing():
+            try:
+                connection.execute('BEGIN')
+                res = db_procedure(*args, **kwargs)
+                if COMMIT_IF_SUCCESS:
+                    connection.execute('COMMIT')
+            except:
+                connection.execute('ROLLBACK')
+                raise
 
         return res
 
@@ -58,6 +96,7 @@ update_currency = wrapper_for_transaction(update_currency)
 update_exchange_rate = wrapper_for_transaction(update_exchange_rate)
 add_currency = wrapper_for_transaction(add_currency)
 add_exchange_rate = wrapper_for_transaction(add_exchange_rate)
+upsert_exchange_rates = wrapper_for_transaction(upsert_exchange_rates)
 
 
 def get_updater(fetcher_procedure: Callable = None, source_id: int = None):
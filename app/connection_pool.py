@@ -0,0 +1,120 @@
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+
+# names of values, which are reported by sqlite as numbers
+PRAGMA_VALUE_NAMES = {
+    'synchronous': {'0': 'OFF', '1': 'NORMAL', '2': 'FULL', '3': 'EXTRA'},
+    'temp_store': {'0': 'DEFAULT', '1': 'FILE', '2': 'MEMORY'},
+}
+
+# pragmas that are persistent in DB file, hence set up by the writer only
+PERSISTENT_PRAGMAS = ('journal_mode',)
+
+# seconds, for which the data version checked last is taken as the current one
+DATA_VERSION_CHECK_INTERVAL = 0.1
+
+
+class ConnectionPool:
+    """
+    Keeps a single writer connection, usage of which is serialized by write lock,
+    and a read connection per thread (opened on demand, in query only mode).
+    If pool is made upon an existing connection (no db path is known), this connection serves everything.
+    """
+
+    def __init__(self, db_path: str | None = None, *, writer: sqlite3.Connection = None, pragmas: dict = None,
+                 cached_statements: int = 128, data_version_check_interval: float = DATA_VERSION_CHECK_INTERVAL):
+        assert db_path or writer, 'Either path to DB or writer connection must be given'
+
+        self.db_path = db_path
+        self.pragmas = pragmas or {}
+        self.cached_statements = cached_statements
+        self.data_version_check_interval = data_version_check_interval
+        # have to disable same thread checking because writer is shared between threads (under write lock)
+        self.writer = writer or self._connect(check_same_thread=False)
+        self.write_lock = threading.RLock()
+        self._writing_thread = None
+        # thread, which has left the transaction of the writer open (see COMMIT_IF_SUCCESS)
+        self._transaction_thread = None
+        self._local = threading.local()
+        self._data_version = self.writer.execute('PRAGMA data_version').fetchone()[0]
+        self._data_version_checked_at = time.monotonic()
+
+        if db_path:
+            for name in PERSISTENT_PRAGMAS:
+                if name in self.pragmas:
+                    self.writer.execute(f'PRAGMA {name}={self.pragmas[name]}')
+
+    @classmethod
+    def from_connection(cls, connection: sqlite3.Connection):
+        return cls(writer=connection)
+
+    def _connect(self, **kwargs):
+        connection = sqlite3.connect(self.db_path, cached_statements=self.cached_statements, **kwargs)
+        connection.execute('PRAGMA foreign_keys(1)')
+        for name, value in self.pragmas.items():
+            if name not in PERSISTENT_PRAGMAS:
+                connection.execute(f'PRAGMA {name}={value}')
+        return connection
+
+    def check_settings(self) -> dict:
+        """
+        Reads back effective values of the configured pragmas on the writer connection.
+        Returns dict of name: (configured value, effective value, whether they match).
+        """
+        res = {}
+        for name, value in self.pragmas.items():
+            effective = str(self.writer.execute(f'PRAGMA {name}').fetchone()[0])
+            effective = PRAGMA_VALUE_NAMES.get(name, {}).get(effective, effective)
+            res[name] = (value, effective, str(value).casefold() == effective.casefold())
+        return res
+
+    @contextmanager
+    def writing(self):
+        """Serializes writes: the writer connection is given out to one thread at a time"""
+        with self.write_lock:
+            outer = self._writing_thread
+            self._writing_thread = threading.get_ident()
+            try:
+                yield self.writer
+            finally:
+                self._writing_thread = outer
+                if outer is None:
+                    self._transaction_thread = threading.get_ident() if self.writer.in_transaction else None
+
+    def get_data_version(self) -> int:
+        """
+        Returns the number, which changes whenever another connection (of another process, first of all) commits.
+        Commits of the writer itself show in its total_changes and in_transaction.
+        DB is asked once in data_version_check_interval at most, and only while the writer is free: meanwhile
+        the number seen last is returned, so that readers neither hit DB nor wait for each other.
+        """
+        if time.monotonic() - self._data_version_checked_at < self.data_version_check_interval:
+            return self._data_version
+        if not self.write_lock.acquire(blocking=False):
+            return self._data_version
+        try:
+            self._data_version = self.writer.execute('PRAGMA data_version').fetchone()[0]
+            self._data_version_checked_at = time.monotonic()
+        finally:
+            self.write_lock.release()
+        return self._data_version
+
+    def get_reader(self) -> sqlite3.Connection:
+        thread = threading.get_ident()
+
+        # uncommitted changes have to be visible to the thread which made them, the others see committed data only
+        if self._writing_thread == thread or not self.db_path:
+            return self.writer
+        # transaction was left open by a finished write of the thread, no one else is writing meanwhile
+        if self._transaction_thread == thread and self._writing_thread is None and self.writer.in_transaction:
+            return self.writer
+
+        reader = getattr(self._local, 'reader', None)
+        if reader is None:
+            reader = self._local.reader = self._connect()
+            reader.execute('PRAGMA query_only(1)')
+
+        return reader
@@ -0,0 +1,35 @@
+import sqlite3
+
+from app.data_objects import Currency
+
+
+class CurrencyCache:
+    """
+    Identity map of currency table: Currency data objects are loaded once and are indexed both by code and id.
+    """
+
+    def __init__(self):
+        self._by_code = {}
+        self._by_id = {}
+        self._all = ()
+        self.state = None
+
+    def load(self, cursor: sqlite3.Cursor, state=None):
+        currencies = tuple(Currency(*rec) for rec in cursor.execute('SELECT * FROM currency'))
+
+        self._by_code = {c.code: c for c in currencies}
+        self._by_id = {c.id: c for c in currencies}
+        self._all = currencies
+        self.state = state
+
+    def invalidate(self):
+        self.state = None
+
+    def get_by_code(self, code) -> Currency | None:
+        return self._by_code.get(code)
+
+    def get_by_id(self, currency_id) -> Currency | None:
+        return self._by_id.get(currency_id)
+
+    def get_all(self) -> tuple:
+        return self._all
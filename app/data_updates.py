@@ -4,6 +4,7 @@ import sys
 from typing import Callable
 
 from app.data_objects import CurrencyRate
+from app.utils.rate_sources import SourceValidators, SourceNotModified
 
 
 def adapt_date_iso(val):
@@ -14,21 +15,22 @@ sqlite3.register_adapter(datetime.date, adapt_date_iso)
 
 
 class CurrencyRatesUpdater:
-    __instances = []
     """
     Provides functionality for keeping currency rates up-to-date in application's database
     """
     __db_details_specs = ('table_name', 'pk_field',  'last_appeal_data_field', 'days_valid_field', 'path_field',
                           'type_field')
+    # specs of fields for validators of the fetched data, conditional fetching is done only if all of them are present
+    __db_validators_specs = ('etag_field', 'last_modified_field', 'content_hash_field')
 
-    def __init__(self, conn, source_id, fetcher_procedure: Callable, update_interface: Callable, db_details: dict):
+    def __init__(self, conn, source_id, fetcher_procedure: Callable, update_interface: Callable, db_details: dict,
+                 bulk_update_interface: Callable = None, *, conditional_fetch=False):
         self._update_interface = update_interface
+        # takes all the rates at once, returns counts of (inserted, updated, skipped) ones
+        self._bulk_update_interface = bulk_update_interface
         self._connection: sqlite3.Connection = conn
         self._db_cursor: sqlite3.Cursor = self._connection.cursor()
 
-        assert source_id not in [inst.source_id for inst in getattr(self, f'_{self.__class__.__name__}__instances')], \
-            'The updater on this source has been set already'
-
         assert set(self.get_db_specs()) & set(db_details.keys()) == set(self.get_db_specs()), \
             'One of the required database specification parameters is missing'
 
@@ -42,9 +44,10 @@ class CurrencyRatesUpdater:
 
         self.fetch_data = fetcher_procedure
 
-        getattr(self, f'_{self.__class__.__name__}__instances').append(self)
+        # fetcher has to accept validators keyword for it
+        self.conditional_fetch = conditional_fetch and self._has_validators_fields()
 
-    def update_is_needed(self):
+    def get_next_update_date(self) -> datetime.date:
         details = self._db_details
 
         sql = '''
@@ -57,7 +60,10 @@ class CurrencyRatesUpdater:
 
         last_appeal, days_valid = datetime.date.fromisoformat(res[0]), datetime.timedelta(days=res[1])
 
-        return True if last_appeal + days_valid <= datetime.date.today() else False
+        return last_appeal + days_valid
+
+    def update_is_needed(self):
+        return True if self.get_next_update_date() <= datetime.date.today() else False
 
     def obtain_data(self):
         path = self.get_path_to_source()
@@ -74,33 +80,118 @@ class CurrencyRatesUpdater:
         res = self._db_cursor.execute(sql, (self.source_id,)).fetchone()
         return res[0]
 
+    def _has_validators_fields(self):
+        details = self._db_details
+        if not set(self.__db_validators_specs) <= set(details):
+            return False
+
+        columns = {rec[1] for rec in self._db_cursor.execute(f'PRAGMA table_info({details["table_name"]})')}
+        return {details[spec] for spec in self.__db_validators_specs} <= columns
+
+    def get_validators(self) -> SourceValidators | None:
+        """Returns validators of the data fetched last time (None if conditional fetching isn't done)"""
+        if not self.conditional_fetch:
+            return None
+
+        sql = '''
+        SELECT {etag_field}, {last_modified_field}, {content_hash_field}
+        FROM {table_name}
+        WHERE {pk_field} = ?
+        '''.format(**self._db_details)
+
+        return SourceValidators(*self._db_cursor.execute(sql, (self.source_id,)).fetchone())
+
+    def fetch(self, path, validators: SourceValidators = None):
+        if validators is None:
+            return self.fetch_data(path)
+        return self.fetch_data(path, validators=validators)
+
     def update(self, on_nonexist_exc=None, *, commit_last_appeal_record=False):
         path = self.get_path_to_source()
-        data = self.fetch_data(path)
+        validators = self.get_validators()
+
+        try:
+            self.apply(
+                self.fetch(path, validators), on_nonexist_exc,
+                commit_last_appeal_record=commit_last_appeal_record, validators=validators
+            )
+        except SourceNotModified:
+            # data is the same as the last time, only appeal is recorded
+            self.record_appeal(validators, commit_last_appeal_record=commit_last_appeal_record)
+
+    def apply(self, data, on_nonexist_exc=None, *, commit_last_appeal_record=False,
+              validators: SourceValidators = None):
+        """
+        Writes rates, which were fetched from the source, into DB and records the appeal.
+        Returns the change set (tuple of RateChange) if rates are written in bulk, None otherwise.
+        """
+        update_happened, changes = self.write(data, on_nonexist_exc)
 
-        update_happened = False
-        for rate in data:
-            try:
+        if update_happened:
+            self.record_appeal(validators, commit_last_appeal_record=commit_last_appeal_record)
+
+        return changes
+
+    def write(self, data, on_nonexist_exc=None, *, commit=False) -> tuple[bool, tuple | None]:
+        """
+        Writes rates into DB, the appeal to the source isn't recorded. Returns whether any rate was taken
+        and the change set (tuple of RateChange) if rates are written in bulk, None otherwise.
+        """
+        changes = None
+
+        if self._bulk_update_interface:
+            update_happened, changes = self._update_in_bulk(data)
+        else:
+            update_happened = False
+            for rate in data:
+                try:
+                    rate.info_source = self.source_id
+                    self._update_interface(rate)
+                    update_happened = True
+                except:
+                    if on_nonexist_exc and isinstance(sys.exception(), on_nonexist_exc):
+                        pass
+                    else:
+                        raise
+
+        if commit and self._connection.in_transaction:
+            self._db_cursor.execute('COMMIT')
+
+        return update_happened, changes
+
+    def record_appeal(self, validators: SourceValidators = None, *, commit_last_appeal_record=False):
+        """Records date of appeal to the source (and validators of the fetched data, if they're given)"""
+        datestamp = datetime.date.today()
+        details = self._db_details.copy()
+        details['datestamp'] = datestamp
+        details['source_id'] = self.source_id
+        sql = '''UPDATE {table_name}
+        SET {last_appeal_data_field} = :datestamp
+        WHERE {pk_field} = :source_id'''.format(**details)
+        self._db_cursor.execute(sql, details)
+
+        if validators and self.conditional_fetch:
+            sql = '''UPDATE {table_name}
+            SET {etag_field} = ?, {last_modified_field} = ?, {content_hash_field} = ?
+            WHERE {pk_field} = ?'''.format(**details)
+            self._db_cursor.execute(
+                sql, (validators.etag, validators.last_modified, validators.content_hash, self.source_id)
+            )
+
+        if commit_last_appeal_record:
+            self._db_cursor.execute('COMMIT')
+
+    def _update_in_bulk(self, data):
+        def prepared(rates):
+            for rate in rates:
                 rate.info_source = self.source_id
-                self._update_interface(rate)
-                update_happened = True
-            except:
-                if on_nonexist_exc and isinstance(sys.exception(), on_nonexist_exc):
-                    pass
-                else:
-                    raise
+                yield rate
 
-        if update_happened:
-            datestamp = datetime.date.today()
-            details = self._db_details.copy()
-            details['datestamp'] = datestamp
-            details['source_id'] = self.source_id
-            sql = '''UPDATE {table_name} 
-            SET {last_appeal_data_field} = :datestamp 
-            WHERE {pk_field} = :source_id'''.format(**details)
-            self._db_cursor.execute(sql, details)
-            if commit_last_appeal_record:
-                self._db_cursor.execute('COMMIT')
+        # only rates of the existing pairs are updated, as it is done on one by one basis,
+        # and only those of them, which have changed, are written
+        res = self._bulk_update_interface(prepared(data), insert_new=False)
+
+        return bool(res.inserted or res.updated or res.unchanged), res.changes
 
     @classmethod
     def get_db_specs(cls):
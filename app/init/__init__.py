@@ -72,3 +72,82 @@ def populate_rates(db_path, rates_fetcher=partial(cbr.obtain_rates, prepare_func
             )
     finally:
         connection.close()
+
+
+# version of DB schema, kept in user_version pragma. DB made before some change of schema is brought up to date
+# by migrations of the later versions, when it's connected to
+SCHEMA_VERSION = 2
+
+# rates known before history was introduced are recorded as valid since this moment, as the one they became valid at
+# is unknown (it precedes any moment given in HISTORY_TIME_FORMAT)
+HISTORY_BACKFILL_TIME = '1970-01-01T00:00:00.000000Z'
+
+RATES_HISTORY_DDL = '''
+CREATE TABLE IF NOT EXISTS exchange_rates_history (
+    base_currency_id INTEGER NOT NULL REFERENCES currency(currency_id),
+    target_currency_id INTEGER NOT NULL REFERENCES currency(currency_id),
+    valid_from TEXT NOT NULL,
+    rate REAL NOT NULL,
+    source_id INTEGER REFERENCES rates_info_source(source_id)
+);
+-- covers range queries on a pair: rate is taken from the index itself
+CREATE INDEX IF NOT EXISTS exchange_rates_history_idx
+ON exchange_rates_history(base_currency_id, target_currency_id, valid_from, rate);
+'''
+
+
+def _add_source_validators_fields(connection: sqlite3.Connection):
+    """Adds fields for validators of the fetched data to rates info source table of DB made before they appeared"""
+    columns = {rec[1] for rec in connection.execute('PRAGMA table_info(rates_info_source)')}
+    for column in ('etag', 'last_modified', 'content_hash'):
+        if column not in columns:
+            connection.execute(f'ALTER TABLE rates_info_source ADD COLUMN {column} TEXT')
+
+
+def _add_rates_history(connection: sqlite3.Connection):
+    """Makes rates history table, the current rates become its first points"""
+    for statement in filter(str.strip, RATES_HISTORY_DDL.split(';')):
+        connection.execute(statement)
+
+    connection.execute(
+        '''
+        INSERT INTO exchange_rates_history(base_currency_id, target_currency_id, valid_from, rate, source_id)
+        SELECT base_currency_id, target_currency_id, ?, rate, source_id
+        FROM exchange_rates r
+        WHERE rate IS NOT NULL AND NOT EXISTS (
+            SELECT 1 FROM exchange_rates_history h
+            WHERE h.base_currency_id = r.base_currency_id AND h.target_currency_id = r.target_currency_id
+        )
+        ''',
+        (HISTORY_BACKFILL_TIME,)
+    )
+
+
+# migrations by the schema version they bring DB up to
+MIGRATIONS = {
+    1: _add_rates_history,
+    2: _add_source_validators_fields,
+}
+
+
+def migrate_db(db_path):
+    """Brings schema of DB up to SCHEMA_VERSION, if it's older (does nothing otherwise)"""
+    connection = sqlite3.connect(db_path, isolation_level=None)
+
+    try:
+        if connection.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+            return
+
+        # write lock is taken at once, so that processes connecting simultaneously migrate DB one at a time
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            version = connection.execute('PRAGMA user_version').fetchone()[0]
+            for migration_version in range(version + 1, SCHEMA_VERSION + 1):
+                MIGRATIONS[migration_version](connection)
+            connection.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+    finally:
+        connection.close()
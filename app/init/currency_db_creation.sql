@@ -1,7 +1,10 @@
 DROP TABLE IF EXISTS currency;
 DROP TABLE IF EXISTS exchange_rates;
 DROP TABLE IF EXISTS rates_info_source;
+DROP TABLE IF EXISTS exchange_rates_history;
 PRAGMA foreign_keys=ON;
+-- DB made by this script is of the latest schema version (SCHEMA_VERSION of app.init)
+PRAGMA user_version=2;
 
 CREATE TABLE currency(
 	
@@ -18,7 +21,10 @@ CREATE TABLE rates_info_source(
 		 src_path TEXT,
 		 src_type TEXT,
 		 days_valid INTEGER,
-		 last_appeal
+		 last_appeal,
+		 etag TEXT,
+		 last_modified TEXT,
+		 content_hash TEXT
 		 
 	     );
 	
@@ -32,4 +38,15 @@ CREATE TABLE exchange_rates (
 	);
 
 CREATE UNIQUE INDEX unique_currency_code_idx ON currency(code);
-CREATE UNIQUE INDEX unique_exchange_pair_idx ON exchange_rates(base_currency_id, target_currency_id);
\ No newline at end of file
+CREATE UNIQUE INDEX unique_exchange_pair_idx ON exchange_rates(base_currency_id, target_currency_id);
+
+CREATE TABLE exchange_rates_history (
+	base_currency_id INTEGER NOT NULL REFERENCES currency (currency_id),
+	target_currency_id INTEGER NOT NULL REFERENCES currency (currency_id),
+	valid_from TEXT NOT NULL,
+	rate REAL NOT NULL,
+	source_id INTEGER REFERENCES rates_info_source(source_id)
+	);
+
+CREATE INDEX exchange_rates_history_idx
+ON exchange_rates_history(base_currency_id, target_currency_id, valid_from, rate);
\ No newline at end of file
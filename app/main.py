@@ -1,13 +1,51 @@
 import sqlite3
+import datetime
+import threading
+import time
+from collections import namedtuple, OrderedDict
 from functools import partial
 from urllib.request import urlopen
 from dataclasses import asdict
-from typing import Callable
+from typing import Callable, Iterable
 
 from app.data_objects import CurrencyRate, Currency
+from app.rate_graph import RateGraph
+from app.rate_matrix import RateMatrix
+from app.currency_cache import CurrencyCache
+from app.connection_pool import ConnectionPool
 
+POOL: ConnectionPool | None = None
+# writer connection of the pool
 CONNECTION: sqlite3.Connection | None = None
-db_cursor: sqlite3.Cursor | None = None
+RATE_GRAPH = RateGraph()
+RATE_MATRIX = None
+# reader of the rate matrix shared by processes (see app.shared_rates), if it's shared
+SHARED_RATES = None
+CURRENCY_CACHE = CurrencyCache()
+# rate graphs of the past moments, recently used ones (they never change, as history is only appended to)
+RATE_SNAPSHOTS = OrderedDict()
+RATE_SNAPSHOTS_LIMIT = 32
+# history of a moment is deemed settled when it's that much in the past (transactions writing into it have ended)
+RATE_SNAPSHOT_SETTLE_TIME = datetime.timedelta(minutes=1)
+_rate_snapshots_lock = threading.Lock()
+# rates written through this module since the rate matrix was built out of transaction last, as
+# (total_changes of the writer after the write, ids of currencies of the written pairs or None if they aren't known)
+_rate_writes = []
+# that many writes at most are kept track of, before the matrix is requested
+RATE_WRITES_LIMIT = 1000
+# guards both the rate matrix and the writes
+_rate_matrix_lock = threading.Lock()
+
+# bumped by every procedure modifying data, so caches built upon data can tell whether they became stale
+data_version = 0
+# bumped by every procedure modifying currency table
+currency_table_version = 0
+# moment of the last modification made through this module
+data_modified_at: datetime.datetime | None = None
+# data version of the changes of this process, which were seen committed at the moment (time.time()) last,
+# shared rates taken from DB before that don't include them
+_committed_data_version = 0
+_committed_at = 0.0
 
 CURRENCY_FIELDS_TO_DB_MAP = {
     'id': 'currency_id',
@@ -21,15 +59,65 @@ CURRENCY_RATE_FIELDS_TO_DB_MAP = {
 
 FIND_RATE_BY_RECIPROCAL = 0b001
 FIND_RATE_BY_COMMON_TARGET = 0b010
+FIND_RATE_BY_PATH = 0b100
+# strategies resolved by lookup in the rate matrix
+FIND_RATE_BY_MATRIX = FIND_RATE_BY_RECIPROCAL | FIND_RATE_BY_COMMON_TARGET
+
+# max number of pairs in a chain for FIND_RATE_BY_PATH strategy
+MAX_RATE_PATH_DEPTH = 4
 
 RATES_VAL_PRECISION = 4
 
+UpsertResult = namedtuple('UpsertResult', ['inserted', 'updated', 'unchanged', 'skipped', 'changes'])
 
-def set_connection(db_connection: sqlite3.Connection):
+# change of a pair's rate made by a write (old_rate is None for a new pair)
+RateChange = namedtuple('RateChange', ['base_currency_code', 'target_currency_code', 'old_rate', 'new_rate'])
+
+# every value a rate has taken is kept along with the moment it became valid from (UTC, in HISTORY_TIME_FORMAT),
+# see migrations of app.init for the table
+HISTORY_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+# number of history points fetched from DB at once, while they're being given out
+HISTORY_FETCH_SIZE = 500
+# the same for rows of the tables
+ROWS_FETCH_SIZE = 500
+
+
+def set_pool(pool: ConnectionPool):
+    global POOL
     global CONNECTION
-    global db_cursor
-    CONNECTION = db_connection
-    db_cursor = CONNECTION.cursor()
+    global RATE_MATRIX
+    POOL = pool
+    CONNECTION = pool.writer
+    RATE_GRAPH.invalidate()
+    with _rate_matrix_lock:
+        RATE_MATRIX = None
+        _rate_writes.clear()
+    CURRENCY_CACHE.invalidate()
+    with _rate_snapshots_lock:
+        RATE_SNAPSHOTS.clear()
+    _register_modification(currency_table_modified=True)
+
+
+def set_connection(db_connection: sqlite3.Connection):
+    set_pool(ConnectionPool.from_connection(db_connection))
+
+
+def _describes_state(reader: sqlite3.Connection, state: tuple) -> bool:
+    """
+    Tells whether what is loaded through the reader matches the state of the writer (..., in_transaction):
+    readers of the other threads don't see uncommitted changes, which the writer is in the middle of making
+    """
+    return reader is CONNECTION or not state[-1]
+
+
+def _read_cursor() -> sqlite3.Cursor:
+    return POOL.get_reader().cursor()
+
+
+def _write_cursor() -> sqlite3.Cursor:
+    # write procedures are supposed to be run inside POOL.writing()
+    return POOL.writer.cursor()
 
 
 def build_sql_query_params_line(params: dict, joiner):
@@ -61,10 +149,26 @@ def substitute_keys(d, subs: dict):
     d.update(dict(new_d))
 
 
-def get_all_currencies():
-    res = db_cursor.execute('SELECT * FROM currency').fetchall()
+def get_currency_cache() -> CurrencyCache:
+    """
+    Returns the currency cache, reloading it from DB if currency table was modified, another process committed
+    (or a transaction was either opened, committed or rolled back) since the last load.
+    """
+    global CURRENCY_CACHE
+    state = (POOL.get_data_version(), currency_table_version, CONNECTION.in_transaction)
+    cache = CURRENCY_CACHE
+    if cache.state != state:
+        # new cache replaces the old one at once, so the threads which are using the old one aren't disturbed
+        reader = POOL.get_reader()
+        cache = CurrencyCache()
+        cache.load(reader.cursor(), state)
+        if _describes_state(reader, state):
+            CURRENCY_CACHE = cache
+    return cache
 
-    return tuple(Currency(*rec) for rec in res)
+
+def get_all_currencies():
+    return get_currency_cache().get_all()
 
 
 def get_currency(currency: Currency):
@@ -72,20 +176,24 @@ def get_currency(currency: Currency):
     - no identity fields were given
     - no such currency in DB
     """
-    params = dict_remove_none_val_items(asdict(currency))
+    assert currency.id is not None or currency.code is not None, 'No identity fields in data objects to make update'
 
-    identity = dict(id=params.get('id'), code=params.get('code'))
-    identity = dict_remove_none_val_items(identity)
+    cache = get_currency_cache()
 
-    substitute_keys(identity, CURRENCY_FIELDS_TO_DB_MAP)
+    res = cache.get_by_id(currency.id) if currency.id is not None else cache.get_by_code(currency.code)
+
+    if res and currency.code is not None and res.code != currency.code:
+        return None
+
+    return res
 
-    assert identity, 'No identity fields in data objects to make update'
 
-    sql = 'SELECT * FROM currency WHERE ' + build_sql_query_params_line(identity, ' AND ')
+def get_currency_by_code(code: str):
+    return get_currency_cache().get_by_code(code)
 
-    rec = db_cursor.execute(sql, identity).fetchone()
 
-    return Currency(*rec) if rec else None
+def get_currency_by_id(currency_id: int):
+    return get_currency_cache().get_by_id(currency_id)
 
 
 def update_currency(currency: Currency):
@@ -107,7 +215,9 @@ def update_currency(currency: Currency):
 
     params_line = build_sql_query_params_line(identity, ' AND ')
 
-    cur_exists = db_cursor.execute('SELECT 1 FROM currency WHERE ' + params_line, identity).fetchone()
+    cursor = _write_cursor()
+
+    cur_exists = cursor.execute('SELECT 1 FROM currency WHERE ' + params_line, identity).fetchone()
     if not cur_exists:
         raise NoRecordToModify(f'No record corresponding to {currency}')
 
@@ -122,7 +232,9 @@ def update_currency(currency: Currency):
           ' WHERE ' + params_line + ' RETURNING *'
     params.update(identity)
 
-    rec = db_cursor.execute(sql, params).fetchone()
+    rec = cursor.execute(sql, params).fetchone()
+
+    _register_modification(currency_table_modified=True)
 
     return Currency(*rec)
 
@@ -135,7 +247,7 @@ def add_currency(currency: Currency):
     # TODO: is RETURNING * statement returning all field of the inserted row?
 
     try:
-        res = db_cursor.execute(sql, (currency.code, currency.full_name, currency.sign)).fetchone()
+        res = _write_cursor().execute(sql, (currency.code, currency.full_name, currency.sign)).fetchone()
     except sqlite3.Error as e:
         if e.sqlite_errorcode == 2067:
             raise RecordOfSuchIdentityExists(f'Record with the same identity as {currency} already exists in database.')
@@ -144,11 +256,55 @@ def add_currency(currency: Currency):
         else:
             raise
 
+    _register_modification(currency_table_modified=True)
+
     return Currency(*res)
 
 
+def _register_modification(currency_table_modified=False, written_pairs: Iterable[tuple] = ()):
+    """To be called by every procedure modifying data, written_pairs are (base id, target id) of written rates"""
+    global data_version, currency_table_version, data_modified_at
+    data_version += 1
+    data_modified_at = datetime.datetime.now(datetime.timezone.utc)
+    if currency_table_modified:
+        currency_table_version += 1
+
+    with _rate_matrix_lock:
+        if len(_rate_writes) < RATE_WRITES_LIMIT:
+            ids = {currency_id for pair in written_pairs for currency_id in pair}
+            _rate_writes.append((CONNECTION.total_changes, ids))
+        else:
+            _rate_writes[:] = [(CONNECTION.total_changes, None)]
+
+
+def get_data_version():
+    """
+    Returns the current data version: version of DB, which changes once another connection (process) commits,
+    along with the version of modifications made through this module. None if the connection has uncommitted
+    changes: nothing built upon such data should be cached, as it might be rolled back.
+    """
+    if CONNECTION.in_transaction:
+        return None
+    return POOL.get_data_version(), data_version
+
+
+def get_data_last_modified() -> datetime.datetime | None:
+    """
+    Returns the moment data was modified at last, as far as it can be told:
+    either the latest appeal to rate sources or the latest modification made through this module.
+    """
+    res = _read_cursor().execute('SELECT max(last_appeal) FROM rates_info_source').fetchone()
+
+    moments = [data_modified_at]
+    if res and res[0]:
+        moments.append(datetime.datetime.combine(datetime.date.fromisoformat(res[0]), datetime.time(),
+                                                 datetime.timezone.utc))
+
+    return max(filter(None, moments), default=None)
+
+
 def get_all_exchange_rates():
-    res = db_cursor.execute(
+    res = _read_cursor().execute(
         '''
     SELECT exchange_rate_id, b.code, t.code, rate, source_id
     FROM exchange_rates
@@ -159,8 +315,170 @@ def get_all_exchange_rates():
     return tuple(CurrencyRate(*rec[:3], 1, *rec[3:]) for rec in res)
 
 
-def get_exchange_rate(rate: CurrencyRate, *, strategy: int = 0):
-    """ERRORS:
+def get_all_exchange_rates_expanded():
+    """
+    Fetches all rates along with both their currencies in one query.
+    Returns tuple of (CurrencyRate, base Currency, target Currency) triples.
+    """
+    return tuple(iter_exchange_rates_expanded())
+
+
+def iter_exchange_rates_expanded():
+    """The same as get_all_exchange_rates_expanded, but triples are fetched from DB as they're being given out"""
+    cursor = _read_cursor().execute(
+        '''
+    SELECT exchange_rate_id, rate, source_id,
+           b.currency_id, b.code, b.full_name, b.currency_sign,
+           t.currency_id, t.code, t.full_name, t.currency_sign
+    FROM exchange_rates
+    JOIN currency b ON (b.currency_id = base_currency_id) 
+    JOIN currency t ON (t.currency_id = target_currency_id)
+    ''')
+
+    currencies = {}
+
+    def make_currency(rec):
+        # every currency is present in many rows, so the same object is used for all of them
+        currency = currencies.get(rec[0])
+        if not currency:
+            currency = currencies[rec[0]] = Currency(*rec)
+        return currency
+
+    def fetch():
+        while res := cursor.fetchmany(ROWS_FETCH_SIZE):
+            for rec in res:
+                yield (CurrencyRate(rec[0], rec[4], rec[8], 1, rec[1], rec[2]), make_currency(rec[3:7]),
+                       make_currency(rec[7:]))
+
+    return fetch()
+
+
+def get_rate_graph() -> RateGraph:
+    """
+    Returns the rate graph consistent with what the current connection sees, reloading it from DB if
+    anything was modified, by other processes as well (or a transaction was either opened, committed or rolled back)
+    since the last load.
+    """
+    global RATE_GRAPH
+    # data version is read first, so the graph loaded afterwards can't be older than the state
+    state = (POOL.get_data_version(), CONNECTION.total_changes, CONNECTION.in_transaction)
+    graph = RATE_GRAPH
+    if graph.state != state:
+        # new graph replaces the old one at once, so the threads which are using the old one aren't disturbed
+        reader = POOL.get_reader()
+        graph = RateGraph()
+        graph.load(reader.cursor(), state)
+        if _describes_state(reader, state):
+            RATE_GRAPH = graph
+    return graph
+
+
+def get_rate_matrix() -> RateMatrix:
+    """
+    Returns the matrix of rates of the current rate graph. Once rates are written through this module, only rows
+    and columns of the currencies of the written pairs are derived anew. Changes made otherwise (by other processes,
+    for one) are found by comparing the graphs.
+    """
+    global RATE_MATRIX
+    graph = get_rate_graph()
+
+    with _rate_matrix_lock:
+        previous = RATE_MATRIX
+        if previous is not None and previous.graph is graph:
+            return previous
+        # graph of another thread's reader isn't cached (see get_rate_graph), nor is its matrix
+        cacheable = graph is RATE_GRAPH
+        changed = _get_written_currencies(previous.graph.state, graph.state) if previous and cacheable else None
+
+    matrix = RateMatrix(graph, previous, changed)
+
+    if cacheable:
+        with _rate_matrix_lock:
+            if RATE_MATRIX is previous:
+                RATE_MATRIX = matrix
+                # writes of a transaction are kept until it's over, as it might be rolled back
+                if not graph.state[-1]:
+                    _rate_writes[:] = [write for write in _rate_writes if write[0] > graph.state[1]]
+
+    return matrix
+
+
+def _get_written_currencies(previous_state: tuple, state: tuple) -> set | None:
+    """
+    Returns ids of currencies, rates of which were written through this module up to the state of the graph
+    since the matrix was built out of transaction last. None if rates might have been modified otherwise.
+    """
+    if previous_state is None or state is None or previous_state[0] != state[0]:
+        # another connection has committed
+        return None
+
+    writes = [(total_changes, ids) for total_changes, ids in _rate_writes if total_changes <= state[1]]
+    # any change made after the last registered write wasn't registered
+    last_registered = writes[-1][0] if writes else previous_state[1]
+    if last_registered != state[1] or any(ids is None for _, ids in writes):
+        return None
+
+    return set().union(*(ids for _, ids in writes))
+
+
+def set_shared_rates(reader):
+    global SHARED_RATES, _committed_data_version
+    SHARED_RATES = reader
+    # publisher takes rates from DB as soon as it starts, so what was written before is left to it
+    _committed_data_version = data_version
+
+
+def _get_published_rates():
+    """
+    Returns the rate matrix shared by processes, unless it isn't shared or the changes this process
+    has committed might not be published yet (then the local matrix has to be used)
+    """
+    global _committed_data_version, _committed_at
+    shared = SHARED_RATES
+    # uncommitted changes aren't published
+    if not shared or CONNECTION.in_transaction:
+        return None
+
+    # changes are seen committed (or rolled back) for the first time, rates taken from DB after that include them
+    if _committed_data_version != data_version:
+        _committed_data_version, _committed_at = data_version, time.time()
+
+    taken_at = shared.taken_at
+    return shared if taken_at is not None and taken_at >= _committed_at else None
+
+
+def get_rate_snapshot(moment: datetime.datetime) -> RateGraph:
+    """
+    Returns the rate graph of rates as they were before the moment (built upon rates history).
+    Snapshots of the settled past are kept, as they can't change.
+    """
+    key = _format_history_time(moment)
+
+    with _rate_snapshots_lock:
+        graph = RATE_SNAPSHOTS.get(key)
+        if graph:
+            RATE_SNAPSHOTS.move_to_end(key)
+            return graph
+
+    graph = RateGraph()
+    graph.load(_read_cursor(), as_of=key)
+
+    settled = _format_history_time(datetime.datetime.now(datetime.timezone.utc) - RATE_SNAPSHOT_SETTLE_TIME)
+    # uncommitted history might be rolled back
+    if key <= settled and not CONNECTION.in_transaction:
+        with _rate_snapshots_lock:
+            RATE_SNAPSHOTS[key] = graph
+            while len(RATE_SNAPSHOTS) > RATE_SNAPSHOTS_LIMIT:
+                RATE_SNAPSHOTS.popitem(last=False)
+
+    return graph
+
+
+def get_exchange_rate(rate: CurrencyRate, *, strategy: int = 0, max_path_depth: int = MAX_RATE_PATH_DEPTH,
+                      as_of: datetime.datetime = None):
+    """
+    If as_of moment is given, the rate is resolved upon the rates as they were before it.
+    ERRORS:
     - no idenitity fields were given
     - no such rate in DB
     """
@@ -173,77 +491,51 @@ def get_exchange_rate(rate: CurrencyRate, *, strategy: int = 0):
     assert by_id or by_cur_codes, ('No any identity set of fields in data object to fetch data. '
                                    'Either id of rate or base+target currencies should be given')
 
-    identity = dict(id=params.get('id')) if by_id else dict(base_currency_code=params.get('base_currency_code'),
-                                                            target_currency_code=params.get('target_currency_code'))
-
-    substitute_keys(params, CURRENCY_RATE_FIELDS_TO_DB_MAP)
-    substitute_keys(identity, CURRENCY_RATE_FIELDS_TO_DB_MAP)
+    graph = get_rate_graph() if as_of is None else get_rate_snapshot(as_of)
 
     if by_id:
-        param_line = build_sql_query_params_line(identity, '')
+        base_id, target_id = graph.get_pair_by_rate_id(params['id']) or (None, None)
     else:
-        param_line = 'b.code = :base_currency_code AND t.code = :target_currency_code'
+        base_id = graph.get_currency_id(params['base_currency_code'])
+        target_id = graph.get_currency_id(params['target_currency_code'])
 
-    sql = '''
-        SELECT exchange_rate_id, b.code, t.code, rate, source_id
-        FROM exchange_rates
-        JOIN currency b ON (b.currency_id = base_currency_id) 
-        JOIN currency t ON (t.currency_id = target_currency_id)
-        WHERE ''' + param_line
+    edge = graph.get_edge(base_id, target_id)
 
-    res = db_cursor.execute(sql, identity).fetchone()
-
-    if res:
-        return CurrencyRate(*res[:3], 1, *res[3:])
+    if edge:
+        return CurrencyRate(edge.id, graph.get_currency_code(base_id), graph.get_currency_code(target_id), 1,
+                            edge.rate, edge.source_id)
 
     if not by_cur_codes and strategy != 0:
         raise AssertionError('Cant use any tricky fetching strategies when no both base and target codes were given')
 
+    # the matrix holds the outcomes of both strategies for every pair
+    if strategy & FIND_RATE_BY_MATRIX == FIND_RATE_BY_MATRIX and as_of is None:
+        matrix = _get_published_rates() or get_rate_matrix()
+        res = matrix.get_rate(params['base_currency_code'], params['target_currency_code'])
+        if res:
+            res = round(res, RATES_VAL_PRECISION)
+            return CurrencyRate(None, params['base_currency_code'], params['target_currency_code'], 1, res, None)
+        strategy &= ~FIND_RATE_BY_MATRIX
+
     if FIND_RATE_BY_RECIPROCAL & strategy == FIND_RATE_BY_RECIPROCAL:
-        res = get_exchange_rate(CurrencyRate(None, identity['target_currency_code'],
-                                             identity['base_currency_code'], None, None, None))
+        res = graph.find_reciprocal_rate(params['base_currency_code'], params['target_currency_code'])
         if res:
             rate.units = 1
-            rate.rate = round(res.reciprocal_rate, RATES_VAL_PRECISION)
+            rate.rate = round(res, RATES_VAL_PRECISION)
             return rate
 
     if FIND_RATE_BY_COMMON_TARGET & strategy == FIND_RATE_BY_COMMON_TARGET:
-        ids = db_cursor.execute(
-            '''
-            SELECT currency_id
-            FROM currency
-            WHERE code IN (?, ?)
-            ''', (params['base_currency_code'], params['target_currency_code'])).fetchall()
-
-        if len(ids) != 2:
-            return None
-
-        base_id, target_id = tuple(rec[0] for rec in ids)
-
-        sql = '''
-            WITH common_cur AS 
-            (SELECT target_currency_id AS id
-            FROM exchange_rates
-            WHERE base_currency_id = ?
-            INTERSECT 
-            SELECT target_currency_id AS id
-            FROM exchange_rates
-            WHERE base_currency_id = ?
-            LIMIT 1)
-            SELECT rate
-            FROM exchange_rates
-            WHERE base_currency_id = ? AND target_currency_id = (SELECT * FROM common_cur)
-            UNION ALL
-            SELECT rate
-            FROM exchange_rates
-            WHERE base_currency_id = ? AND target_currency_id = (SELECT * FROM common_cur)
-            '''
+        res = graph.find_common_target_rate(params['base_currency_code'], params['target_currency_code'])
 
-        res = tuple(rec[0] for rec in db_cursor.execute(
-            sql, (base_id, target_id, base_id, target_id)).fetchall())
+        if res:
+            res = round(res, RATES_VAL_PRECISION)
+            return CurrencyRate(None, params['base_currency_code'], params['target_currency_code'], 1, res, None)
+
+    if FIND_RATE_BY_PATH & strategy == FIND_RATE_BY_PATH:
+        res = graph.find_path_rate(params['base_currency_code'], params['target_currency_code'], max_path_depth)
 
         if res:
-            res = round(res[0] / res[1], RATES_VAL_PRECISION)
+            res = round(res, RATES_VAL_PRECISION)
             return CurrencyRate(None, params['base_currency_code'], params['target_currency_code'], 1, res, None)
 
     return None
@@ -281,10 +573,6 @@ def update_exchange_rate(rate: CurrencyRate):
         dict_remove_none_val_items(dict(rate=params.get('rate'), source_id=params.get('source_id'))), ', '
     )
 
-    rate_exists = get_exchange_rate(rate)
-    if not rate_exists:
-        raise NoRecordToModify(f'No rate that corresponds to {rate}')
-
     if len(identity) == 1:
         cte_param_line = build_sql_query_params_line(identity, '')
         sql = 'UPDATE exchange_rates SET ' + sql_query_params_line + ' WHERE ' + cte_param_line + ' RETURNING *'
@@ -304,12 +592,22 @@ def update_exchange_rate(rate: CurrencyRate):
             '''
 
     try:
-        res = db_cursor.execute(sql, params).fetchone()
+        res = _write_cursor().execute(sql, params).fetchone()
     except sqlite3.Error as e:
         if e.sqlite_errorcode == 787:
             raise QueryError('Foreign key constraint failed')
         raise
 
+    # existence is checked by the update itself instead of a preceding lookup,
+    # so the rate graph isn't reloaded for every single rate during bulk updates
+    if not res:
+        raise NoRecordToModify(f'No rate that corresponds to {rate}')
+
+    if params.get('rate') is not None:
+        _record_rates_history(_write_cursor(), (res[1:],))
+
+    _register_modification(written_pairs=(res[1:3],))
+
     return CurrencyRate(res[0], params['base_currency_code'], params['target_currency_code'], 1, *res[3:])
 
 
@@ -344,7 +642,7 @@ def add_exchange_rate(rate: CurrencyRate):
         RETURNING *'''
 
     try:
-        res = db_cursor.execute(sql, params).fetchone()
+        res = _write_cursor().execute(sql, params).fetchone()
     except sqlite3.Error as e:
         if e.sqlite_errorcode == 2067:
             raise RecordOfSuchIdentityExists(f'Record with the same identity as {rate} already exists in database.')
@@ -356,11 +654,143 @@ def add_exchange_rate(rate: CurrencyRate):
             raise
 
     if res:
+        _record_rates_history(_write_cursor(), (res[1:],))
+        _register_modification(written_pairs=(res[1:3],))
         return CurrencyRate(res[0], params['base_currency_code'], params['target_currency_code'], 1, *res[3:])
     else:
         return None
 
 
+def upsert_exchange_rates(rates: Iterable[CurrencyRate], *, insert_new: bool = True) -> UpsertResult:
+    """
+    Writes many rates at once: rates of the existing pairs are updated, the new pairs are inserted
+    (if insert_new is set, otherwise they're skipped). Rates of unknown currencies or without value are skipped.
+    Rates, that are the same as the stored ones (up to RATES_VAL_PRECISION), aren't written.
+    Returns counts of inserted, updated, unchanged and skipped rates along with the change set (tuple of RateChange).
+    ERRORS:
+    - no such source (QueryError)
+    """
+    cursor = _write_cursor()
+
+    currency_ids = dict(cursor.execute('SELECT code, currency_id FROM currency'))
+    stored_rates = {
+        (base_id, target_id): rate
+        for base_id, target_id, rate in cursor.execute(
+            'SELECT base_currency_id, target_currency_id, rate FROM exchange_rates'
+        )
+    }
+
+    inserted = updated = unchanged = skipped = 0
+    rows = []
+    changes = []
+
+    for rate in rates:
+        pair = (currency_ids.get(rate.base_currency_code), currency_ids.get(rate.target_currency_code))
+        rate_value = rate.reduced_rate
+
+        if None in pair or rate_value is None:
+            skipped += 1
+            continue
+
+        if pair in stored_rates:
+            old_value = stored_rates[pair]
+            # rates are compared with the precision they're given out with
+            if (old_value is not None and
+                    round(old_value, RATES_VAL_PRECISION) == round(rate_value, RATES_VAL_PRECISION)):
+                unchanged += 1
+                continue
+            updated += 1
+        elif insert_new:
+            old_value = None
+            inserted += 1
+        else:
+            skipped += 1
+            continue
+
+        stored_rates[pair] = rate_value
+        rows.append((*pair, rate_value, rate.info_source))
+        changes.append(RateChange(rate.base_currency_code, rate.target_currency_code, old_value, rate_value))
+
+    sql = '''
+        INSERT INTO exchange_rates(base_currency_id, target_currency_id, rate, source_id)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(base_currency_id, target_currency_id) DO UPDATE SET
+        rate = excluded.rate, source_id = coalesce(excluded.source_id, source_id)
+        '''
+
+    try:
+        cursor.executemany(sql, rows)
+        # history of all the changed rates is written at once too
+        _record_rates_history(cursor, rows)
+    except sqlite3.Error as e:
+        if e.sqlite_errorcode == 787:
+            raise QueryError('Foreign key constraint failed')
+        raise
+
+    # data is left of the same version if nothing has changed, so that nothing built upon it is invalidated;
+    # pairs of the change set are registered, so the rate matrix is updated only for them
+    if rows:
+        _register_modification(written_pairs=(row[:2] for row in rows))
+
+    return UpsertResult(inserted, updated, unchanged, skipped, tuple(changes))
+
+
+def _record_rates_history(cursor: sqlite3.Cursor, rows: Iterable[tuple]):
+    """Records rates given as (base id, target id, rate, source id) rows as valid from now on"""
+    valid_from = _format_history_time(datetime.datetime.now(datetime.timezone.utc))
+
+    cursor.executemany(
+        '''
+        INSERT INTO exchange_rates_history(base_currency_id, target_currency_id, valid_from, rate, source_id)
+        VALUES (?, ?, ?, ?, ?)
+        ''',
+        ((base_id, target_id, valid_from, rate, source_id) for base_id, target_id, rate, source_id in rows)
+    )
+
+
+def _format_history_time(moment: datetime.datetime):
+    # naive moments are taken as UTC ones
+    if moment.tzinfo:
+        moment = moment.astimezone(datetime.timezone.utc)
+    return moment.strftime(HISTORY_TIME_FORMAT)
+
+
+def get_exchange_rate_history(base_code: str, target_code: str, since: datetime.datetime = None,
+                              until: datetime.datetime = None):
+    """
+    Gives out (valid from, rate) points of the pair's history in chronological order, lazily,
+    HISTORY_FETCH_SIZE points at a time. Bounds: since is inclusive, until is exclusive.
+    Returns None if any of the currencies is unknown.
+    """
+    cache = get_currency_cache()
+    base, target = cache.get_by_code(base_code), cache.get_by_code(target_code)
+
+    if not base or not target:
+        return None
+
+    conditions = ['base_currency_id = :base_id', 'target_currency_id = :target_id']
+    params = {'base_id': base.id, 'target_id': target.id}
+
+    if since:
+        conditions.append('valid_from >= :since')
+        params['since'] = _format_history_time(since)
+    if until:
+        conditions.append('valid_from < :until')
+        params['until'] = _format_history_time(until)
+
+    cursor = _read_cursor().execute(
+        'SELECT valid_from, rate FROM exchange_rates_history WHERE ' + ' AND '.join(conditions) +
+        ' ORDER BY valid_from',
+        params
+    )
+
+    def fetch():
+        while points := cursor.fetchmany(HISTORY_FETCH_SIZE):
+            yield from points
+
+    return fetch()
+
+
 class QueryError(Exception):
     pass
 
@@ -0,0 +1,186 @@
+import sqlite3
+import threading
+from collections import namedtuple, OrderedDict
+
+
+RateEdge = namedtuple('RateEdge', ['id', 'rate', 'source_id'])
+
+# number of found chain rates kept by graph, recently used ones
+PATH_CACHE_SIZE = 4096
+
+RATES_SQL = 'SELECT exchange_rate_id, base_currency_id, target_currency_id, rate, source_id FROM exchange_rates'
+
+# rates as they were before the given moment: the latest point of every pair's history
+# (sqlite takes values of bare columns from the row max() picks)
+RATES_AS_OF_SQL = '''
+    SELECT NULL, base_currency_id, target_currency_id, rate, source_id
+    FROM (
+        SELECT base_currency_id, target_currency_id, rate, source_id, max(valid_from)
+        FROM exchange_rates_history
+        WHERE valid_from < ?
+        GROUP BY base_currency_id, target_currency_id
+    )
+    '''
+
+
+class RateGraph:
+    """
+    In-memory representation of exchange_rates table: an adjacency structure keyed by currency id,
+    where every edge base -> target holds the stored rate of the pair.
+    Allows to resolve direct, reciprocal, common target and multi-pair chain rates without touching the database.
+    """
+
+    def __init__(self):
+        self._ids_by_code = {}
+        self._codes_by_id = {}
+        self._edges = {}
+        self._edges_by_rate_id = {}
+        self._reverse_edges = {}
+        self._path_cache = OrderedDict()
+        self._path_cache_lock = threading.Lock()
+        self.state = None
+
+    def load(self, cursor: sqlite3.Cursor, state=None, *, as_of: str = None):
+        """Loads the current rates, or the rates as they were before as_of moment (then edges have no ids)"""
+        ids_by_code = {}
+        codes_by_id = {}
+        edges = {}
+        edges_by_rate_id = {}
+        reverse_edges = {}
+
+        for currency_id, code in cursor.execute('SELECT currency_id, code FROM currency'):
+            ids_by_code[code] = currency_id
+            codes_by_id[currency_id] = code
+
+        res = cursor.execute(RATES_SQL) if as_of is None else cursor.execute(RATES_AS_OF_SQL, (as_of,))
+        for rate_id, base_id, target_id, rate, source_id in res:
+            edge = RateEdge(rate_id, rate, source_id)
+            edges.setdefault(base_id, {})[target_id] = edge
+            if rate_id is not None:
+                edges_by_rate_id[rate_id] = (base_id, target_id)
+            reverse_edges.setdefault(target_id, {})[base_id] = edge
+
+        self._ids_by_code = ids_by_code
+        self._codes_by_id = codes_by_id
+        self._edges = edges
+        self._edges_by_rate_id = edges_by_rate_id
+        self._reverse_edges = reverse_edges
+        self._path_cache = OrderedDict()
+        self.state = state
+
+    def invalidate(self):
+        self.state = None
+
+    def get_currency_id(self, code):
+        return self._ids_by_code.get(code)
+
+    def get_currency_code(self, currency_id):
+        return self._codes_by_id.get(currency_id)
+
+    def get_edge(self, base_id, target_id) -> RateEdge | None:
+        return self._edges.get(base_id, {}).get(target_id)
+
+    def get_pair_by_rate_id(self, rate_id) -> tuple | None:
+        return self._edges_by_rate_id.get(rate_id)
+
+    def get_targets(self, base_id) -> dict:
+        return self._edges.get(base_id, {})
+
+    def get_bases(self, target_id) -> dict:
+        return self._reverse_edges.get(target_id, {})
+
+    def get_currencies(self) -> dict:
+        """Returns codes of currencies by their ids"""
+        return self._codes_by_id
+
+    def get_changed_currencies(self, other: 'RateGraph') -> set:
+        """Returns ids of currencies, rates of pairs of which differ in the other graph (either by value or presence)"""
+        changed = set()
+        for base_id in self._edges.keys() | other._edges.keys():
+            targets, other_targets = self.get_targets(base_id), other.get_targets(base_id)
+            for target_id in targets.keys() | other_targets.keys():
+                edge, other_edge = targets.get(target_id), other_targets.get(target_id)
+                if edge is None or other_edge is None or edge.rate != other_edge.rate:
+                    changed.update((base_id, target_id))
+        return changed
+
+    def find_direct_rate(self, base_code, target_code) -> RateEdge | None:
+        return self.get_edge(self.get_currency_id(base_code), self.get_currency_id(target_code))
+
+    def find_reciprocal_rate(self, base_code, target_code) -> float | None:
+        edge = self.find_direct_rate(target_code, base_code)
+
+        return 1 / edge.rate if edge and edge.rate else None
+
+    def find_common_target_rate(self, base_code, target_code) -> float | None:
+        base_id, target_id = self.get_currency_id(base_code), self.get_currency_id(target_code)
+
+        if base_id is None or target_id is None:
+            return None
+
+        base_targets, target_targets = self.get_targets(base_id), self.get_targets(target_id)
+
+        # the least id of common targets is taken, as the sql INTERSECT used to give
+        common = base_targets.keys() & target_targets.keys()
+        if not common:
+            return None
+        common_id = min(common)
+
+        return base_targets[common_id].rate / target_targets[common_id].rate
+
+    def find_path_rate(self, base_code, target_code, max_depth: int) -> float | None:
+        """
+        Finds the rate through the chain of the fewest pairs (max_depth at most) connecting two currencies,
+        where every pair may be passed either directly or reciprocally.
+        Results for currencies of the graph are cached (PATH_CACHE_SIZE recently used ones) until it's reloaded.
+        """
+        base_id, target_id = self.get_currency_id(base_code), self.get_currency_id(target_code)
+        if base_id is None or target_id is None:
+            return None
+
+        key = (base_id, target_id, max_depth)
+        with self._path_cache_lock:
+            if key in self._path_cache:
+                self._path_cache.move_to_end(key)
+                return self._path_cache[key]
+
+        res = self._search_path(base_id, target_id, max_depth)
+
+        with self._path_cache_lock:
+            self._path_cache[key] = res
+            if len(self._path_cache) > PATH_CACHE_SIZE:
+                self._path_cache.popitem(last=False)
+
+        return res
+
+    def _get_neighbours(self, currency_id):
+        for target_id, edge in self._edges.get(currency_id, {}).items():
+            yield target_id, edge.rate
+        for base_id, edge in self._reverse_edges.get(currency_id, {}).items():
+            if edge.rate:
+                yield base_id, 1 / edge.rate
+
+    def _search_path(self, base_id, target_id, max_depth):
+        # breadth-first search, level by level, so the first found chain is one of the shortest
+        if base_id == target_id:
+            return 1.0
+
+        frontier = {base_id: 1.0}
+        visited = {base_id}
+
+        for _ in range(max_depth):
+            next_frontier = {}
+            for currency_id, acc_rate in frontier.items():
+                for neighbour_id, rate in self._get_neighbours(currency_id):
+                    if neighbour_id not in visited and neighbour_id not in next_frontier:
+                        next_frontier[neighbour_id] = acc_rate * rate
+
+            if target_id in next_frontier:
+                return next_frontier[target_id]
+            if not next_frontier:
+                break
+
+            visited.update(next_frontier)
+            frontier = next_frontier
+
+        return None
@@ -0,0 +1,114 @@
+import math
+from array import array
+
+from app.rate_graph import RateGraph
+
+NO_RATE = math.nan
+
+# when rates of more currencies than that part of all of them have changed, matrix is built anew
+INCREMENTAL_UPDATE_LIMIT = 0.25
+
+
+class RateMatrix:
+    """
+    Dense matrix of rates of every pair of currencies, derived from the rate graph by the rules get_exchange_rate
+    applies: stored rate of the pair, reciprocal of the reverse one, or the one through their common target.
+    Rates are kept row by row in a flat array of doubles, NaN marks the pairs that can't be converted.
+    Matrix is never modified once built, the one of the changed graph is made by copying.
+    """
+
+    def __init__(self, graph: RateGraph, previous: 'RateMatrix' = None, changed: set = None):
+        """
+        changed - ids of currencies, rates of which may differ from those of the previous matrix's graph
+        (if they aren't known, they're found by comparing the graphs)
+        """
+        self.graph = graph
+        currencies = graph.get_currencies()
+        ids = sorted(currencies)
+        self._size = len(ids)
+        self._index_by_id = {currency_id: i for i, currency_id in enumerate(ids)}
+        self._index_by_code = {currencies[currency_id]: i for i, currency_id in enumerate(ids)}
+
+        if previous and previous._index_by_id == self._index_by_id:
+            if changed is None:
+                changed = graph.get_changed_currencies(previous.graph)
+            if len(changed) <= self._size * INCREMENTAL_UPDATE_LIMIT:
+                self._rates = self._update(previous._rates, changed)
+                return
+
+        self._rates = self._build()
+
+    def get_codes(self) -> list:
+        """Returns codes of currencies in the order of rows (and columns)"""
+        return sorted(self._index_by_code, key=self._index_by_code.get)
+
+    def get_rates(self) -> array:
+        return self._rates
+
+    def get_rate(self, base_code, target_code) -> float | None:
+        base, target = self._index_by_code.get(base_code), self._index_by_code.get(target_code)
+        if base is None or target is None:
+            return None
+
+        rate = self._rates[base * self._size + target]
+        return None if math.isnan(rate) else rate
+
+    def _build(self):
+        graph, size, index = self.graph, self._size, self._index_by_id
+        rates = array('d', [NO_RATE]) * (size * size)
+
+        # rules are applied from the weakest to the strongest, so the latter ones take over;
+        # common targets go from the greatest id to the least one, as the least one is taken by get_exchange_rate
+        for target_id in sorted(index, reverse=True):
+            bases = [(index[base_id], edge.rate) for base_id, edge in graph.get_bases(target_id).items()]
+            for base, base_rate in bases:
+                row = base * size
+                for other, other_rate in bases:
+                    if other_rate:
+                        rates[row + other] = base_rate / other_rate
+
+        edges = [(index[base_id], index[target_id], edge.rate)
+                 for base_id in index for target_id, edge in graph.get_targets(base_id).items()]
+        for base, target, rate in edges:
+            if rate:
+                rates[target * size + base] = 1 / rate
+        for base, target, rate in edges:
+            rates[base * size + target] = rate
+
+        return rates
+
+    def _update(self, previous_rates: array, changed: set):
+        # only rates of pairs one of currencies of which is the changed one may differ
+        if not changed:
+            return previous_rates
+
+        rates = array('d', previous_rates)
+        size, index = self._size, self._index_by_id
+
+        for currency_id in changed:
+            i = index[currency_id]
+            for other_id, j in index.items():
+                rates[i * size + j] = self._derive(currency_id, other_id)
+                rates[j * size + i] = self._derive(other_id, currency_id)
+
+        return rates
+
+    def _derive(self, base_id, target_id):
+        graph = self.graph
+
+        edge = graph.get_edge(base_id, target_id)
+        if edge:
+            return edge.rate
+
+        edge = graph.get_edge(target_id, base_id)
+        if edge and edge.rate:
+            return 1 / edge.rate
+
+        base_targets, target_targets = graph.get_targets(base_id), graph.get_targets(target_id)
+        common = base_targets.keys() & target_targets.keys()
+        if common:
+            common_id = min(common)
+            if target_targets[common_id].rate:
+                return base_targets[common_id].rate / target_targets[common_id].rate
+
+        return NO_RATE
@@ -0,0 +1,263 @@
+"""
+Sharing of the rate matrix between processes serving the application through a memory-mapped file,
+so that none of them has to go to DB to learn that rates were modified by another one.
+
+File consists of the header and two slots. The publisher writes the matrix into the slot that isn't in use,
+then switches the header to it and increases the version. Readers map the file and read rates right from it,
+version is checked after every read, so the read is repeated if the slot was overwritten meanwhile.
+
+Header: magic, active slot (0 or 1), slot capacity in bytes, version (0 - nothing is published yet).
+Slot: number of currencies (n), moment (time.time()) the rates were taken from DB at, their 3-letter codes
+(padded to 8 bytes), n * n doubles of rates row by row.
+"""
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+
+from app.rate_graph import RateGraph
+from app.rate_matrix import RateMatrix
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+MAGIC = b'CXRATES2'
+HEADER = struct.Struct('<8sQQQ')
+SLOT_LAYOUT = struct.Struct('<8sQQ')  # the same header, without version
+VERSION = struct.Struct('<Q')
+VERSION_OFFSET = SLOT_LAYOUT.size
+CODE_SIZE = 3
+
+# slots are made bigger than needed, so that new currencies don't make the file grow every time
+CURRENCIES_HEADROOM = 64
+
+# reader checks that often whether the file has appeared, until it's published
+MAP_RETRY_INTERVAL = 1.0
+
+
+def _padded(size):
+    return (size + 7) // 8 * 8
+
+
+def get_slot_size(currencies_number: int):
+    return 16 + _padded(currencies_number * CODE_SIZE) + currencies_number * currencies_number * 8
+
+
+class SharedRatesWriter:
+    """Writes the rate matrix into the file (only one process at a time is supposed to)"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self._fd).st_size < HEADER.size:
+            os.ftruncate(self._fd, HEADER.size)
+        self._mm = mmap.mmap(self._fd, 0)
+        if self._mm[:len(MAGIC)] != MAGIC:
+            HEADER.pack_into(self._mm, 0, MAGIC, 0, 0, 0)
+
+    def publish(self, codes: list, rates: array, taken_at: float = None) -> int:
+        """
+        Publishes rates of currencies (rows of n * n matrix in order of codes), which were taken from DB
+        at the moment (now, if it isn't given). Returns the new version.
+        """
+        _, active, capacity, version = HEADER.unpack_from(self._mm)
+        n = len(codes)
+        size = get_slot_size(n)
+
+        if size > capacity:
+            capacity = get_slot_size(n + CURRENCIES_HEADROOM)
+            os.ftruncate(self._fd, HEADER.size + 2 * capacity)
+            self._mm.close()
+            self._mm = mmap.mmap(self._fd, 0)
+
+        slot = 1 - active if version else 0
+        offset = HEADER.size + slot * capacity
+        codes_size = _padded(n * CODE_SIZE)
+
+        self._mm[offset:offset + 16] = struct.pack('<Qd', n, time.time() if taken_at is None else taken_at)
+        self._mm[offset + 16:offset + 16 + codes_size] = ''.join(codes).encode('ascii').ljust(codes_size, b'\0')
+        self._mm[offset + 16 + codes_size:offset + size] = rates.tobytes()
+
+        # slot is switched before the version is increased, readers go by the version
+        SLOT_LAYOUT.pack_into(self._mm, 0, MAGIC, slot, capacity)
+        VERSION.pack_into(self._mm, VERSION_OFFSET, version + 1)
+
+        return version + 1
+
+    def close(self):
+        self._mm.close()
+        os.close(self._fd)
+
+
+class SharedRatesReader:
+    """Reads rates right from the file the matrix is published to, picking up new versions as they appear"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._mm = None
+        self._next_map_attempt = 0
+        # (version, index by code, rates, n, moment rates were taken at) of the version read last
+        self._state = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_published(self):
+        return self._read_version() > 0
+
+    @property
+    def taken_at(self) -> float | None:
+        """Moment (time.time()) the published rates were taken from DB at"""
+        state = self._get_state()
+        return state[4] if state else None
+
+    def get_rate(self, base_code, target_code) -> float | None:
+        while True:
+            state = self._get_state()
+            if state is None:
+                return None
+
+            version, index, rates, n, _ = state
+            base, target = index.get(base_code), index.get(target_code)
+            rate = None if base is None or target is None else rates[base * n + target]
+
+            if self._read_version() == version:
+                return None if rate is None or math.isnan(rate) else rate
+
+    def _map(self):
+        if self._mm is None and time.monotonic() >= self._next_map_attempt:
+            self._next_map_attempt = time.monotonic() + MAP_RETRY_INTERVAL
+            try:
+                with open(self.path, 'rb') as f:
+                    self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                return None
+        return self._mm
+
+    def _read_version(self):
+        mm = self._map()
+        if mm is None or len(mm) < HEADER.size or mm[:len(MAGIC)] != MAGIC:
+            return 0
+        return VERSION.unpack_from(mm, VERSION_OFFSET)[0]
+
+    def _get_state(self):
+        state = self._state
+        version = self._read_version()
+        if state and state[0] == version:
+            return state
+        if not version:
+            return None
+
+        with self._lock:
+            _, slot, capacity = SLOT_LAYOUT.unpack_from(self._mm)
+            offset = HEADER.size + slot * capacity
+
+            if len(self._mm) < HEADER.size + 2 * capacity:
+                # file has grown, the old mapping is left to the reads that may still use it
+                with open(self.path, 'rb') as f:
+                    self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            try:
+                n, taken_at = struct.unpack_from('<Qd', self._mm, offset)
+                codes_size = _padded(n * CODE_SIZE)
+                codes = self._mm[offset + 16:offset + 16 + n * CODE_SIZE].decode('ascii')
+                index = {codes[i * CODE_SIZE:(i + 1) * CODE_SIZE]: i for i in range(n)}
+                rates_offset = offset + 16 + codes_size
+                rates = memoryview(self._mm)[rates_offset:rates_offset + n * n * 8].cast('d')
+            except (ValueError, struct.error):
+                # garbage of the slot being overwritten, it gets read anew
+                return version, {}, (), 0, None
+
+            state = (version, index, rates, n, taken_at)
+            # the slot might have been overwritten while it was being read
+            if self._read_version() == version:
+                self._state = state
+
+        return state
+
+
+class RatesPublisher:
+    """
+    Publishes the rate matrix whenever DB gets modified (by any process). Every process may run one:
+    the one that takes the lock of the file publishes, the rest stand by in case it stops.
+    """
+
+    def __init__(self, path: str, pool, *, check_interval=1.0, logger=None):
+        self.path = path
+        self._pool = pool
+        self.check_interval = check_interval
+        self._logger = logger or logging.getLogger(__name__)
+        self._lock_fd = None
+        self._writer = None
+        self._data_version = None
+        self._matrix = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='rates-publisher', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout)
+        if self._writer:
+            self._writer.close()
+            os.close(self._lock_fd)
+            self._writer = self._lock_fd = None
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.publish_if_modified()
+            except Exception as e:
+                self._logger.warning(f'Rates were not published: {e!r}')
+            self._stop_event.wait(self.check_interval)
+
+    def acquire(self) -> bool:
+        """Tries to become the publisher of the file"""
+        if self._writer:
+            return True
+
+        fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if fcntl:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        except OSError:
+            os.close(fd)
+            return False
+
+        self._lock_fd = fd
+        self._writer = SharedRatesWriter(self.path)
+        return True
+
+    def publish_if_modified(self) -> bool:
+        if not self.acquire():
+            return False
+
+        # rates are taken no earlier than that
+        taken_at = time.time()
+        conn = self._pool.get_reader()
+        # data_version changes whenever another connection commits
+        data_version = conn.execute('PRAGMA data_version').fetchone()[0]
+        if data_version == self._data_version and self._matrix:
+            return False
+
+        graph = RateGraph()
+        graph.load(conn.cursor())
+        self._matrix = RateMatrix(graph, self._matrix)
+        version = self._writer.publish(self._matrix.get_codes(), self._matrix.get_rates(), taken_at)
+        self._data_version = data_version
+        self._logger.debug(f'Rates were published, version {version}')
+
+        return True
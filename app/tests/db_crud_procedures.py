@@ -1,9 +1,22 @@
 import unittest
+import datetime
+import math
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from array import array
 from dataclasses import asdict
 from functools import partial
+from unittest import mock
 
 import app
 from app.data_objects import CurrencyRate, Currency
+from app.init import migrate_db, SCHEMA_VERSION, HISTORY_BACKFILL_TIME
+from app.rate_graph import RateGraph
+from app.rate_matrix import RateMatrix
+from app.shared_rates import SharedRatesWriter, SharedRatesReader, RatesPublisher
 
 app.connect_db('test.db')
 
@@ -58,6 +71,15 @@ class CurrencyCrudTest(unittest.TestCase):
         app.connection.rollback()
         self.assertEqual(app.update_currency(Currency(None, 'AMD', None, 'changed')), correct_result)
 
+    def test_getCurrencyReflectsUpdate(self):
+        self.assertEqual(app.get_currency_by_code('AMD'), Currency(4, 'AMD', 'Armenian Dram', 'դր.'))
+        app.update_currency(Currency(4, None, None, 'changed'))
+
+        self.assertEqual(app.get_currency_by_code('AMD'), Currency(4, 'AMD', 'Armenian Dram', 'changed'))
+        self.assertEqual(app.get_currency_by_id(4), Currency(4, 'AMD', 'Armenian Dram', 'changed'))
+        app.connection.rollback()
+        self.assertEqual(app.get_currency_by_id(4), Currency(4, 'AMD', 'Armenian Dram', 'դր.'))
+
     def test_updateNonExistingCurrency(self):
         with self.assertRaises(app.main.NoRecordToModify):
             app.update_currency(Currency(None, 'XXX', None, None))
@@ -99,6 +121,15 @@ class ExchangeRatesCrudTest(unittest.TestCase):
             sql).fetchall())
         self.assertEqual(app.get_all_exchange_rates(), correct_result_set_rates)
 
+    def test_getAllRatesExpanded(self):
+        correct_result_set = tuple(
+            (rate,
+             app.get_currency_by_code(rate.base_currency_code),
+             app.get_currency_by_code(rate.target_currency_code))
+            for rate in app.get_all_exchange_rates()
+        )
+        self.assertEqual(app.get_all_exchange_rates_expanded(), correct_result_set)
+
     def test_getOneRateByIdOrCode(self):
         correct_result_single_rate = CurrencyRate(1, 'AUD', 'RUB', 1, 58.0244, None)
 
@@ -145,12 +176,173 @@ class ExchangeRatesCrudTest(unittest.TestCase):
             self.cursor.execute('DELETE FROM exchange_rates WHERE exchange_rate_id > 946')
             app.connection.commit()
 
+    def test_getRateByPathStrategy(self):
+        sql = '''
+        INSERT INTO exchange_rates(base_currency_id, target_currency_id, rate)
+        VALUES
+        (?, ?, ?)
+        '''
+        # ETH -> BTC -> USD -> RUB
+        self.cursor.executemany(sql, ((182, 181, 0.05), (181, 159, 5000)))
+        app.connection.commit()
+
+        correct_result_single_rate = CurrencyRate(None, 'ETH', 'RUB', 1, round(0.05 * 5000 * 87.373, 4), None)
+        try:
+            strategy = app.main.FIND_RATE_BY_COMMON_TARGET | app.main.FIND_RATE_BY_RECIPROCAL
+            self.assertEqual(app.get_exchange_rate(CurrencyRate(None, 'ETH', 'RUB', None, None, None),
+                                                   strategy=strategy), None)
+
+            strategy = app.main.FIND_RATE_BY_PATH
+            self.assertEqual(app.get_exchange_rate(CurrencyRate(None, 'ETH', 'RUB', None, None, None),
+                                                   strategy=strategy), correct_result_single_rate)
+            self.assertEqual(app.get_exchange_rate(CurrencyRate(None, 'ETH', 'RUB', None, None, None),
+                                                   strategy=strategy, max_path_depth=2), None)
+        finally:
+            self.cursor.execute('DELETE FROM exchange_rates WHERE exchange_rate_id > 946')
+            app.connection.commit()
+
+    def test_pathCacheIsBoundedAndKeepsOnlyKnownCurrencies(self):
+        graph = RateGraph()
+        graph.load(app.connection.cursor())
+
+        with mock.patch('app.rate_graph.PATH_CACHE_SIZE', 2):
+            self.assertIsNone(graph.find_path_rate('AUD', 'XXX', 4))
+            self.assertEqual(len(graph._path_cache), 0)
+
+            for target in ('USD', 'EUR', 'BTC'):
+                graph.find_path_rate('AUD', target, 4)
+            self.assertEqual(len(graph._path_cache), 2)
+
     def test_updateRate(self):
         correct_result_single_rate = CurrencyRate(1, 'AUD', 'RUB', 1, 45, None)
 
         self.assertEqual(app.update_exchange_rate(CurrencyRate(1, 'AUD', 'RUB', 1, 45, None)),
                          correct_result_single_rate)
 
+    def test_getRateReflectsUpdate(self):
+        app.get_exchange_rate(CurrencyRate(None, 'AUD', 'RUB', None, None, None))
+        app.update_exchange_rate(CurrencyRate(None, 'AUD', 'RUB', 1, 45, None))
+
+        self.assertEqual(app.get_exchange_rate(CurrencyRate(None, 'AUD', 'RUB', None, None, None)),
+                         CurrencyRate(1, 'AUD', 'RUB', 1, 45, None))
+        app.connection.rollback()
+        self.assertEqual(app.get_exchange_rate(CurrencyRate(None, 'AUD', 'RUB', None, None, None)),
+                         CurrencyRate(1, 'AUD', 'RUB', 1, 58.0244, None))
+
+    def test_graphOfAnotherThreadIsNotTakenForUncommittedOne(self):
+        get_rate = partial(app.get_exchange_rate, CurrencyRate(None, 'AUD', 'RUB', None, None, None))
+        written, read = threading.Event(), threading.Event()
+        rates = []
+
+        def write():
+            # transaction is left open (COMMIT_IF_SUCCESS is off)
+            app.update_exchange_rate(CurrencyRate(None, 'AUD', 'RUB', 1, 45, None))
+            written.set()
+            read.wait(5)
+            rates.append(get_rate().rate)
+
+        thread = threading.Thread(target=write)
+        thread.start()
+        written.wait(5)
+        # reader of this thread sees only committed rates
+        rates.append(get_rate().rate)
+        read.set()
+        thread.join()
+
+        self.assertEqual(rates, [58.0244, 45])
+
+    # commits of other connections are seen at once, not in a moment
+    @mock.patch.object(app.pool, 'data_version_check_interval', 0)
+    def test_rateCommittedByAnotherProcessIsSeen(self):
+        get_rate = partial(app.get_exchange_rate, CurrencyRate(None, 'AUD', 'RUB', None, None, None))
+        self.assertEqual(get_rate().rate, 58.0244)
+
+        other = sqlite3.connect('test.db')
+        try:
+            with other:
+                other.execute('UPDATE exchange_rates SET rate = 45 WHERE exchange_rate_id = 1')
+            self.assertEqual(get_rate().rate, 45)
+        finally:
+            with other:
+                other.execute('UPDATE exchange_rates SET rate = 58.0244 WHERE exchange_rate_id = 1')
+            other.close()
+
+    def test_rateHistoryIsRecorded(self):
+        since = datetime.datetime.now(datetime.timezone.utc)
+        app.update_exchange_rate(CurrencyRate(None, 'AUD', 'RUB', 1, 45, None))
+        app.main.upsert_exchange_rates((CurrencyRate(None, 'AUD', 'RUB', 1, 46, None),))
+
+        points = list(app.get_exchange_rate_history('AUD', 'RUB', since))
+
+        self.assertEqual([rate for valid_from, rate in points], [45, 46])
+        self.assertEqual(list(app.get_exchange_rate_history('AUD', 'RUB', since, since)), [])
+        self.assertIsNone(app.get_exchange_rate_history('AUD', 'XXX'))
+
+    def test_rateMatrixAgreesWithStrategies(self):
+        graph, matrix = app.main.get_rate_graph(), app.main.get_rate_matrix()
+        codes = ('AUD', 'RUB', 'USD', 'EUR', 'BTC', 'ZAR', 'AMD')
+
+        for base in codes:
+            for target in codes:
+                with self.subTest(base=base, target=target):
+                    edge = graph.find_direct_rate(base, target)
+                    correct = (edge.rate if edge else graph.find_reciprocal_rate(base, target) or
+                               graph.find_common_target_rate(base, target))
+                    if correct is None:
+                        self.assertIsNone(matrix.get_rate(base, target))
+                    else:
+                        self.assertAlmostEqual(matrix.get_rate(base, target), correct)
+
+    def test_rateMatrixIsUpdatedIncrementally(self):
+        matrix = app.main.get_rate_matrix()
+        app.update_exchange_rate(CurrencyRate(None, 'AUD', 'RUB', 1, 45, None))
+        updated = app.main.get_rate_matrix()
+
+        self.assertIsNot(updated, matrix)
+        self.assertEqual(updated.get_rate('RUB', 'AUD'), 1 / 45)
+        self.assertEqual(updated._rates.tobytes(), RateMatrix(updated.graph)._rates.tobytes())
+
+    def test_rateMatrixIsUpdatedByWrittenPairs(self):
+        app.main.get_rate_matrix()
+
+        # pairs are known from the writes, so the graphs aren't compared
+        with mock.patch.object(RateGraph, 'get_changed_currencies', side_effect=AssertionError('Graphs are compared')):
+            app.update_exchange_rate(CurrencyRate(None, 'AUD', 'RUB', 1, 45, None))
+            self.assertEqual(app.main.get_rate_matrix().get_rate('RUB', 'AUD'), 1 / 45)
+
+            app.main.upsert_exchange_rates((CurrencyRate(None, 'AUD', 'RUB', 1, 46, None),
+                                            CurrencyRate(None, 'USD', 'RUB', 1, 87.373, None)))
+            self.assertEqual(app.main.get_rate_matrix().get_rate('RUB', 'AUD'), 1 / 46)
+
+            # rows of the written pairs are derived anew as long as the transaction might be rolled back
+            app.connection.rollback()
+            self.assertEqual(app.main.get_rate_matrix().get_rate('RUB', 'AUD'), 1 / 58.0244)
+
+    def test_getExchangeRateAsOf(self):
+        past = datetime.datetime(2000, 1, 1)
+        self.assertIs(app.main.get_rate_snapshot(past), app.main.get_rate_snapshot(past))
+
+        query_rate = CurrencyRate(None, 'AUD', 'RUB', None, None, None)
+        # rates stored before history was introduced are its first points
+        stored = app.get_exchange_rate(query_rate).rate
+        before = datetime.datetime.now(datetime.timezone.utc)
+        time.sleep(0.001)
+        app.update_exchange_rate(CurrencyRate(None, 'AUD', 'RUB', 1, 45, None))
+        time.sleep(0.001)
+        between = datetime.datetime.now(datetime.timezone.utc)
+        time.sleep(0.001)
+        app.main.upsert_exchange_rates((CurrencyRate(None, 'AUD', 'RUB', 1, 46, None),))
+
+        self.assertEqual(app.get_exchange_rate(query_rate, as_of=before).rate, stored)
+        self.assertIsNone(app.get_exchange_rate(query_rate, as_of=datetime.datetime(1970, 1, 1)))
+        self.assertEqual(app.get_exchange_rate(query_rate, as_of=between).rate, 45)
+        self.assertEqual(app.get_exchange_rate(query_rate, as_of=datetime.datetime.now(datetime.timezone.utc)).rate, 46)
+        self.assertAlmostEqual(
+            app.get_exchange_rate(CurrencyRate(None, 'RUB', 'AUD', None, None, None),
+                                  strategy=app.main.FIND_RATE_BY_RECIPROCAL, as_of=between).rate,
+            1 / 45, places=4
+        )
+
     def test_updateRateWhenNoRateValueIsGiven(self):
         with self.assertRaises(app.main.RequiredFieldAbsent):
             app.main.update_exchange_rate(CurrencyRate(1, 'AUD', 'RUB', 1, None, None))
@@ -169,6 +361,43 @@ class ExchangeRatesCrudTest(unittest.TestCase):
         self.assertEqual(app.add_exchange_rate(CurrencyRate(None, 'BTC', 'USD', 5, 5000 * 5, None)),
                          correct_result_single_rate)
 
+    def test_upsertRates(self):
+        rates = (
+            CurrencyRate(None, 'AUD', 'RUB', 1, 45, None),
+            CurrencyRate(None, 'BTC', 'USD', 5, 5000 * 5, None),
+            CurrencyRate(None, 'AUD', 'ZZZ', 1, 4, None),
+        )
+
+        self.assertEqual(app.upsert_exchange_rates(rates)[:4], (1, 1, 0, 1))
+        self.assertEqual(app.get_exchange_rate(CurrencyRate(None, 'AUD', 'RUB', None, None, None)),
+                         CurrencyRate(1, 'AUD', 'RUB', 1, 45, None))
+        self.assertEqual(app.get_exchange_rate(CurrencyRate(None, 'BTC', 'USD', None, None, None)),
+                         CurrencyRate(947, 'BTC', 'USD', 1, 5000, None))
+
+    def test_upsertRatesWithoutInsertion(self):
+        rates = (
+            CurrencyRate(None, 'AUD', 'RUB', 1, 45, None),
+            CurrencyRate(None, 'BTC', 'USD', 1, 5000, None),
+        )
+
+        self.assertEqual(app.upsert_exchange_rates(rates, insert_new=False)[:4], (0, 1, 0, 1))
+        self.assertEqual(app.get_exchange_rate(CurrencyRate(None, 'BTC', 'USD', None, None, None)), None)
+
+    def test_upsertRatesWritesOnlyChanged(self):
+        aud_rub = app.get_exchange_rate(CurrencyRate(None, 'AUD', 'RUB', None, None, None)).rate
+        version = app.main.data_version
+        rates = (CurrencyRate(None, 'AUD', 'RUB', 1, aud_rub + 0.00001, None),)
+
+        self.assertEqual(app.upsert_exchange_rates(rates), (0, 0, 1, 0, ()))
+        # nothing is written, so the data is of the same version
+        self.assertEqual(app.main.data_version, version)
+
+        rates = (CurrencyRate(None, 'AUD', 'RUB', 1, 45, None),)
+        # the transaction is left open by the previous call, so procedure is called without the wrapper
+        self.assertEqual(
+            app.main.upsert_exchange_rates(rates).changes, (app.main.RateChange('AUD', 'RUB', aud_rub, 45),)
+        )
+
     def test_addRateForNonExistingCurrency(self):
         self.assertEqual(app.add_exchange_rate(CurrencyRate(None, 'AUD', 'XXX', 1, 4, None)), None)
 
@@ -181,5 +410,192 @@ class ExchangeRatesCrudTest(unittest.TestCase):
             app.add_exchange_rate(CurrencyRate(None, 'BTC', 'USD', 1, None, None))
 
 
+class ConnectionPoolTest(unittest.TestCase):
+
+    def test_readersArePerThread(self):
+        pool = app.main.ConnectionPool('test.db')
+        readers = []
+
+        def read():
+            readers.append(pool.get_reader())
+            readers.append(pool.get_reader())
+
+        thread = threading.Thread(target=read)
+        thread.start()
+        thread.join()
+
+        self.assertIs(readers[0], readers[1])
+        self.assertIsNot(readers[0], pool.get_reader())
+        self.assertIsNot(readers[0], pool.writer)
+
+    def test_writingThreadReadsThroughWriter(self):
+        pool = app.main.ConnectionPool('test.db')
+
+        with pool.writing():
+            self.assertIs(pool.get_reader(), pool.writer)
+        self.assertIsNot(pool.get_reader(), pool.writer)
+
+    def test_transactionLeftOpenIsReadOnlyByItsThread(self):
+        pool = app.main.ConnectionPool('test.db')
+        readers = []
+
+        with pool.writing() as writer:
+            writer.execute('BEGIN')
+        try:
+            thread = threading.Thread(target=lambda: readers.append(pool.get_reader()))
+            thread.start()
+            thread.join()
+
+            self.assertIs(pool.get_reader(), pool.writer)
+            self.assertIsNot(readers[0], pool.writer)
+        finally:
+            pool.writer.rollback()
+
+    def test_dataVersionIsCheckedOnceInInterval(self):
+        pool = app.main.ConnectionPool('test.db', data_version_check_interval=60)
+        version = pool.get_data_version()
+
+        other = sqlite3.connect('test.db')
+        try:
+            with other:
+                other.execute('UPDATE exchange_rates SET rate = 45 WHERE exchange_rate_id = 1')
+            self.assertEqual(pool.get_data_version(), version)
+
+            pool.data_version_check_interval = 0
+            self.assertNotEqual(pool.get_data_version(), version)
+        finally:
+            with other:
+                other.execute('UPDATE exchange_rates SET rate = 58.0244 WHERE exchange_rate_id = 1')
+            other.close()
+
+    def test_dataVersionCheckDoesntWaitForWriter(self):
+        pool = app.main.ConnectionPool('test.db', data_version_check_interval=0)
+        version = pool.get_data_version()
+        taken, release = threading.Event(), threading.Event()
+
+        def write():
+            with pool.writing():
+                taken.set()
+                release.wait(5)
+
+        thread = threading.Thread(target=write)
+        thread.start()
+        taken.wait(5)
+        try:
+            started = time.monotonic()
+            self.assertEqual(pool.get_data_version(), version)
+            self.assertLess(time.monotonic() - started, 1)
+        finally:
+            release.set()
+            thread.join()
+
+    def test_settingsAreApplied(self):
+        pool = app.main.ConnectionPool('test.db', pragmas={'synchronous': 'NORMAL', 'temp_store': 'MEMORY'})
+
+        self.assertEqual(pool.check_settings(),
+                         {'synchronous': ('NORMAL', 'NORMAL', True), 'temp_store': ('MEMORY', 'MEMORY', True)})
+
+
+class MigrationTest(unittest.TestCase):
+
+    def test_oldDBIsBroughtUpToDate(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'old.db')
+            connection = sqlite3.connect(path)
+            # schema DB was made with before the validators and history were introduced
+            connection.executescript('''
+                CREATE TABLE currency(currency_id INTEGER PRIMARY KEY, code TEXT NOT NULL, full_name NOT NULL,
+                                      currency_sign NOT NULL);
+                CREATE TABLE rates_info_source(source_id INTEGER PRIMARY KEY, src_path TEXT, src_type TEXT,
+                                               days_valid INTEGER, last_appeal);
+                CREATE TABLE exchange_rates(exchange_rate_id INTEGER PRIMARY KEY, base_currency_id INTEGER,
+                                            target_currency_id INTEGER, rate REAL NOT NULL, source_id int);
+                INSERT INTO currency(code, full_name, currency_sign) VALUES ('USD', 'n', 's'), ('RUB', 'n', 's');
+                INSERT INTO exchange_rates(base_currency_id, target_currency_id, rate) VALUES (1, 2, 90.5);
+            ''')
+            connection.close()
+
+            migrate_db(path)
+            migrate_db(path)
+
+            connection = sqlite3.connect(path)
+            try:
+                columns = {rec[1] for rec in connection.execute('PRAGMA table_info(rates_info_source)')}
+                self.assertLessEqual({'etag', 'last_modified', 'content_hash'}, columns)
+                self.assertEqual(connection.execute('PRAGMA user_version').fetchone()[0], SCHEMA_VERSION)
+                # the current rates are recorded once, as valid since before any moment asked about
+                self.assertEqual(
+                    connection.execute('SELECT * FROM exchange_rates_history').fetchall(),
+                    [(1, 2, HISTORY_BACKFILL_TIME, 90.5, None)]
+                )
+            finally:
+                connection.close()
+
+
+class SharedRatesTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'rates.shm')
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_readerPicksUpPublishedVersions(self):
+        writer, reader = SharedRatesWriter(self.path), SharedRatesReader(self.path)
+        self.assertFalse(reader.is_published)
+        self.assertIsNone(reader.get_rate('AUD', 'RUB'))
+
+        writer.publish(['AUD', 'RUB'], array('d', [1, 58, math.nan, 1]))
+        self.assertEqual(reader.get_rate('AUD', 'RUB'), 58)
+        self.assertIsNone(reader.get_rate('RUB', 'AUD'))
+
+        # the whole matrix doesn't fit into the slots made for the previous one, so the file grows
+        matrix = app.main.get_rate_matrix()
+        writer.publish(matrix.get_codes(), matrix.get_rates())
+        for base, target in (('AUD', 'RUB'), ('RUB', 'AUD'), ('EUR', 'AMD'), ('BTC', 'ZAR')):
+            with self.subTest(base=base, target=target):
+                self.assertEqual(reader.get_rate(base, target), matrix.get_rate(base, target))
+
+        writer.close()
+
+    def test_ownChangesAreResolvedLocallyUntilPublished(self):
+        writer = SharedRatesWriter(self.path)
+        app.main.set_shared_rates(SharedRatesReader(self.path))
+        get_rate = partial(app.get_exchange_rate, CurrencyRate(None, 'RUB', 'AUD', None, None, None),
+                           strategy=app.main.FIND_RATE_BY_MATRIX)
+        try:
+            writer.publish(['AUD', 'RUB'], array('d', [1, 58, 7, 1]))
+            self.assertEqual(get_rate().rate, 7)
+
+            app.update_exchange_rate(CurrencyRate(None, 'AUD', 'RUB', 1, 50, None))
+            app.connection.commit()
+            self.assertEqual(get_rate().rate, 0.02)
+
+            # rates taken from DB after the commit include the change
+            writer.publish(['AUD', 'RUB'], array('d', [1, 50, 7, 1]))
+            self.assertEqual(get_rate().rate, 7)
+        finally:
+            app.main.set_shared_rates(None)
+            app.update_exchange_rate(CurrencyRate(None, 'AUD', 'RUB', 1, 58.0244, None))
+            app.connection.commit()
+            writer.close()
+
+    def test_onlyOnePublisherAtATime(self):
+        publisher, other_publisher = RatesPublisher(self.path, app.pool), RatesPublisher(self.path, app.pool)
+
+        self.assertTrue(publisher.acquire())
+        self.assertFalse(other_publisher.acquire())
+
+        self.assertTrue(publisher.publish_if_modified())
+        self.assertFalse(publisher.publish_if_modified())
+        self.assertEqual(SharedRatesReader(self.path).get_rate('AUD', 'RUB'),
+                         app.main.get_rate_matrix().get_rate('AUD', 'RUB'))
+
+        publisher.stop()
+        self.assertTrue(other_publisher.acquire())
+        other_publisher.stop()
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -2,11 +2,19 @@ import unittest
 import sqlite3
 import datetime
 import configparser
+import io
 
 import app
 from app.data_updates import CurrencyRatesUpdater
-from app.data_objects import Currency
-from app.utils.rates_obtaining_from_cbr_website import obtain_rates
+from app.data_objects import Currency, CurrencyRate
+from app.utils.rates_obtaining_from_cbr_website import (
+    obtain_rates, process_data_from_html_table, process_data_from_html_stream
+)
+from app.utils.rate_calculations import CrossRatesDeriver, complete_building_set_of_rates
+from app.utils.rate_sources import (
+    get_source_adapter, parse_cbr_xml, parse_csv, parse_json, UnknownSourceType, HTML_TABLE, SourceNotModified,
+    SourceValidators, read_source, record_content_hash
+)
 
 mock_db_conn = sqlite3.connect(':memory:')
 cur = mock_db_conn.cursor()
@@ -73,5 +81,176 @@ class CurrencyRatesUpdaterTest(unittest.TestCase):
             datetime.date.today().isoformat()
         )
 
+    def test_UpdateRatesInBulk(self):
+        cur.execute('insert into rates_info_source(src_path, days_valid) VALUES (?, ?)', ('mock_source', 1))
+        source_id = cur.lastrowid
+
+        def fetcher(path):
+            yield CurrencyRate(None, 'USD', 'RUB', 1, 90.5, None)
+            yield CurrencyRate(None, 'RUB', 'USD', 1, 0.011, None)
+
+        bulk_updater = CurrencyRatesUpdater(
+            mock_db_conn, source_id, fetcher, app.update_exchange_rate, db_details, app.main.upsert_exchange_rates)
+
+        bulk_updater.update()
+
+        # only the existing pair is updated
+        self.assertEqual(
+            cur.execute('select base_currency_id, target_currency_id, rate, source_id from exchange_rates').fetchall(),
+            [(1, 2, 90.5, source_id)]
+        )
+
+    def test_UpdateRatesConditionally(self):
+        cur.execute('insert into rates_info_source(src_path, days_valid) VALUES (?, ?)', ('mock_source_2', 1))
+        source_id = cur.lastrowid
+        fetched = []
+
+        def fetcher(path, validators):
+            if validators.etag == 'v1':
+                raise SourceNotModified()
+            validators.etag, validators.content_hash = 'v1', 'hash'
+            fetched.append(path)
+            yield CurrencyRate(None, 'USD', 'RUB', 1, 91.5, None)
+
+        cond_updater = CurrencyRatesUpdater(
+            mock_db_conn, source_id, fetcher, app.update_exchange_rate, db_details, conditional_fetch=True)
+        validators_sql = 'select etag, content_hash, last_appeal from rates_info_source where source_id = ?'
+
+        cond_updater.update()
+        self.assertEqual(
+            cur.execute(validators_sql, (source_id,)).fetchone(), ('v1', 'hash', datetime.date.today().isoformat())
+        )
+
+        cur.execute('update rates_info_source set last_appeal = NULL where source_id = ?', (source_id,))
+        cond_updater.update()
+
+        # nothing is fetched on the second time, but appeal is recorded
+        self.assertEqual(fetched, ['mock_source_2'])
+        self.assertEqual(
+            cur.execute(validators_sql, (source_id,)).fetchone(), ('v1', 'hash', datetime.date.today().isoformat())
+        )
+
+
+class CrossRatesDeriverTest(unittest.TestCase):
+    rates = (
+        CurrencyRate(None, 'USD', 'RUB', 1, 90, None),
+        CurrencyRate(None, 'EUR', 'RUB', 1, 100, None),
+        CurrencyRate(None, 'JPY', 'RUB', 100, 60, None),
+    )
+
+    def test_allCrossRatesAreDerived(self):
+        derived = {(r.base_currency_code, r.target_currency_code): r.rate for r in CrossRatesDeriver(self.rates)}
+
+        self.assertEqual(len(derived), 6)
+        self.assertAlmostEqual(derived[('USD', 'EUR')], 0.9)
+        self.assertAlmostEqual(derived[('EUR', 'USD')], 100 / 90)
+        self.assertAlmostEqual(derived[('JPY', 'USD')], 0.6 / 90)
+
+    def test_ratesWithoutValueAreSkipped(self):
+        rates = self.rates + (CurrencyRate(None, 'GBP', 'RUB', 1, 0, None),
+                              CurrencyRate(None, 'CNY', 'RUB', 1, None, None))
+        derived = {(r.base_currency_code, r.target_currency_code) for r in CrossRatesDeriver(rates)}
+
+        self.assertEqual(len(derived), 6)
+        self.assertNotIn(('USD', 'GBP'), derived)
+
+    def test_sourceRatesAreCompleted(self):
+        rates = list(complete_building_set_of_rates(iter(self.rates)))
+
+        self.assertEqual(rates[:3], list(self.rates))
+        self.assertEqual(len(rates), 9)
+
+
+class CbrPageParsingTest(unittest.TestCase):
+    html = '''
+    <table class="data">
+      <tbody>
+        <tr><th>Цифр. код</th><th>Букв. код</th><th>Единиц</th><th>Валюта</th><th>Курс</th></tr>
+        <tr><td>840</td><td>USD</td><td>1</td><td>Доллар США</td><td>90,5</td></tr>
+        <tr><td>392</td><td>JPY</td><td>100</td><td>Японских иен</td><td>60,25</td></tr>
+      </tbody>
+    </table>
+    '''
+
+    def test_pageIsParsedByChunks(self):
+        chunks = (self.html[i:i + 7] for i in range(0, len(self.html), 7))
+
+        rates = list(process_data_from_html_stream(chunks, derive_cross_rates=False))
+
+        self.assertEqual(
+            [(r.base_currency_code, r.target_currency_code, r.units, r.rate) for r in rates],
+            [('USD', 'RUB', 1, 90.5), ('JPY', 'RUB', 100, 60.25)]
+        )
+        self.assertEqual(rates, list(process_data_from_html_table(self.html, derive_cross_rates=False)))
+
+    def test_onlyRatesTableIsExtracted(self):
+        html = open('fixtures/cbr_daily.html', encoding='utf-8').read()
+        chunks = (html[i:i + 1000] for i in range(0, len(html), 1000))
+
+        rates = list(process_data_from_html_stream(chunks, derive_cross_rates=False))
+
+        self.assertEqual(len(rates), 43)
+        self.assertEqual(
+            (rates[12].base_currency_code, rates[12].units, rates[12].rate), ('USD', 1, 88.7171)
+        )
+        self.assertEqual(rates, list(process_data_from_html_table(html, derive_cross_rates=False)))
+
+
+class RateSourcesTest(unittest.TestCase):
+
+    def test_adapterIsChosenBySourceType(self):
+        self.assertEqual(get_source_adapter('web').data_format, HTML_TABLE)
+        with self.assertRaises(UnknownSourceType):
+            get_source_adapter('carrier_pigeon')
+
+    def test_xmlIsParsed(self):
+        xml = '''<?xml version="1.0" encoding="windows-1251"?>
+        <ValCurs Date="17.10.2024" name="Foreign Currency Market">
+            <Valute ID="R01235"><NumCode>840</NumCode><CharCode>USD</CharCode><Nominal>1</Nominal>
+            <Name>Dollar</Name><Value>88,7171</Value></Valute>
+            <Valute ID="R01820"><NumCode>392</NumCode><CharCode>JPY</CharCode><Nominal>100</Nominal>
+            <Name>Yen</Name><Value>59,5362</Value></Valute>
+        </ValCurs>'''.encode('windows-1251')
+
+        self.assertEqual(
+            [(r.base_currency_code, r.target_currency_code, r.units, r.rate) for r in parse_cbr_xml(io.BytesIO(xml))],
+            [('USD', 'RUB', 1, 88.7171), ('JPY', 'RUB', 100, 59.5362)]
+        )
+
+    def test_jsonIsParsed(self):
+        single_base = {'base': 'USD', 'rates': {'EUR': 0.92}}
+        listed = [{'base': 'USD', 'target': 'EUR', 'rate': 0.92}]
+
+        for data in (single_base, listed):
+            self.assertEqual(list(parse_json(data)), [CurrencyRate(None, 'USD', 'EUR', 1, 0.92, None)])
+
+    def test_csvIsParsed(self):
+        data = io.StringIO('base,target,rate,units\nJPY,RUB,59.5362,100\nUSD,RUB,88.7171,\n')
+
+        self.assertEqual(
+            list(parse_csv(data)),
+            [CurrencyRate(None, 'JPY', 'RUB', 100, 59.5362, None), CurrencyRate(None, 'USD', 'RUB', 1, 88.7171, None)]
+        )
+
+    def test_unchangedContentIsDetectedBeforeItIsParsed(self):
+        content = b'base,target,rate\nUSD,RUB,88.7171\n'
+        validators = SourceValidators()
+
+        reader = read_source(io.BytesIO(content), validators)
+        self.assertEqual(reader.read(), content)
+        record_content_hash(reader, validators)
+
+        # source gives no validators of its own, so the content is compared by hash as soon as it's opened
+        with self.assertRaises(SourceNotModified):
+            read_source(io.BytesIO(content), validators)
+        self.assertEqual(read_source(io.BytesIO(content + b'EUR,RUB,99\n'), validators).read()[-3:], b'99\n')
+
+    def test_sourceIsNotReadPastItsTimeout(self):
+        reader = read_source(io.BytesIO(b'base,target,rate\nUSD,RUB,88.7171\n'), timeout=0)
+
+        with self.assertRaises(TimeoutError):
+            reader.read()
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,63 +1,173 @@
 from html.parser import HTMLParser
+from typing import Iterable
 import re
 
 
 class HtmlTableDataExtractor(HTMLParser):
+    """
+    Extracts text of table cells row by row. Extraction may be restricted to a table of the given
+    CSS class or id, then markup outside of it is skipped.
+    """
 
     useless_data_patterns = [
-        '\\s*'
+        re.compile('\\s*')
     ]
-    for p in useless_data_patterns:
-        re.compile(p)
 
-    def __init__(self, *args, **kwargs):
+    CELL_TAGS = frozenset(('td', 'th'))
+
+    table_start_pattern = re.compile('<table\\b[^>]*>', re.IGNORECASE)
+
+    def __init__(self, *args, keep_tables=True, table_class: str = None, table_id: str = None, **kwargs):
         super().__init__(*args, **kwargs)
         self.table_tag_is_opened = False
         self.extracted_tables = []
+        # if tables aren't kept, rows are only given out by feed_rows
+        self.keep_tables = keep_tables
+        self.table_class = table_class
+        self.table_id = table_id
+        self.current_table = []
+        self.current_row = []
+        # whether text belongs to a cell (it goes right after cell's start tag)
+        self._in_cell = False
+        # count of tables opened inside the extracted one (their rows are extracted too)
+        self._inner_tables = 0
+        self._rows_in_table = 0
+        self._closed_rows = []
+        self._data_pieces = []
+        # text held back while looking for the target table (it may contain beginning of its tag)
+        self._skipped_tail = ''
 
     def feed(self, data: str) -> tuple:
-        super().feed(data)
+        self._feed_chunk(data)
+        self._closed_rows.clear()
         return tuple(self.extracted_tables)
 
+    def _feed_chunk(self, data: str):
+        if self.table_class is not None or self.table_id is not None:
+            data = self._skip_to_target_table(data)
+        if data:
+            super().feed(data)
+
+    def _skip_to_target_table(self, data: str) -> str:
+        # markup outside of the target table isn't even tokenized,
+        # unless parser holds unprocessed text (it has to be processed as a whole then)
+        if self.table_tag_is_opened or self.rawdata:
+            return data
+
+        data = self._skipped_tail + data
+        self._skipped_tail = ''
+        pos = 0
+
+        while match := self.table_start_pattern.search(data, pos):
+            tag_text = match.group()
+            # exact check is made by parser, this one only sorts out tables which can't be the target
+            if ((self.table_class is None or self.table_class in tag_text) and
+                    (self.table_id is None or self.table_id in tag_text)):
+                return data[match.start():]
+            pos = match.end()
+
+        tag_start = data.rfind('<', pos)
+        if tag_start != -1:
+            self._skipped_tail = data[tag_start:]
+
+        return ''
+
+    def feed_rows(self, chunks: Iterable[str]):
+        """
+        Feeds data chunk by chunk, yields (index of row in its table, row) as soon as the row is closed.
+        Index 0 is given to header row (it is empty if table has no header).
+        """
+        for chunk in chunks:
+            self._feed_chunk(chunk)
+            yield from self._closed_rows
+            self._closed_rows.clear()
+
+        super().close()
+        yield from self._closed_rows
+        self._closed_rows.clear()
+
     def close(self) -> None:
         self.extracted_tables = []
+        self._skipped_tail = ''
         super().close()
 
+    def is_target_table(self, attrs) -> bool:
+        if self.table_class is None and self.table_id is None:
+            return True
+
+        attrs = dict(attrs)
+        if self.table_id is not None and attrs.get('id') != self.table_id:
+            return False
+        if self.table_class is not None and self.table_class not in (attrs.get('class') or '').split():
+            return False
+        return True
+
     def handle_starttag(self, tag, attrs):
+        if self._data_pieces:
+            self._flush_data()
 
-        if tag == 'table':
-            self.table_tag_is_opened = True
-            self.current_table = []
+        if not self.table_tag_is_opened:
+            if tag == 'table' and self.is_target_table(attrs):
+                self.table_tag_is_opened = True
+                self.current_table = []
+                self._rows_in_table = 0
+            return
+
+        self._in_cell = tag in self.CELL_TAGS
 
         if tag == 'tr':
             self.current_row = []
 
-        if tag == 'th':
-            pass
+        elif tag == 'td':
+            if self._rows_in_table == 0:
+                self._add_row(())
 
-        if tag == 'td':
-            if len(self.current_table) == 0:
-                self.current_table.append([])
+        elif tag == 'table':
+            self._inner_tables += 1
 
     def is_valid_data(self, data):
-        for is_match in filter(None, (re.fullmatch(p, data) for p in self.useless_data_patterns)):
-            if is_match:
+        for p in self.useless_data_patterns:
+            if p.fullmatch(data):
                 return False
         return True
 
     def handle_data(self, data: str) -> None:
-        if self.get_starttag_text() in ('<td>', '<th>') and self.is_valid_data(data):
+        # text may come in pieces if it is split between fed chunks, so it is collected up to the next tag
+        if self._in_cell:
+            self._data_pieces.append(data)
+
+    def _flush_data(self):
+        data = ''.join(self._data_pieces)
+        self._data_pieces.clear()
+        if self.is_valid_data(data):
             self.current_row.append(data)
 
     def handle_endtag(self, tag: str) -> None:
+        if not self.table_tag_is_opened:
+            return
+
+        if self._data_pieces:
+            self._flush_data()
+        self._in_cell = False
+
         if tag == 'table':
-            self.extracted_tables.append(tuple(self.current_table))
-            self.current_table.clear()
+            if self._inner_tables:
+                self._inner_tables -= 1
+                return
+            if self.keep_tables:
+                self.extracted_tables.append(tuple(self.current_table))
+            self.current_table = []
             self.table_tag_is_opened = False
 
-        if tag == 'tr':
-            self.current_table.append(tuple(self.current_row))
-            self.current_row.clear()
+        elif tag == 'tr':
+            self._add_row(tuple(self.current_row))
+            self.current_row = []
+
+    def _add_row(self, row: tuple):
+        if self.keep_tables:
+            self.current_table.append(row)
+        self._closed_rows.append((self._rows_in_table, row))
+        self._rows_in_table += 1
 
 
 
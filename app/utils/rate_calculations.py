@@ -1,5 +1,4 @@
-from itertools import combinations
-from typing import Sequence
+from typing import Iterable, Sequence
 
 from app.data_objects import CurrencyRate
 
@@ -9,12 +8,50 @@ def calculate_rate_depending_on_base_rates(target1_to_base_rate: float | int, ta
     return target1_to_base_rate/target2_to_base_rate
 
 
+def group_rates_by_target(rates: Iterable[CurrencyRate]) -> dict:
+    """Returns dict of target currency code: {base currency code: reduced rate}"""
+    groups = {}
+    for rate in rates:
+        groups.setdefault(rate.target_currency_code, {})[rate.base_currency_code] = rate.reduced_rate
+    return groups
+
+
+class CrossRatesDeriver:
+    """
+    Derives rates between currencies, which have rates to a common target currency (in both directions).
+    Rates without value (or zero ones) are skipped, as no rate can be derived from them.
+    """
+
+    def __init__(self, rates: Iterable[CurrencyRate]):
+        self._groups = group_rates_by_target(rate for rate in rates if rate.reduced_rate)
+
+    def __iter__(self):
+        derived = set()
+
+        for target, group in self._groups.items():
+            codes, values = tuple(group), tuple(group.values())
+
+            for i, base_code in enumerate(codes):
+                base_value = values[i]
+                for j, target_code in enumerate(codes):
+                    # pair may be derivable through several common targets, but is given once
+                    if i == j or (base_code, target_code) in derived:
+                        continue
+                    # direct rate of the pair is given by the source itself
+                    if base_code in self._groups.get(target_code, ()):
+                        continue
+                    derived.add((base_code, target_code))
+                    yield CurrencyRate(
+                        None, base_code, target_code, 1,
+                        calculate_rate_depending_on_base_rates(base_value, values[j]), None
+                    )
+
+
 def complete_building_set_of_rates(rates: Sequence[CurrencyRate]) -> Sequence[CurrencyRate]:
     # takes set of rates, completes building rates for items, which both have rates to common item
-    yield from rates
-    combos = combinations(rates, 2)
-    for rate1, rate2 in combos:
-        if rate1.target_currency_code == rate2.target_currency_code:
-            new_rate = CurrencyRate(None, rate1.base_currency_code, rate2.base_currency_code, 1,
-                                    calculate_rate_depending_on_base_rates(rate1.reduced_rate, rate2.reduced_rate), None)
-            yield new_rate
+    # rates are given out as they come, cross rates can only be derived when all of them are there
+    collected = []
+    for rate in rates:
+        collected.append(rate)
+        yield rate
+    yield from CrossRatesDeriver(collected)
@@ -0,0 +1,204 @@
+"""
+Adapters of rates sources. Adapter knows how to obtain rates from a source of certain type (src_type field of
+rates info source table) and declares data format of the source.
+Each adapter's fetcher takes path to the source, timeout of appeal to it (given both to connect and to read the data)
+and validators of the data fetched last time, yields CurrencyRate objects. If the data hasn't changed since then,
+fetcher raises SourceNotModified before it yields anything.
+"""
+import csv
+import hashlib
+import io
+import json
+import time
+import xml.etree.ElementTree as ElementTree
+from collections import namedtuple
+from dataclasses import dataclass
+from http import HTTPStatus
+from typing import Callable
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from app.data_objects import CurrencyRate
+from app.utils import rates_obtaining_from_cbr_website as cbr
+from app.utils.rate_calculations import complete_building_set_of_rates
+
+HTML_TABLE = 'html_table'
+JSON = 'json'
+CSV = 'csv'
+XML = 'xml'
+
+DEFAULT_TIMEOUT = 30
+
+SourceAdapter = namedtuple('SourceAdapter', 'src_type data_format fetch')
+
+SOURCE_ADAPTERS = {}
+
+
+class UnknownSourceType(LookupError):
+    pass
+
+
+class SourceNotModified(Exception):
+    pass
+
+
+@dataclass
+class SourceValidators:
+    """Validators of the data fetched from a source (they're updated by fetcher on each appeal)"""
+    etag: str | None = None
+    last_modified: str | None = None
+    content_hash: str | None = None
+
+
+class HashingReader(io.RawIOBase):
+    """
+    Wraps response, computes hash of the content as it is being read. Timeout of the socket bounds every read
+    rather than the whole of them, so reading past the deadline (if it's given) raises TimeoutError.
+    """
+
+    def __init__(self, stream, deadline: float = None):
+        super().__init__()
+        self._stream = stream
+        self._hash = hashlib.sha256()
+        self._deadline = deadline
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self._deadline is not None and time.monotonic() > self._deadline:
+            raise TimeoutError('Source is read for longer than its timeout')
+        data = self._stream.read(len(buffer))
+        self._hash.update(data)
+        buffer[:len(data)] = data
+        return len(data)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+def open_source(url: str, timeout=DEFAULT_TIMEOUT, validators: SourceValidators = None):
+    """Makes request to the source, conditional one if validators are given"""
+    headers = {}
+    if validators and validators.etag:
+        headers['If-None-Match'] = validators.etag
+    if validators and validators.last_modified:
+        headers['If-Modified-Since'] = validators.last_modified
+
+    try:
+        response = urlopen(Request(url, headers=headers), timeout=timeout)
+    except HTTPError as e:
+        if e.code == HTTPStatus.NOT_MODIFIED:
+            raise SourceNotModified() from None
+        raise
+
+    if validators:
+        validators.etag = response.headers.get('ETag')
+        validators.last_modified = response.headers.get('Last-Modified')
+
+    return response
+
+
+def read_source(response, validators: SourceValidators = None, timeout=DEFAULT_TIMEOUT) -> HashingReader:
+    """
+    Returns reader of the content, which hashes it as it is being read and has to read it within timeout.
+    If the source doesn't give validators of its own, the hash of the content is the only way to tell that
+    it hasn't changed: then the content is read at once, and SourceNotModified is raised before any rate is
+    given out.
+    """
+    reader = HashingReader(response, time.monotonic() + timeout)
+
+    if validators is not None and not (validators.etag or validators.last_modified):
+        content = reader.read()
+        if reader.hexdigest() == validators.content_hash:
+            raise SourceNotModified()
+        reader = HashingReader(io.BytesIO(content))
+
+    return reader
+
+
+def record_content_hash(reader: HashingReader, validators: SourceValidators = None):
+    """To be called when the content is read completely"""
+    if validators is not None:
+        validators.content_hash = reader.hexdigest()
+
+
+def register_source_adapter(src_type: str, data_format: str):
+    """Registers decorated fetcher as adapter of sources of the given type"""
+    def decorator(fetch: Callable):
+        SOURCE_ADAPTERS[src_type] = SourceAdapter(src_type, data_format, fetch)
+        return fetch
+    return decorator
+
+
+def get_source_adapter(src_type: str) -> SourceAdapter:
+    try:
+        return SOURCE_ADAPTERS[src_type]
+    except KeyError:
+        raise UnknownSourceType(f'No adapter for sources of type {src_type!r}') from None
+
+
+@register_source_adapter('web', HTML_TABLE)
+def fetch_cbr_html(url: str, timeout=DEFAULT_TIMEOUT, validators: SourceValidators = None):
+    # page of daily rates at cbr.ru
+    with open_source(url, timeout, validators) as response:
+        reader = read_source(response, validators, timeout)
+        chunks = cbr.read_decoded_chunks(reader, response.headers.get_content_charset() or 'utf-8')
+        yield from cbr.process_data_from_html_stream(chunks)
+        record_content_hash(reader, validators)
+
+
+@register_source_adapter('cbr_xml', XML)
+def fetch_cbr_xml(url: str, timeout=DEFAULT_TIMEOUT, validators: SourceValidators = None):
+    # XML daily rates of cbr.ru (XML_daily.asp), all of them are given to ruble
+    with open_source(url, timeout, validators) as response:
+        reader = read_source(response, validators, timeout)
+        yield from complete_building_set_of_rates(parse_cbr_xml(reader))
+        record_content_hash(reader, validators)
+
+
+def parse_cbr_xml(stream):
+    for _, elem in ElementTree.iterparse(stream):
+        if elem.tag == 'Valute':
+            yield CurrencyRate(
+                None, elem.findtext('CharCode'), cbr.COMMON_TARGET_CURRENCY_CODE, int(elem.findtext('Nominal')),
+                float(elem.findtext('Value').replace(',', '.')), None
+            )
+            elem.clear()
+
+
+@register_source_adapter('json', JSON)
+def fetch_json(url: str, timeout=DEFAULT_TIMEOUT, validators: SourceValidators = None):
+    with open_source(url, timeout, validators) as response:
+        reader = read_source(response, validators, timeout)
+        data = json.load(reader)
+        record_content_hash(reader, validators)
+        yield from parse_json(data)
+
+
+def parse_json(data):
+    """
+    Accepts either rates of a single base ({"base": "USD", "rates": {"EUR": 0.92, ...}})
+    or list of rates ([{"base": "USD", "target": "EUR", "rate": 0.92, "units": 1}, ...])
+    """
+    if isinstance(data, dict):
+        for target, rate in data['rates'].items():
+            yield CurrencyRate(None, data['base'], target, 1, float(rate), None)
+    else:
+        for rec in data:
+            yield CurrencyRate(None, rec['base'], rec['target'], int(rec.get('units', 1)), float(rec['rate']), None)
+
+
+@register_source_adapter('csv', CSV)
+def fetch_csv(url: str, timeout=DEFAULT_TIMEOUT, validators: SourceValidators = None):
+    with open_source(url, timeout, validators) as response:
+        reader = read_source(response, validators, timeout)
+        charset = response.headers.get_content_charset() or 'utf-8'
+        yield from parse_csv(io.TextIOWrapper(io.BufferedReader(reader), encoding=charset, newline=''))
+        record_content_hash(reader, validators)
+
+
+def parse_csv(stream):
+    # first line is header: base,target,rate[,units]
+    for rec in csv.DictReader(stream):
+        yield CurrencyRate(None, rec['base'], rec['target'], int(rec.get('units') or 1), float(rec['rate']), None)
@@ -1,3 +1,5 @@
+import codecs
+from typing import Iterable
 from urllib.request import urlopen
 
 from app.utils.html_table_parser import HtmlTableDataExtractor
@@ -6,17 +8,35 @@ from app.data_objects import CurrencyRate
 
 
 COMMON_TARGET_CURRENCY_CODE = 'RUB'
+# CSS class of the table with rates at the source page
+RATES_TABLE_CLASS = 'data'
 RATE_PRECISION = 4
 
+# size of chunks in which source page is read and fed to parser
+READ_CHUNK_SIZE = 16 * 1024
 
-def obtain_rates(url: str, prepare_func=None):
 
-    html = urlopen(url).read().decode('utf-8')
+def obtain_rates(url: str, prepare_func=None, *, derive_cross_rates=True, timeout=None):
+    """
+    Yields rates of the source. If derive_cross_rates is False, only rates given by the source are yielded
+    """
+
+    # page is parsed as it is being downloaded, rates are given out as soon as their rows are read
+    with urlopen(url, timeout=timeout) as response:
+        chunks = read_decoded_chunks(response, response.headers.get_content_charset() or 'utf-8')
+        rates = process_data_from_html_stream(chunks, derive_cross_rates=derive_cross_rates)
+
+        data = (prepare_func(rate) for rate in rates) if prepare_func else rates
 
-    data = (prepare_func(rate) for rate in process_data_from_html_table(html)) \
-        if prepare_func else process_data_from_html_table(html)
+        yield from data
 
-    yield from data
+
+def read_decoded_chunks(stream, encoding='utf-8', chunk_size=READ_CHUNK_SIZE):
+    # multibyte characters may be split between chunks, hence incremental decoding
+    decoder = codecs.getincrementaldecoder(encoding)()
+    while chunk := stream.read(chunk_size):
+        yield decoder.decode(chunk)
+    yield decoder.decode(b'', final=True)
 
 
 def prepare_for_insertion_into_db(data_obj: CurrencyRate):
@@ -27,19 +47,25 @@ def prepare_for_insertion_into_db(data_obj: CurrencyRate):
             round(data_obj.rate, RATE_PRECISION))
 
 
-def process_data_from_html_table(html):
+def process_data_from_html_table(html, *, derive_cross_rates=True):
+
+    yield from process_data_from_html_stream((html,), derive_cross_rates=derive_cross_rates)
+
 
-    parser = HtmlTableDataExtractor()
+def process_data_from_html_stream(chunks: Iterable[str], *, derive_cross_rates=True):
 
-    data = parser.feed(html)
-    rates = []
+    parser = HtmlTableDataExtractor(keep_tables=False, table_class=RATES_TABLE_CLASS)
 
-    for table in data:
-        for record in table[1:]:  # TODO: do headers row recognition
-            data_obj = make_data_object(record)
-            rates.append(data_obj)
+    rates = (
+        make_data_object(record)
+        for row_index, record in parser.feed_rows(chunks)
+        if row_index > 0  # TODO: do headers row recognition
+    )
 
-    yield from complete_building_set_of_rates(rates)
+    if derive_cross_rates:
+        yield from complete_building_set_of_rates(rates)
+    else:
+        yield from rates
 
 
 def make_data_object(data: tuple):
@@ -0,0 +1,87 @@
+"""
+Micro-benchmark of HtmlTableDataExtractor on the saved page of cbr.ru daily rates.
+Run from project root: python -m misc.html_parser_benchmark
+"""
+import os.path
+import re
+import timeit
+from html.parser import HTMLParser
+
+from app.utils.html_table_parser import HtmlTableDataExtractor
+
+FIXTURE_PATH = os.path.join(os.path.dirname(__file__), '..', 'app', 'tests', 'fixtures', 'cbr_daily.html')
+
+REPEAT = 5
+NUMBER = 50
+
+
+class LegacyHtmlTableDataExtractor(HTMLParser):
+    # previous implementation of the extractor, kept as reference point
+
+    useless_data_patterns = [
+        '\\s*'
+    ]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.table_tag_is_opened = False
+        self.extracted_tables = []
+
+    def feed(self, data: str) -> tuple:
+        super().feed(data)
+        return tuple(self.extracted_tables)
+
+    def handle_starttag(self, tag, attrs):
+
+        if tag == 'table':
+            self.table_tag_is_opened = True
+            self.current_table = []
+
+        if tag == 'tr':
+            self.current_row = []
+
+        if tag == 'td':
+            if len(self.current_table) == 0:
+                self.current_table.append([])
+
+    def is_valid_data(self, data):
+        for is_match in filter(None, (re.fullmatch(p, data) for p in self.useless_data_patterns)):
+            if is_match:
+                return False
+        return True
+
+    def handle_data(self, data: str) -> None:
+        if self.get_starttag_text() in ('<td>', '<th>') and self.is_valid_data(data):
+            self.current_row.append(data)
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag == 'table':
+            self.extracted_tables.append(tuple(self.current_table))
+            self.current_table.clear()
+            self.table_tag_is_opened = False
+
+        if tag == 'tr':
+            self.current_table.append(tuple(self.current_row))
+            self.current_row.clear()
+
+
+def measure(make_parser, html):
+    best = min(timeit.repeat(lambda: make_parser().feed(html), repeat=REPEAT, number=NUMBER))
+    return best / NUMBER
+
+
+if __name__ == '__main__':
+    with open(FIXTURE_PATH, encoding='utf-8') as f:
+        html = f.read()
+
+    cases = (
+        ('legacy extractor', LegacyHtmlTableDataExtractor),
+        ('extractor, all tables', HtmlTableDataExtractor),
+        ('extractor, table.data only', lambda: HtmlTableDataExtractor(table_class='data')),
+    )
+
+    baseline = None
+    for name, make_parser in cases:
+        took = measure(make_parser, html)
+        baseline = baseline or took
+        print(f'{name:<30}{took * 1000:8.3f} ms/page{baseline / took:8.2f}x')
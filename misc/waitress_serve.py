@@ -5,4 +5,4 @@ from web.wsgi_application import application
 application.set_logging_level('DEBUG')
 
 if __name__ == '__main__':
-    serve(application, host='localhost', port=8000, expose_tracebacks=True, threads=1)
+    serve(application, host='localhost', port=8000, expose_tracebacks=True, threads=8)
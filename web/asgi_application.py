@@ -0,0 +1,24 @@
+"""
+ASGI entry point of the application, e.g. `uvicorn web.asgi_application:application`.
+Routes are the same as of the WSGI one, which serves the requests on the pool of threads.
+"""
+import web.wsgi_application as wsgi_application
+from web.wsgi_app_bases.asgi_adapter import ASGIAdapter
+
+# most of requests that are processed at the same time, the rest wait for their turn in the event loop
+MAX_WORKERS = 32
+
+
+def start_rates_refresher():
+    if wsgi_application.REFRESH_RATES_IN_BACKGROUND:
+        wsgi_application.core_application.start_rates_refresher()
+
+
+def stop_rates_refresher():
+    wsgi_application.core_application.stop_rates_refresher()
+
+
+application = ASGIAdapter(
+    wsgi_application.application, max_workers=MAX_WORKERS,
+    on_startup=start_rates_refresher, on_shutdown=stop_rates_refresher
+)
@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from typing import Iterable
 
 from app.data_objects import Currency
 
@@ -18,3 +19,11 @@ class ConvertedExchangeRate:
     rate: float | int
     amount: float | int
     convertedAmount: float | int
+
+
+@dataclass
+class ExchangeRateHistory:
+    baseCurrency: Currency
+    targetCurrency: Currency
+    # (valid from, rate) pairs, given out lazily
+    points: Iterable[tuple]
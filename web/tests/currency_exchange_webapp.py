@@ -2,17 +2,27 @@ import unittest
 import os
 import sys
 import json
+import sqlite3
+import asyncio
+import datetime
+import http.client
+import threading
 import wsgiref
 import wsgiref.util
 from http import HTTPStatus
 from io import BytesIO
+from unittest import mock
 from urllib.parse import quote, urlencode
 
 import app as coreapp
 from app.data_objects import Currency, CurrencyRate
 from web.data_objects import ExchangeRate
 from web.tests.mock_wsgi_gateway import MockServerGateway
+import web.wsgi_application
 from web.wsgi_application import application
+from web.updaters import RatesRefresher
+from web.asgi_application import application as asgi_application
+from web.wsgiserver import WSGIServer
 from web.views import (
     json_currency, json_currencies, json_exchange_rate,
     json_exchange_rates, json_converted_rate, http_status_enum_to_string
@@ -30,6 +40,9 @@ coreapp.connect_db('test.db')
 
 coreapp.COMMIT_IF_SUCCESS = False
 
+# rates sources mustn't be appealed to during tests
+web.wsgi_application.REFRESH_RATES_IN_BACKGROUND = False
+
 
 class BaseAppTest(unittest.TestCase):
     _gw = gw
@@ -56,6 +69,21 @@ class CurrenciesEndPoint(BaseAppTest):
 
         self.assertEqual(gw.result_data[0].decode(), correct)
 
+    def test_getCurrenciesIsServedFreshAfterModification(self):
+        gw = self._gw
+        env = gw.env
+        env['PATH_INFO'] = '/currencies'
+
+        for _ in range(2):
+            gw.run(application)
+            self.assertEqual(gw.result_data[0].decode(), json_currencies(coreapp.get_all_currencies()))
+            gw.clean_attrs()
+
+        coreapp.add_currency(Currency(None, 'XXX', 'some_curr', '$#'))
+
+        gw.run(application)
+        self.assertIn('"XXX"', gw.result_data[0].decode())
+
     def test_postCurrenciesRequestSuccessful(self):
         gw = self._gw
         env = gw.env
@@ -110,6 +138,17 @@ class CurrencyEndPoint(BaseAppTest):
             gw.result_data[0].decode()
         )
 
+    def test_getCurrencyAtMixedCasePath(self):
+        gw = self._gw
+        gw.env['PATH_INFO'] = '/Currency/rub'
+
+        gw.run(application)
+
+        self.assertEqual(gw.response_status, http_status_enum_to_string(HTTPStatus.OK))
+        self.assertEqual(
+            gw.result_data[0].decode(), json_currency(coreapp.get_currency(Currency(None, 'RUB', None, None)))
+        )
+
     def test_getCurrencyRespondsWErrorNotFound(self):
         gw = self._gw
         env = gw.env
@@ -161,6 +200,142 @@ class ExchangeRatesEndPoint(BaseAppTest):
             correct, gw.result_data[0].decode()
         )
 
+    def test_getExchangeRatesRespondsWNotModified(self):
+        gw = self._gw
+        env = gw.env
+
+        env['PATH_INFO'] = '/exchangeRates'
+        env['REQUEST_METHOD'] = 'GET'
+
+        gw.run(application)
+        etag = dict(gw.response_headers)['ETag']
+        gw.clean_attrs()
+
+        env['HTTP_IF_NONE_MATCH'] = etag
+        gw.run(application)
+
+        self.assertEqual(gw.response_status, http_status_enum_to_string(HTTPStatus.NOT_MODIFIED))
+        self.assertEqual(gw.result_data, [b''])
+        self.assertEqual(dict(gw.response_headers)['ETag'], etag)
+
+    # commits of other connections are seen at once, not in a moment
+    @mock.patch.object(coreapp.pool, 'data_version_check_interval', 0)
+    def test_rateCommittedByAnotherProcessIsSeen(self):
+        gw = self._gw
+        env = gw.env
+
+        env['PATH_INFO'] = '/exchangeRates'
+        env['REQUEST_METHOD'] = 'GET'
+
+        gw.run(application)
+        self.assertNotIn('12345.0', gw.result_data[0].decode())
+        gw.clean_attrs()
+
+        other = sqlite3.connect('test.db')
+        rate = other.execute('SELECT rate FROM exchange_rates WHERE exchange_rate_id = 1').fetchone()[0]
+        try:
+            with other:
+                other.execute('UPDATE exchange_rates SET rate = 12345 WHERE exchange_rate_id = 1')
+
+            gw.run(application)
+
+            self.assertIn('12345.0', gw.result_data[0].decode())
+        finally:
+            with other:
+                other.execute('UPDATE exchange_rates SET rate = ? WHERE exchange_rate_id = 1', (rate,))
+            other.close()
+
+    # commits of other connections are seen at once, not in a moment
+    @mock.patch.object(coreapp.pool, 'data_version_check_interval', 0)
+    def test_rateCommittedByAnotherProcessChangesValidators(self):
+        gw = self._gw
+        env = gw.env
+
+        env['PATH_INFO'] = '/exchangeRates'
+        env['REQUEST_METHOD'] = 'GET'
+
+        gw.run(application)
+        etag = dict(gw.response_headers)['ETag']
+        gw.clean_attrs()
+
+        other = sqlite3.connect('test.db')
+        rate = other.execute('SELECT rate FROM exchange_rates WHERE exchange_rate_id = 1').fetchone()[0]
+        try:
+            with other:
+                other.execute('UPDATE exchange_rates SET rate = 12345 WHERE exchange_rate_id = 1')
+
+            env['HTTP_IF_NONE_MATCH'] = etag
+            gw.run(application)
+
+            self.assertEqual(gw.response_status, http_status_enum_to_string(HTTPStatus.OK))
+            self.assertNotEqual(dict(gw.response_headers)['ETag'], etag)
+        finally:
+            with other:
+                other.execute('UPDATE exchange_rates SET rate = ? WHERE exchange_rate_id = 1', (rate,))
+            other.close()
+
+    def test_getExchangeRatesIfModifiedSinceDateOfUnknownZone(self):
+        gw = self._gw
+        env = gw.env
+
+        env['PATH_INFO'] = '/exchangeRates'
+        env['REQUEST_METHOD'] = 'GET'
+        env['HTTP_IF_MODIFIED_SINCE'] = 'Sun, 01 Jan 2090 00:00:00 -0000'
+
+        gw.run(application)
+
+        self.assertEqual(gw.response_status, http_status_enum_to_string(HTTPStatus.NOT_MODIFIED))
+
+    def test_appealToSourcesChangesValidators(self):
+        gw = self._gw
+        env = gw.env
+
+        env['PATH_INFO'] = '/exchangeRates'
+        env['REQUEST_METHOD'] = 'GET'
+
+        gw.run(application)
+        etag = dict(gw.response_headers)['ETag']
+        gw.clean_attrs()
+
+        appeals = coreapp.connection.execute('SELECT last_appeal, source_id FROM rates_info_source').fetchall()
+        try:
+            coreapp.connection.execute('UPDATE rates_info_source SET last_appeal = ?',
+                                       (datetime.date.today() + datetime.timedelta(days=1),))
+            coreapp.connection.commit()
+
+            env['HTTP_IF_NONE_MATCH'] = etag
+            gw.run(application)
+
+            self.assertEqual(gw.response_status, http_status_enum_to_string(HTTPStatus.OK))
+            self.assertNotEqual(dict(gw.response_headers)['ETag'], etag)
+        finally:
+            coreapp.connection.executemany('UPDATE rates_info_source SET last_appeal = ? WHERE source_id = ?', appeals)
+            coreapp.connection.commit()
+
+    def test_getExchangeRatesAsNdjson(self):
+        gw = self._gw
+        env = gw.env
+
+        env['PATH_INFO'] = '/exchangeRates'
+        env['REQUEST_METHOD'] = 'GET'
+        env['HTTP_ACCEPT'] = 'application/x-ndjson, application/json;q=0.5'
+
+        gw.run(application)
+
+        # every row is given out as a separate piece
+        self.assertEqual(len(gw.result_data), len(coreapp.get_all_exchange_rates()))
+        self.assertEqual(dict(gw.response_headers)['Content-type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in b''.join(gw.result_data).decode().splitlines()]
+        gw.clean_attrs()
+
+        env = gw.env = mock_env.copy()
+        env['PATH_INFO'] = '/exchangeRates'
+        env['REQUEST_METHOD'] = 'GET'
+        env['HTTP_ACCEPT'] = 'application/json, application/x-ndjson;q=0.5'
+        gw.run(application)
+        self.assertEqual(dict(gw.response_headers)['Content-type'], 'application/json')
+        self.assertEqual(json.loads(b''.join(gw.result_data)), rows)
+
     def test_postExchangeRatesSuccessfull(self):
         gw = self._gw
         env = gw.env
@@ -223,6 +398,52 @@ class ExchangeRateEndPoint(BaseAppTest):
         gw.run(application)
         self.assertEqual(correct, gw.result_data[0].decode())
 
+    def test_getExchangeRateHistory(self):
+        gw = self._gw
+        env = gw.env
+        today = datetime.date.today().isoformat()
+
+        coreapp.update_exchange_rate(CurrencyRate(None, 'USD', 'RUB', 1, 90.5, None))
+
+        env['PATH_INFO'] = '/exchangeRate/USDRUB/history'
+        env['QUERY_STRING'] = f'from={today}&to={today}'
+        env['REQUEST_METHOD'] = 'GET'
+        gw.run(application)
+
+        history = json.loads(b''.join(gw.result_data))
+        self.assertEqual(history['baseCurrency']['code'], 'USD')
+        self.assertEqual([point['rate'] for point in history['points']], [90.5])
+
+        gw.clean_attrs()
+        env['QUERY_STRING'] = 'from=yesterday'
+        gw.run(application)
+        self.assertEqual(gw.response_status, http_status_enum_to_string(HTTPStatus.BAD_REQUEST))
+
+    def test_exchangeAsOfDate(self):
+        gw = self._gw
+        env = gw.env
+        today = datetime.date.today()
+        stored = coreapp.get_exchange_rate(CurrencyRate(None, 'USD', 'RUB', None, None, None)).rate
+
+        coreapp.update_exchange_rate(CurrencyRate(None, 'USD', 'RUB', 1, 90.5, None))
+
+        env['PATH_INFO'] = '/exchange'
+        env['REQUEST_METHOD'] = 'GET'
+        env['QUERY_STRING'] = f'from=USD&to=RUB&amount=2&date={today.isoformat()}'
+        gw.run(application)
+        self.assertEqual(json.loads(b''.join(gw.result_data))['convertedAmount'], 181)
+
+        gw.clean_attrs()
+        env['QUERY_STRING'] = f'from=USD&to=RUB&amount=2&date={(today - datetime.timedelta(days=1)).isoformat()}'
+        gw.run(application)
+        # the rate stored before history was introduced
+        self.assertEqual(json.loads(b''.join(gw.result_data))['convertedAmount'], round(stored * 2, 2))
+
+        gw.clean_attrs()
+        env['QUERY_STRING'] = 'from=USD&to=RUB&amount=2&date=today'
+        gw.run(application)
+        self.assertEqual(gw.response_status, http_status_enum_to_string(HTTPStatus.BAD_REQUEST))
+
     def test_getOrPostExchangeRateRespondsWBadRequest(self):
         gw = self._gw
         env = gw.env
@@ -342,3 +563,309 @@ class ExchangeEndPoint(BaseAppTest):
 
         gw.run(application)
         self.assertEqual(http_status_enum_to_string(HTTPStatus.BAD_REQUEST), gw.response_status)
+
+    def test_postExchangeBatch(self):
+        gw = self._gw
+        env = gw.env
+        items = [{'from': 'USD', 'to': 'RUB', 'amount': 10.5}, {'from': 'AUD', 'to': 'RUB', 'amount': 2},
+                 {'from': 'usd', 'to': 'rub', 'amount': '1'}]
+
+        correct = [
+            round(coreapp.get_exchange_rate(CurrencyRate(None, 'USD', 'RUB', None, None, None)).reduced_rate * 10.5, 2),
+            round(coreapp.get_exchange_rate(CurrencyRate(None, 'AUD', 'RUB', None, None, None)).reduced_rate * 2, 2),
+            round(coreapp.get_exchange_rate(CurrencyRate(None, 'USD', 'RUB', None, None, None)).reduced_rate, 2),
+        ]
+
+        env['PATH_INFO'] = '/exchange/batch'
+        env['REQUEST_METHOD'] = 'POST'
+
+        for content_type, body in (('application/json', json.dumps(items)),
+                                   ('application/x-ndjson', '\n'.join(json.dumps(itm) for itm in items))):
+            with self.subTest(CONTENT_TYPE=content_type):
+                env['CONTENT_TYPE'] = content_type
+                env['wsgi.input'] = BytesIO(body.encode())
+                gw.run(application)
+
+                converted = json.loads(b''.join(gw.result_data))
+                self.assertEqual([itm['convertedAmount'] for itm in converted], correct)
+                gw.clean_attrs()
+
+        for content_type, body, status in (
+                ('application/json', json.dumps([{'from': 'USD', 'to': 'XXX', 'amount': 1}]), HTTPStatus.NOT_FOUND),
+                ('application/json', json.dumps([{'from': 'USD', 'to': 'RUB'}]), HTTPStatus.BAD_REQUEST),
+                ('application/json', '[{', HTTPStatus.BAD_REQUEST),
+                ('text/plain', json.dumps(items), HTTPStatus.UNSUPPORTED_MEDIA_TYPE),
+        ):
+            with self.subTest(CONTENT_TYPE=content_type, body=body):
+                env['CONTENT_TYPE'] = content_type
+                env['wsgi.input'] = BytesIO(body.encode())
+                gw.run(application)
+                self.assertEqual(gw.response_status, http_status_enum_to_string(status))
+                gw.clean_attrs()
+
+    def test_postExchangeBatchReadsNoMoreThanContentLength(self):
+        gw = self._gw
+        env = gw.env
+        body = json.dumps([{'from': 'USD', 'to': 'RUB', 'amount': 1}]).encode()
+
+        env['PATH_INFO'] = '/exchange/batch'
+        env['REQUEST_METHOD'] = 'POST'
+        env['CONTENT_TYPE'] = 'application/json'
+        env['CONTENT_LENGTH'] = str(len(body))
+        env['wsgi.input'] = BytesIO(body + b'GET / HTTP/1.1')
+
+        gw.run(application)
+
+        self.assertEqual(gw.response_status, http_status_enum_to_string(HTTPStatus.OK))
+        self.assertEqual(env['wsgi.input'].read(), b'GET / HTTP/1.1')
+
+    def test_postExchangeBatchRespondsWTooLargeOnBigBody(self):
+        gw = self._gw
+        env = gw.env
+        body = json.dumps([{'from': 'USD', 'to': 'RUB', 'amount': 1}] * 10).encode()
+
+        env['PATH_INFO'] = '/exchange/batch'
+        env['REQUEST_METHOD'] = 'POST'
+        env['CONTENT_TYPE'] = 'application/json'
+
+        with mock.patch.object(web.wsgi_application, 'BATCH_BODY_LIMIT', len(body) - 1):
+            for content_length in (str(len(body)), ''):
+                with self.subTest(CONTENT_LENGTH=content_length):
+                    env['CONTENT_LENGTH'] = content_length
+                    env['wsgi.input'] = BytesIO(body)
+                    gw.run(application)
+                    self.assertEqual(gw.response_status,
+                                     http_status_enum_to_string(HTTPStatus.REQUEST_ENTITY_TOO_LARGE))
+                    gw.clean_attrs()
+
+
+class ASGIEntryPointTest(unittest.TestCase):
+
+    @staticmethod
+    def run_asgi(scope, body_pieces=(b'',)):
+        messages = [{'type': 'http.request', 'body': piece, 'more_body': i < len(body_pieces) - 1}
+                    for i, piece in enumerate(body_pieces)]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': 'http', 'method': 'GET', 'path': '/', 'query_string': b'', 'headers': [], **scope}
+        asyncio.run(asgi_application(scope, receive, send))
+
+        return sent[0], b''.join(message['body'] for message in sent[1:])
+
+    def test_getCurrencies(self):
+        start, body = self.run_asgi({'path': '/currencies'})
+
+        self.assertEqual(start['status'], 200)
+        self.assertIn((b'content-type', b'application/json'), start['headers'])
+        self.assertEqual(body.decode(), json_currencies(coreapp.get_all_currencies()))
+
+    def test_postExchangeBatchInPieces(self):
+        body = json.dumps([{'from': 'USD', 'to': 'RUB', 'amount': 2}]).encode()
+        rate = coreapp.get_exchange_rate(CurrencyRate(None, 'USD', 'RUB', None, None, None)).reduced_rate
+
+        start, body = self.run_asgi(
+            {'method': 'POST', 'path': '/exchange/batch', 'headers': [(b'content-type', b'application/json')]},
+            [body[:10], body[10:]]
+        )
+
+        self.assertEqual(start['status'], 200)
+        self.assertEqual(json.loads(body)[0]['convertedAmount'], round(rate * 2, 2))
+
+    def test_lifespan(self):
+        messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message['type'])
+
+        # the refresher is a mock, so that sources aren't appealed to
+        with mock.patch.object(web.wsgi_application, 'REFRESH_RATES_IN_BACKGROUND', True), \
+                mock.patch.object(web.wsgi_application, 'RatesRefresher') as refresher_cls:
+            asyncio.run(asgi_application({'type': 'lifespan'}, receive, send))
+
+        self.assertEqual(sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+        refresher_cls.return_value.start.assert_called_once()
+        refresher_cls.return_value.stop.assert_called_once()
+        self.assertIsNone(web.wsgi_application.RATES_REFRESHER)
+
+
+class WSGIServerTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.server = WSGIServer(('localhost', 0), application, workers=2)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.conn = http.client.HTTPConnection('localhost', self.server.server_port, timeout=5)
+
+    def tearDown(self) -> None:
+        self.conn.close()
+        self.server.shutdown_gracefully(timeout=5)
+
+    def test_requestsAreServedOnKeptAliveConnection(self):
+        body = json.dumps([{'from': 'USD', 'to': 'RUB', 'amount': 2}])
+
+        self.conn.request('GET', '/currencies')
+        resp = self.conn.getresponse()
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(resp.read().decode(), json_currencies(coreapp.get_all_currencies()))
+
+        self.conn.request('POST', '/exchange/batch', body, {'Content-Type': 'application/json'})
+        resp = self.conn.getresponse()
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(len(json.loads(resp.read())), 1)
+
+        # body of the response of unknown length is sent in chunks
+        self.conn.request('GET', '/exchangeRates', headers={'Accept': 'application/x-ndjson'})
+        resp = self.conn.getresponse()
+        self.assertEqual(resp.getheader('Transfer-Encoding'), 'chunked')
+        self.assertEqual(len(resp.read().splitlines()), len(coreapp.get_all_exchange_rates_expanded()))
+
+        self.conn.request('GET', '/currency/XXX')
+        resp = self.conn.getresponse()
+        self.assertEqual(resp.status, 404)
+        resp.read()
+        self.assertFalse(resp.will_close)
+
+    def test_chunkedRequestBodyIsDecoded(self):
+        body = json.dumps([{'from': 'USD', 'to': 'RUB', 'amount': 2}, {'from': 'EUR', 'to': 'RUB', 'amount': 3}])
+        chunks = (body[i:i + 10].encode() for i in range(0, len(body), 10))
+
+        self.conn.request('POST', '/exchange/batch', chunks, {'Content-Type': 'application/json'})
+        resp = self.conn.getresponse()
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(len(json.loads(resp.read())), 2)
+
+        # the body isn't taken for the next request
+        self.conn.request('GET', '/currencies')
+        resp = self.conn.getresponse()
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(resp.read().decode(), json_currencies(coreapp.get_all_currencies()))
+
+    def test_unsupportedTransferCodingClosesConnection(self):
+        self.conn.request('POST', '/exchange/batch', b'[]', {'Transfer-Encoding': 'gzip', 'Content-Length': '2'})
+        resp = self.conn.getresponse()
+        resp.read()
+        self.assertEqual(resp.status, 501)
+        self.assertTrue(resp.will_close)
+
+    def test_idleConnectionsDontHoldWorkers(self):
+        idle_conns = [http.client.HTTPConnection('localhost', self.server.server_port, timeout=5) for _ in range(3)]
+        try:
+            for conn in idle_conns:
+                conn.request('GET', '/currencies')
+                conn.getresponse().read()
+
+            self.conn.request('GET', '/currencies')
+            self.assertEqual(self.conn.getresponse().status, 200)
+
+            # idle connections are still kept alive
+            idle_conns[0].request('GET', '/currencies')
+            self.assertEqual(idle_conns[0].getresponse().status, 200)
+        finally:
+            for conn in idle_conns:
+                conn.close()
+
+    def test_idleConnectionIsClosedAfterKeepAliveTimeout(self):
+        self.server.keep_alive_timeout = 0.2
+        self.conn.request('GET', '/currencies')
+        self.conn.getresponse().read()
+
+        self.assertEqual(self.conn.sock.recv(1), b'')
+
+    def test_keptAliveConnectionIsClosedOnShutdown(self):
+        self.conn.request('GET', '/currencies')
+        self.conn.getresponse().read()
+
+        self.server.shutdown_gracefully(timeout=5)
+
+        self.assertEqual(self.conn.sock.recv(1), b'')
+
+
+class MockUpdater:
+
+    def __init__(self, fetcher, next_update_date=None, source_id=1):
+        self.source_id = source_id
+        self.fetch_data = fetcher
+        self.next_update_date = next_update_date or datetime.date.today()
+        self.applied = None
+
+    def get_next_update_date(self):
+        return self.next_update_date
+
+    def get_path_to_source(self):
+        return 'mock_source'
+
+    def get_validators(self):
+        return None
+
+    def fetch(self, path, validators=None):
+        return self.fetch_data(path)
+
+    def write(self, data, on_nonexist_exc=None, *, commit=False):
+        self.applied = (self.applied or []) + list(data)
+        return bool(data), None
+
+    def record_appeal(self, validators=None, *, commit_last_appeal_record=False):
+        pass
+
+
+class RatesRefresherTest(unittest.TestCase):
+
+    def test_refreshAppliesFetchedRates(self):
+        updater = MockUpdater(lambda path: iter([CurrencyRate(None, 'USD', 'RUB', 1, 90.5, None)]))
+        refresher = RatesRefresher([updater], coreapp.pool, check_interval=100)
+
+        self.assertEqual(refresher.refresh(updater), 100)
+        self.assertEqual(len(updater.applied), 1)
+
+    def test_refreshIsNotDoneBeforeDueDate(self):
+        updater = MockUpdater(lambda path: iter(()), datetime.date.today() + datetime.timedelta(days=2))
+        refresher = RatesRefresher([updater], coreapp.pool, check_interval=100)
+
+        self.assertEqual(refresher.refresh(updater), 100)
+        self.assertIsNone(updater.applied)
+
+    def test_ratesAreWrittenWhileBeingFetched(self):
+        written_while_fetching = []
+
+        def fetcher(path):
+            for code in ('USD', 'EUR', 'GBP'):
+                written_while_fetching.append(len(updater.applied or ()))
+                yield CurrencyRate(None, code, 'RUB', 1, 90.5, None)
+
+        updater = MockUpdater(fetcher)
+        refresher = RatesRefresher([updater], coreapp.pool, check_interval=100, batch_size=1)
+
+        self.assertEqual(refresher.refresh(updater), 100)
+        self.assertEqual(written_while_fetching, [0, 1, 2])
+        self.assertEqual(len(updater.applied), 3)
+
+    def test_failedRefreshIsRetriedWithBackoff(self):
+        def fetcher(path):
+            raise OSError('Source is unavailable')
+
+        updater = MockUpdater(fetcher)
+        refresher = RatesRefresher([updater], coreapp.pool, retry_interval=10, max_retry_interval=30)
+
+        self.assertEqual([refresher.refresh(updater) for _ in range(3)], [10, 20, 30])
+
+    def test_sourcesAreRefreshedConcurrently(self):
+        barrier = threading.Barrier(2, timeout=5)
+
+        def fetcher(path):
+            # both sources have to be appealed to at the same time to pass the barrier
+            barrier.wait()
+            return iter(())
+
+        updaters = [MockUpdater(fetcher, source_id=1), MockUpdater(fetcher, source_id=2)]
+        refresher = RatesRefresher(updaters, coreapp.pool, check_interval=100)
+
+        self.assertEqual(refresher.refresh_all(), {1: 100, 2: 100})
@@ -20,6 +20,13 @@ def mock_currencies_handler(env, start_response):
     return [b'Hello! Test!']
 
 
+@testapp.at_route('/item/{item_id:int}')
+@testapp.at_route('/item/{item_id:int}/history/{name}')
+def mock_item_handler(env, start_response):
+    start_response('200 OK', ['text/plain'])
+    return [repr(sorted(testapp.get_request(env).params.items())).encode()]
+
+
 class ParseURLEncodedQuery(BaseAppTest):
 
     def test_parsesSuccessfully(self):
@@ -87,6 +94,42 @@ class RootRespondsWSuccessStatuses(BaseAppTest):
             self._gw.clean_attrs()
 
 
+class Routing(BaseAppTest):
+
+    def test_routesAreMatchedRegardlessOfCase(self):
+        for path_inf in ('/currencies', '/CURRENCIES', '/Currencies', '/cUrReNcIeS/'):
+            self._gw.env['PATH_INFO'] = path_inf
+            self._gw.run(testapp)
+            with self.subTest(PATH_INFO=path_inf):
+                self.assertEqual(self._gw.result_data, [b'Hello! Test!'])
+            self._gw.clean_attrs()
+
+    def test_pathParametersAreConverted(self):
+        inp = (
+            ('/item/12', [('item_id', 12)]),
+            ('/Item/12/HISTORY/abc', [('item_id', 12), ('name', 'abc')]),
+            ('/item/abc', []),
+            ('/item/12/history', []),
+        )
+
+        for path_inf, params in inp:
+            self._gw.env['PATH_INFO'] = path_inf
+            self._gw.run(testapp)
+            with self.subTest(PATH_INFO=path_inf):
+                self.assertEqual(self._gw.result_data, [repr(params).encode()])
+            self._gw.clean_attrs()
+
+    def test_pathIsParsedOnce(self):
+        env = {'PATH_INFO': '/currency//RUB'}
+        request = testapp.get_request(env)
+
+        self.assertEqual(request.components, ('', 'currency', 'RUB'))
+        self.assertIs(testapp.get_request(env), request)
+
+        env['PATH_INFO'] = '/currencies'
+        self.assertEqual(testapp.get_request(env).components, ('', 'currencies'))
+
+
 class RootHandlerRespondsWithErrors(BaseAppTest):
 
     def test_RootRespondsWNotImplemented(self):
@@ -1,25 +1,182 @@
+import datetime
+import logging
 import os.path
+import random
 import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
+from functools import partial
+from itertools import islice
+from typing import Iterable
 
 import app
 from app.data_updates import CurrencyRatesUpdater
-from app.utils import rates_obtaining_from_cbr_website as cbr
+from app.utils.rate_sources import get_source_adapter, UnknownSourceType, SourceNotModified, DEFAULT_TIMEOUT
 
+_logger = logging.getLogger(__name__)
 
 def get_er_updaters():
+    """Makes updater for each source of rates info source table, sources are adapted according to their type"""
+    sql = 'SELECT {pk_field}, {type_field} FROM {table_name}'.format(**table_schema)
+
     objs = []
-    for updp in _updaters_params:
+    for source_id, src_type in app.connection.execute(sql).fetchall():
+        try:
+            adapter = get_source_adapter(src_type)
+        except UnknownSourceType as e:
+            _logger.warning(f'Source {source_id} is skipped: {e}')
+            continue
+
+        fetcher = partial(adapter.fetch, timeout=SOURCE_TIMEOUTS.get(source_id, DEFAULT_SOURCE_TIMEOUT))
         objs.append(
-            CurrencyRatesUpdater(app.connection, *updp)
+            CurrencyRatesUpdater(app.connection, source_id, fetcher, *_updaters_params, conditional_fetch=True)
         )
     return tuple(objs)
 
 
+def _batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+class RatesRefresher:
+    """
+    Keeps rates of the sources up-to-date from a background thread, on schedule of the sources (days_valid),
+    so that requests never wait for the sources. Failed updates are retried with growing intervals.
+    Sources, that are due, are appealed to concurrently.
+    """
+
+    def __init__(self, updaters: Iterable[CurrencyRatesUpdater], pool, *, on_nonexist_exc=None,
+                 check_interval=3600, retry_interval=60, max_retry_interval=3600, jitter=0.1, batch_size=500,
+                 logger=None):
+        self._updaters = tuple(updaters)
+        self._pool = pool
+        self._on_nonexist_exc = on_nonexist_exc
+        self.check_interval = check_interval
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.jitter = jitter
+        # number of rates written in a transaction while the source is being read
+        self.batch_size = batch_size
+        self._logger = logger or logging.getLogger(__name__)
+        self._failures = {updr.source_id: 0 for updr in self._updaters}
+        self._stop_event = threading.Event()
+        self._start_lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """Starts refreshing, if it hasn't been started yet"""
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='rates-refresher', daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _run(self):
+        if not self._updaters:
+            return
+
+        next_checks = {updr.source_id: 0 for updr in self._updaters}
+
+        while not self._stop_event.is_set():
+            now = time.monotonic()
+            due = [updr for updr in self._updaters if next_checks[updr.source_id] <= now]
+
+            for source_id, delay in self.refresh_all(due).items():
+                next_checks[source_id] = time.monotonic() + delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+            self._stop_event.wait(max(min(next_checks.values()) - time.monotonic(), 0))
+
+    def refresh_all(self, updaters: Iterable[CurrencyRatesUpdater] = None) -> dict:
+        """Refreshes the sources concurrently. Returns dict of source id: delay before the next check"""
+        updaters = tuple(self._updaters if updaters is None else updaters)
+
+        if len(updaters) <= 1:
+            return {updr.source_id: self.refresh(updr) for updr in updaters}
+
+        # each source is given its timeout to respond and as much to send the data, the slowest one bounds the refresh
+        with ThreadPoolExecutor(max_workers=len(updaters), thread_name_prefix='rates-fetcher') as executor:
+            delays = executor.map(self.refresh, updaters)
+            return {updr.source_id: delay for updr, delay in zip(updaters, delays)}
+
+    def refresh(self, updater: CurrencyRatesUpdater) -> float:
+        """Updates rates of the source if they're out of date. Returns delay in seconds before the next check"""
+        try:
+            with self._pool.writing():
+                try:
+                    next_update = updater.get_next_update_date()
+                except TypeError:
+                    # the source hasn't been appealed to ever
+                    next_update = datetime.date.today()
+                path = updater.get_path_to_source()
+                validators = updater.get_validators()
+
+            if next_update > datetime.date.today():
+                self._logger.debug(f'Update of source {updater.source_id} is not needed')
+                return self._get_delay_until(next_update)
+
+            # rates are written by batches as they're being downloaded, each batch is committed on its own,
+            # so the write lock isn't held while the source is waited for
+            update_happened, changes = False, []
+            try:
+                for batch in _batched(updater.fetch(path, validators), self.batch_size):
+                    with self._pool.writing():
+                        written, batch_changes = updater.write(batch, self._on_nonexist_exc, commit=True)
+                    update_happened |= written
+                    # change set is known only if rates are written in bulk
+                    if batch_changes is None:
+                        changes = None
+                    elif changes is not None:
+                        changes.extend(batch_changes)
+                not_modified = False
+            except SourceNotModified:
+                not_modified = True
+
+            # validators are recorded once the data is read completely, so an interrupted download is repeated
+            if not_modified or update_happened:
+                with self._pool.writing():
+                    updater.record_appeal(validators, commit_last_appeal_record=True)
+
+        except Exception as e:
+            failures = self._failures[updater.source_id] = self._failures[updater.source_id] + 1
+            delay = min(self.retry_interval * 2 ** (failures - 1), self.max_retry_interval)
+            self._logger.warning(
+                f'Update of source {updater.source_id} failed ({e!r}), next attempt in {delay:.0f} seconds'
+            )
+            return delay
+
+        self._failures[updater.source_id] = 0
+        if not_modified:
+            self._logger.info(f"Rates of source {updater.source_id} haven't changed since the last appeal")
+        elif changes is not None:
+            self._logger.info(f'Rates of source {updater.source_id} were updated successfully ({len(changes)} changed)')
+            for change in changes:
+                self._logger.debug('{}{}: {} -> {}'.format(*change))
+        else:
+            self._logger.info(f'Rates of source {updater.source_id} were updated successfully')
+
+        return self.check_interval
+
+    def _get_delay_until(self, date: datetime.date):
+        delay = (datetime.datetime.combine(date, datetime.time()) - datetime.datetime.now()).total_seconds()
+        return min(max(delay, 0), self.check_interval)
+
+
 p = ConfigParser()
 p.read(os.path.join(app.pkg_dir, r'configs\info_source_dbtable.ini'))
 table_schema = {k: v for k, v in p['schema'].items()}
 
-_updaters_params = [
-    (1, cbr.obtain_rates, app.update_exchange_rate, table_schema)
-]
\ No newline at end of file
+# parameters of updaters which follow source id and fetcher
+_updaters_params = (app.update_exchange_rate, table_schema, app.upsert_exchange_rates)
+
+_timeouts = p['timeouts'] if p.has_section('timeouts') else {}
+# timeouts (in seconds) of appeal to particular sources, by source id
+SOURCE_TIMEOUTS = {int(source_id): float(timeout) for source_id, timeout in _timeouts.items() if source_id != 'default'}
+DEFAULT_SOURCE_TIMEOUT = float(_timeouts.get('default', DEFAULT_TIMEOUT))
@@ -1,13 +1,16 @@
 import dataclasses
+import datetime
 import json
+import secrets
 from collections import OrderedDict
+from email.utils import format_datetime, parsedate_to_datetime
 from http import HTTPStatus
 from typing import Iterable
 
 from app.data_objects import Currency, CurrencyRate
-from app.main import substitute_keys
-from web.viewstools import View, ViewHolder
-from web.data_objects import ExchangeRate, ConvertedExchangeRate
+from app.main import substitute_keys, get_data_version, get_data_last_modified
+from web.viewstools import View, ViewHolder, ResponseCache
+from web.data_objects import ExchangeRate, ConvertedExchangeRate, ExchangeRateHistory
 from web.wsgi_app_bases.wsgi_middleware_base import WSGIMiddleware
 
 EXCHANGE_RATE_FIELDS_MAPPING = {
@@ -19,11 +22,72 @@ CURRENCY_FIELDS_MAPPING = {
     'full_name': 'name'
 }
 
+# endpoints, GET responses of which are cached until data gets modified
+CACHED_ENDPOINTS = ('/currencies', '/exchangeRates')
+_CACHED_ENDPOINTS_BY_KEY = {endpoint.casefold(): endpoint for endpoint in CACHED_ENDPOINTS}
+
+# number of history points put into one piece of streamed response
+HISTORY_POINTS_PER_PIECE = 500
+
+DATA_VERSION_ENV_KEY = 'currency_exchange.data_version'
+
+NDJSON_MIME = 'application/x-ndjson'
+
+# endpoints (method, casefolded path), that are able to give out their rows one at a time as NDJSON,
+# along with views of a single row
+NDJSON_ROW_VIEWS = {
+    ('GET', '/currencies'): '/currency',
+    ('GET', '/exchangerates'): '/exchangeRate',
+    ('POST', '/exchange'): '/exchange',
+}
+
+# is set in environment, if rows are to be given out one at a time, holds the view of a row
+STREAM_ROWS_ENV_KEY = 'currency_exchange.stream_rows'
+
+# data versions are counted anew in every process, so the etags of different processes must not coincide
+ETAG_PROCESS_TAG = secrets.token_hex(4)
+
 
 def http_status_enum_to_string(status: HTTPStatus):
     return f'{status.value} {status.phrase}'
 
 
+def etag_matches(if_none_match: str, etag: str):
+    if if_none_match.strip() == '*':
+        return True
+    return any(tag.strip().removeprefix('W/') == etag for tag in if_none_match.split(','))
+
+
+def is_modified_since(if_modified_since: str, last_modified):
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return True
+    # time of '-0000' zone is given as naive one, it's UTC though
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=datetime.timezone.utc)
+    return last_modified.replace(microsecond=0) > since
+
+
+def accepts_ndjson(accept: str):
+    """Tells if NDJSON is preferred to JSON by the Accept header"""
+    quality = {}
+    for media_range in accept.split(','):
+        mime, *params = (part.strip() for part in media_range.split(';'))
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        quality[mime.lower()] = q
+
+    ndjson_quality = quality.get(NDJSON_MIME, 0)
+    return ndjson_quality > 0 and ndjson_quality >= quality.get('application/json', 0)
+
+
 def dataclass_as_specified_dict(dataclass: dataclasses.dataclass, fields: tuple):
     d = OrderedDict()
     for f in fields:
@@ -32,7 +96,10 @@ def dataclass_as_specified_dict(dataclass: dataclasses.dataclass, fields: tuple)
 
 
 def exchange_rate_as_specified_dict(er: ExchangeRate):
-    return dataclass_as_specified_dict(er, ('id', 'baseCurrency', 'targetCurrency', 'rate'))
+    d = dataclass_as_specified_dict(er, ('id', 'baseCurrency', 'targetCurrency', 'rate'))
+    d['baseCurrency'] = currency_as_dict(d['baseCurrency'])
+    d['targetCurrency'] = currency_as_dict(d['targetCurrency'])
+    return d
 
 
 def currency_as_dict(currency: Currency):
@@ -51,24 +118,55 @@ def json_currencies(currencies: Iterable[Currency]):
 
 
 def json_exchange_rate(er: ExchangeRate):
-    d = dataclass_as_specified_dict(er, ('id', 'baseCurrency', 'targetCurrency', 'rate'))
-    d['baseCurrency'] = currency_as_dict(d['baseCurrency'])
-    d['targetCurrency'] = currency_as_dict(d['targetCurrency'])
-    return json.dumps(d)
+    return json.dumps(exchange_rate_as_specified_dict(er))
 
 
 def json_exchange_rates(ers: Iterable[ExchangeRate]):
-    return json.dumps([json.loads(json_exchange_rate(c)) for c in ers])
+    return json.dumps([exchange_rate_as_specified_dict(er) for er in ers])
 
 
-def json_converted_rate(converted_er: ConvertedExchangeRate):
+def converted_rate_as_specified_dict(converted_er: ConvertedExchangeRate):
     d = dataclass_as_specified_dict(
         converted_er, ('baseCurrency', 'targetCurrency', 'rate', 'amount', 'convertedAmount')
     )
     d['baseCurrency'] = json_currency(d['baseCurrency'])
     d['targetCurrency'] = json_currency(d['targetCurrency'])
+    return d
 
-    return json.dumps(d)
+
+def json_converted_rate(converted_er: ConvertedExchangeRate):
+    return json.dumps(converted_rate_as_specified_dict(converted_er))
+
+
+def json_converted_rates(converted_ers: Iterable[ConvertedExchangeRate]):
+    return json.dumps([converted_rate_as_specified_dict(er) for er in converted_ers])
+
+
+def json_exchange_rate_history(history: ExchangeRateHistory):
+    # given out piece by piece, as the history may be long
+    head = json.dumps({
+        'baseCurrency': currency_as_dict(history.baseCurrency),
+        'targetCurrency': currency_as_dict(history.targetCurrency),
+        'points': []
+    })
+    yield head[:-2]
+
+    pieces = []
+    separator = ''
+    for valid_from, rate in history.points:
+        pieces.append(f'{separator}{{"validFrom": {json.dumps(valid_from)}, "rate": {json.dumps(rate)}}}')
+        separator = ', '
+        if len(pieces) == HISTORY_POINTS_PER_PIECE:
+            yield ''.join(pieces)
+            pieces.clear()
+
+    yield ''.join(pieces) + ']}'
+
+
+def ndjson_row(view_maker):
+    def make_row(data):
+        return view_maker(data) + '\n'
+    return make_row
 
 
 def json_message(msg: str):
@@ -82,8 +180,13 @@ view_holder.add_view('/currency', View(json_currency, 'application/json'))
 view_holder.add_view('/currencies', View(json_currencies, 'application/json'))
 view_holder.add_view('/exchangeRate', View(json_exchange_rate, 'application/json'))
 view_holder.add_view('/exchangeRates', View(json_exchange_rates, 'application/json'))
+view_holder.add_view('/exchangeRate/history', View(json_exchange_rate_history, 'application/json'))
 view_holder.add_view('/exchange', View(json_converted_rate, 'application/json'))
+view_holder.add_view('/exchange/batch', View(json_converted_rates, 'application/json'))
 view_holder.add_view('message', View(json_message, 'application/json'))
+view_holder.add_view('/currency', View(ndjson_row(json_currency), NDJSON_MIME))
+view_holder.add_view('/exchangeRate', View(ndjson_row(json_exchange_rate), NDJSON_MIME))
+view_holder.add_view('/exchange', View(ndjson_row(json_converted_rate), NDJSON_MIME))
 
 
 class CurrencyExchangeAppViewLayer(WSGIMiddleware):
@@ -91,9 +194,101 @@ class CurrencyExchangeAppViewLayer(WSGIMiddleware):
     def __init__(self, underlying_app):
         super().__init__(underlying_app)
         self.views = view_holder
+        self.response_cache = ResponseCache()
+
+    def __call__(self, env, start_response):
+        row_view = self._get_ndjson_row_view(env)
+        if row_view:
+            env[STREAM_ROWS_ENV_KEY] = row_view
+
+        endpoint = self._get_cached_endpoint(env)
+
+        if endpoint:
+            self.underlying_layer.refresh_data_on_request(env)
+            if row_view:
+                # rows given out one at a time aren't cached
+                return super().__call__(env, start_response)
+
+            version = get_data_version()
+            validators = self._get_validators(version)
+
+            if validators and not self._is_modified(env, validators):
+                start_response(
+                    http_status_enum_to_string(HTTPStatus.NOT_MODIFIED), self._make_validator_headers(validators)
+                )
+                return []
+
+            body = self.response_cache.get(endpoint, version)
+
+            if body is not None:
+                headers = [('Content-type', 'application/json'), ('Content-Length', str(len(body)))]
+                headers.extend(self._make_validator_headers(validators))
+                start_response(http_status_enum_to_string(HTTPStatus.OK), headers)
+                return [body]
+
+            env[DATA_VERSION_ENV_KEY] = version
+
+        return super().__call__(env, start_response)
+
+    @staticmethod
+    def _get_validators(version):
+        """
+        Returns (ETag, Last-Modified) pair for data of the given version. They aren't kept by version,
+        as appeals to rate sources change the moment of the last modification, but not the version.
+        """
+        if version is None:
+            return None
+
+        last_modified = get_data_last_modified()
+        db_version, local_version = version
+        appealed = int(last_modified.timestamp()) if last_modified else 0
+        etag = f'"{ETAG_PROCESS_TAG}-{db_version}.{local_version}-{appealed}"'
+
+        return etag, last_modified
+
+    @staticmethod
+    def _make_validator_headers(validators):
+        if not validators:
+            return []
+        etag, last_modified = validators
+        headers = [('ETag', etag)]
+        if last_modified:
+            headers.append(('Last-Modified', format_datetime(last_modified, usegmt=True)))
+        return headers
+
+    @staticmethod
+    def _is_modified(env, validators):
+        etag, last_modified = validators
+        if 'HTTP_IF_NONE_MATCH' in env:
+            return not etag_matches(env['HTTP_IF_NONE_MATCH'], etag)
+        if 'HTTP_IF_MODIFIED_SINCE' in env and last_modified:
+            return is_modified_since(env['HTTP_IF_MODIFIED_SINCE'], last_modified)
+        return True
+
+    def _get_ndjson_row_view(self, env):
+        if not accepts_ndjson(env.get('HTTP_ACCEPT', '')):
+            return None
+
+        request = self.get_request(env)
+        if not request.is_valid or len(request.components) < 2:
+            return None
+
+        return NDJSON_ROW_VIEWS.get((env['REQUEST_METHOD'], '/' + request.components[1].casefold()))
+
+    def _get_cached_endpoint(self, env):
+        if env['REQUEST_METHOD'] != 'GET':
+            return None
+
+        request = self.get_request(env)
+        if not request.is_valid or len(request.components) != 2:
+            return None
+
+        return _CACHED_ENDPOINTS_BY_KEY.get('/' + request.components[1].casefold())
 
     def modify_headers(self, env, headers):
-        headers.insert(1, ('Content-type', 'application/json'))
+        headers.insert(1, ('Content-type', NDJSON_MIME if STREAM_ROWS_ENV_KEY in env else 'application/json'))
+        if DATA_VERSION_ENV_KEY in env and self.resp_ctxt.headers_set[0] == HTTPStatus.OK:
+            headers.extend(self._make_validator_headers(self._get_validators(env[DATA_VERSION_ENV_KEY])))
 
     def modify_error_response_headers(self, e, headers):
         headers.insert(1, ('Content-type', 'application/json'))
@@ -102,23 +297,45 @@ class CurrencyExchangeAppViewLayer(WSGIMiddleware):
         rc = self.resp_ctxt
         method = rc.env['REQUEST_METHOD']
         fmt = 'application/json'
-        endpoint = '/' + self._get_path_components(rc.env)[1]
+        endpoint = '/' + self.get_request(rc.env).components[1].casefold()
         view = self.views.get_view(endpoint, fmt)
 
         if type(data) is str:
             view = self.views.get_view('message', fmt)
             return view.apply(data).encode()
 
+        if STREAM_ROWS_ENV_KEY in rc.env:
+            return self.views.get_view(rc.env[STREAM_ROWS_ENV_KEY], NDJSON_MIME).apply(data).encode()
+
+        if isinstance(data, ExchangeRateHistory):
+            view = self.views.get_view('/exchangeRate/history', fmt)
+            return (piece.encode() for piece in view.apply(data))
+
         if method == 'POST':
-            if endpoint.casefold() == '/currencies'.casefold():
+            if endpoint == '/currencies':
                 view = self.views.get_view('/currency', fmt)
-            if endpoint.casefold() == '/exchangeRates'.casefold():
+            if endpoint == '/exchangerates':
                 view = self.views.get_view('/exchangeRate', fmt)
+            if endpoint == '/exchange':
+                view = self.views.get_view('/exchange/batch', fmt)
 
         if not data:
             return b''
 
-        return view.apply(data).encode()
+        body = view.apply(data).encode()
+
+        if DATA_VERSION_ENV_KEY in rc.env and rc.headers_set[0] == HTTPStatus.OK:
+            self.response_cache.store(self._get_cached_endpoint(rc.env), rc.env[DATA_VERSION_ENV_KEY], body)
+
+        return body
+
+    def start_response_giveaway(self, result):
+        # data may be turned into a sequence of pieces, if it's given out while being processed
+        for piece in super().start_response_giveaway(result):
+            if isinstance(piece, bytes):
+                yield piece
+            else:
+                yield from piece
 
     def process_status(self, status):
         return http_status_enum_to_string(status)
@@ -11,16 +11,30 @@ class View:
 
 
 class ViewHolder:
+    # views are found by casefolded id, as endpoints they're named after are
     def __init__(self):
         self._views = {}
 
     def add_view(self, _id: str, view_obj: View):
-        if not self._views.get(_id):
-            self._views[_id] = {}
-        self._views[_id][view_obj.mime_type] = view_obj
+        self._views.setdefault(_id.casefold(), {})[view_obj.mime_type] = view_obj
 
     def get_view(self, _id, mime_type):
-        return self._views[_id][mime_type]
-
+        return self._views[_id.casefold()][mime_type]
 
 
+class ResponseCache:
+    """Keeps encoded response bodies along with the data version they were built upon"""
+    def __init__(self):
+        self._bodies = {}
+
+    def get(self, _id, version):
+        if version is None:
+            return None
+        entry = self._bodies.get(_id)
+        if entry and entry[0] == version:
+            return entry[1]
+        return None
+
+    def store(self, _id, version, body: bytes):
+        if version is not None:
+            self._bodies[_id] = (version, body)
@@ -0,0 +1,206 @@
+import asyncio
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from io import BytesIO
+from typing import Callable
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+class ASGIAdapter:
+    """
+    Serves WSGI application as ASGI one. Event loop only takes care of connections, while the application is run
+    on the bounded pool of threads, so blocking work of one request doesn't hold up the others.
+    Every request is served by a single thread from start to end (application keeps response context per thread),
+    pieces of the response are handed over to the loop as they're produced.
+    """
+
+    def __init__(self, wsgi_app: Callable, *, max_workers: int = None, max_body_size: int = 16 * 1024 * 1024,
+                 piece_size: int = 16 * 1024, on_startup: Callable = None, on_shutdown: Callable = None):
+        self.wsgi_app = wsgi_app
+        self.max_workers = max_workers
+        self.max_body_size = max_body_size
+        # small pieces of response are joined up to that size before they're sent
+        self.piece_size = piece_size
+        self.on_startup = on_startup
+        self.on_shutdown = on_shutdown
+        self._executor = None
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='asgi-worker')
+        return self._executor
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            await self._serve_http(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self._serve_lifespan(receive, send)
+
+    async def _serve_lifespan(self, receive, send):
+        # handlers may block (e.g. wait for threads to stop), so they're run out of the event loop
+        loop = asyncio.get_running_loop()
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    if self.on_startup:
+                        await loop.run_in_executor(None, self.on_startup)
+                except Exception as e:
+                    await send({'type': 'lifespan.startup.failed', 'message': repr(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.on_shutdown:
+                    await loop.run_in_executor(None, self.on_shutdown)
+                if self._executor:
+                    self._executor.shutdown(wait=False)
+                    self._executor = None
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _serve_http(self, scope, receive, send):
+        try:
+            body = await self._read_body(receive)
+        except ClientDisconnected:
+            return
+        if body is None:
+            await self._send_error(send, HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+            return
+
+        loop = asyncio.get_running_loop()
+        # the queue is bounded, so the application waits while the client can't keep up with it
+        pieces = asyncio.Queue(maxsize=8)
+        disconnected = False
+
+        def put(item):
+            if disconnected:
+                raise ClientDisconnected()
+            asyncio.run_coroutine_threadsafe(pieces.put(item), loop).result()
+
+        def run_app():
+            try:
+                self._run_wsgi_app(self._make_environ(scope, body), put)
+            except ClientDisconnected:
+                pass
+            except BaseException as e:
+                put(e)
+            else:
+                put(None)
+
+        future = loop.run_in_executor(self.executor, run_app)
+
+        try:
+            while (item := await pieces.get()) is not None:
+                if isinstance(item, BaseException):
+                    raise item
+                await send(item)
+        except BaseException:
+            disconnected = True
+            # let the worker, which may be waiting for room in the queue, find out it has to stop
+            while not future.done():
+                try:
+                    pieces.get_nowait()
+                except asyncio.QueueEmpty:
+                    await asyncio.sleep(0)
+            raise
+
+        await future
+
+    def _run_wsgi_app(self, environ, put):
+        response_start = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info:
+                try:
+                    if response_start.get('sent'):
+                        raise exc_info[1].with_traceback(exc_info[2])
+                finally:
+                    exc_info = None
+            response_start['status'] = int(status.split(' ', 1)[0])
+            response_start['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                         for name, value in headers]
+
+        def send_start():
+            if not response_start.get('sent'):
+                put({'type': 'http.response.start', 'status': response_start['status'],
+                     'headers': response_start['headers']})
+                response_start['sent'] = True
+
+        result = self.wsgi_app(environ, start_response)
+        buffer = []
+        buffered = 0
+        try:
+            for data in result:
+                if not data:
+                    continue
+                buffer.append(data)
+                buffered += len(data)
+                if buffered >= self.piece_size:
+                    send_start()
+                    put({'type': 'http.response.body', 'body': b''.join(buffer), 'more_body': True})
+                    buffer.clear()
+                    buffered = 0
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+        send_start()
+        put({'type': 'http.response.body', 'body': b''.join(buffer), 'more_body': False})
+
+    async def _read_body(self, receive) -> bytes | None:
+        pieces = []
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                raise ClientDisconnected()
+            pieces.append(message.get('body', b''))
+            size += len(pieces[-1])
+            if size > self.max_body_size:
+                return None
+            if not message.get('more_body'):
+                return b''.join(pieces)
+
+    @staticmethod
+    async def _send_error(send, status: HTTPStatus):
+        await send({'type': 'http.response.start', 'status': status.value,
+                    'headers': [(b'content-type', b'text/plain')]})
+        await send({'type': 'http.response.body', 'body': status.phrase.encode()})
+
+    @staticmethod
+    def _make_environ(scope, body: bytes) -> dict:
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', ''),
+            'PATH_INFO': scope['path'],
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        if scope.get('client'):
+            environ['REMOTE_ADDR'] = scope['client'][0]
+
+        for name, value in scope.get('headers', ()):
+            name, value = name.decode('latin-1'), value.decode('latin-1')
+            if name == 'content-type':
+                environ['CONTENT_TYPE'] = value
+            elif name != 'content-length':
+                key = 'HTTP_' + name.upper().replace('-', '_')
+                environ[key] = f'{environ[key]},{value}' if key in environ else value
+
+        return environ
@@ -1,4 +1,5 @@
 import sys
+import threading
 from collections import namedtuple
 from types import FunctionType
 from urllib.parse import urlparse, parse_qsl, unquote
@@ -13,19 +14,49 @@ ResponseContext = namedtuple(
         ['env', 'headers_set', 'headers_sent', 'orig_start_response', 'own_start_response']
     )
 
+# PATH_INFO split into components once, shared by all the layers and handlers the request passes through.
+# params are values of path parameters of the route template the path matched
+Request = namedtuple('Request', ['path', 'components', 'is_valid', 'params'])
+
+# handler of the routes sharing the first path component, with templates of the rest of their paths
+Route = namedtuple('Route', ['handler', 'templates'])
+
+# the rest of the route path: literal components (casefolded, unless case-sensitive) and (name, converter) pairs
+# of parameters
+PathTemplate = namedtuple('PathTemplate', ['components', 'case_sensitive'])
+
+REQUEST_ENV_KEY = 'wsgi_app.request'
+
 
 class WSGIApplication:
     _path_pattern = re.compile('(/[a-zA-Z0-9]*)*')
+    _path_param_pattern = re.compile('{([a-zA-Z_][a-zA-Z0-9_]*)(?::([a-zA-Z_][a-zA-Z0-9_]*))?}')
+
+    # converters of path parameters by name of type, the one given in route template as {name:type}
+    path_param_types = {'str': str, 'int': int}
 
     def __init__(self):
+        # routes by casefolded first path component, case-sensitive ones are kept apart
         self._handler_route_map = {}
+        self._case_sensitive_route_map = {}
+        self._handler_instances = {}
+        # response context is kept per thread, as requests may be served by several threads simultaneously
+        self._local = threading.local()
+
+    @property
+    def resp_ctxt(self) -> ResponseContext:
+        return self._local.resp_ctxt
+
+    @resp_ctxt.setter
+    def resp_ctxt(self, ctxt: ResponseContext):
+        self._local.resp_ctxt = ctxt
 
     def __call__(self, env: dict, start_response: Callable):
         # path validness checking happens here (http error response)
-        path = env.get('PATH_INFO')
-        path_components: list = self._get_path_components(env)
+        request = self.get_request(env)
+        path_components = request.components
 
-        if not self._is_valid_path(path):
+        if not request.is_valid:
             raise ResponseProcessingError(HTTPStatus.BAD_REQUEST)
 
         inner_handler = self._get_inner_handler(env['REQUEST_METHOD'])
@@ -52,33 +83,51 @@ class WSGIApplication:
             return
 
     def _delegate_wsgi_call(self, env: dict, start_response: Callable):
-        path_components = self._get_path_components(env)
+        path_components = self.get_request(env).components
 
-        handler = self._get_handler(f'/{path_components[1]}')
+        route = self._get_route(f'/{path_components[1]}')
 
-        if handler:
+        if route:
+            rest = path_components[2:]
             new_env = env.copy()
             new_env['SCRIPT_NAME'] = '/' + path_components[1]
-            new_env['PATH_INFO'] = '/' + '/'.join(path_components[2:])
+            new_env['PATH_INFO'] = '/' + '/'.join(rest)
+            new_env[REQUEST_ENV_KEY] = Request(
+                new_env['PATH_INFO'], ('',) + rest, True, self._match_path_templates(route.templates, rest)
+            )
 
-            return handler(new_env, start_response)
+            return route.handler(new_env, start_response)
 
-        supplied = ', '.join(self._handler_route_map.keys())
+        supplied = ', '.join(self._routes_supplied())
         raise ResponseProcessingError(
             HTTPStatus.NOT_FOUND, f'Cant serve request to {env["SCRIPT_NAME"]}. Supplied paths on this app: {supplied}'
         )
 
-    def _get_handler(self, path: str):
+    def _get_route(self, path: str) -> Route | None:
         if path == '':
             path = '/'
 
-        return self._handler_route_map.get(path)
+        return self._handler_route_map.get(path.casefold()) or self._case_sensitive_route_map.get(path)
+
+    def _routes_supplied(self):
+        return [*self._handler_route_map, *self._case_sensitive_route_map]
 
     def at_route(self, path, case_sensitive=False):
+        """
+        Registers handler of requests to the path and everything under it. Path may end with a template of the rest
+        of it, e.g. /exchangeRate/{pair} or /item/{id:int}/history, values of the matched parameters are given out
+        to the handler in params of the request. Handler may be registered to several templates of the same path,
+        requests to paths none of them matches are given to it as well (with no params)
+        """
+        template_start = path.find('/', 1)
+        path, template = (path, '') if template_start == -1 else (path[:template_start], path[template_start:])
         if not self._is_valid_path(path):
             raise URLError(f'{path} is invalid path')
         if path == '':
             path = '/'
+        template = self._compile_path_template(template, case_sensitive)
+        route_map = self._case_sensitive_route_map if case_sensitive else self._handler_route_map
+        key = path if case_sensitive else path.casefold()
 
         def recorder(handler):
             if not hasattr(handler, '__call__'):
@@ -87,35 +136,92 @@ class WSGIApplication:
             if not isinstance(handler, FunctionType):
                 if issubclass(handler, self.__class__):  # place an instance if decorated a class
                     cls = handler
-                    handler = handler()
+                    if cls not in self._handler_instances:
+                        self._handler_instances[cls] = cls()
+                    handler = self._handler_instances[cls]
                 else:
                     raise AssertionError(
                         'Handler, if is implemented as a class, must be a descendant of WSGIApplication'
                     )
-            self._handler_route_map[path] = handler
-            if not case_sensitive:
-                self._handler_route_map[path.lower()] = handler
-                self._handler_route_map[path.upper()] = handler
+
+            route = route_map.get(key)
+            if not route or route.handler is not handler:
+                route = route_map[key] = Route(handler, [])
+            if template:
+                route.templates.append(template)
+
             return cls or handler
 
         return recorder
 
+    def _compile_path_template(self, template: str, case_sensitive=False) -> PathTemplate | None:
+        if not template:
+            return None
+
+        components = []
+        for comp in filter(None, template.split('/')):
+            param = self._path_param_pattern.fullmatch(comp)
+            if param:
+                name, type_name = param.groups()
+                if (type_name or 'str') not in self.path_param_types:
+                    raise URLError(f'Unknown type of path parameter: {comp}')
+                components.append((name, self.path_param_types[type_name or 'str']))
+            elif self._is_valid_path('/' + comp):
+                components.append(comp if case_sensitive else comp.casefold())
+            else:
+                raise URLError(f'{template} is invalid path template')
+
+        return PathTemplate(tuple(components), case_sensitive)
+
+    @staticmethod
+    def _match_path_templates(templates: list, components: tuple) -> dict:
+        """Returns parameters of the first template the components match (empty if none does)"""
+        for template in templates:
+            if len(template.components) != len(components):
+                continue
+
+            params = {}
+            for expected, comp in zip(template.components, components):
+                if isinstance(expected, str):
+                    if expected != (comp if template.case_sensitive else comp.casefold()):
+                        break
+                    continue
+                name, converter = expected
+                try:
+                    params[name] = converter(comp)
+                except ValueError:
+                    break
+            else:
+                return params
+
+        return {}
+
     def _is_valid_path(self, path: str):
         return True if self._path_pattern.fullmatch(path) else False
 
+    def get_request(self, env) -> Request:
+        """Returns the request the env describes, its path is parsed only the first time"""
+        path = env.get('PATH_INFO')
+        request = env.get(REQUEST_ENV_KEY)
+        if request and request.path == path:
+            return request
+
+        request = Request(path, self._split_path(path), self._is_valid_path(path), {})
+        env[REQUEST_ENV_KEY] = request
+
+        return request
+
+    def _get_path_components(self, env) -> tuple:
+        return self.get_request(env).components
+
     @staticmethod
-    def _get_path_components(env):
-        path_str = env.get('PATH_INFO')
+    def _split_path(path_str):
         if path_str == '/':
             path_str = ''
 
-        path_comps = path_str.split('/')
-        path_comps = list(filter(None, path_comps))
-        path_comps.insert(0, '')
-
-        return path_comps
+        return ('',) + tuple(filter(None, path_str.split('/')))
 
-    def _parse_qsl(self, env: dict, required_fields: list | tuple = None) -> dict:
+    def _parse_qsl(self, env: dict, required_fields: list | tuple = None, optional_fields: list | tuple = ()) -> dict:
         if env.get('CONTENT_TYPE') != 'application/x-www-form-urlencoded':
             raise ResponseProcessingError(HTTPStatus.UNSUPPORTED_MEDIA_TYPE, 'Required x-www-form-urlencoded')
 
@@ -128,7 +234,7 @@ class WSGIApplication:
             )
 
             if required_fields:
-                if set(required_fields) != set(qd.keys()):
+                if not set(required_fields) <= set(qd.keys()) <= set(required_fields) | set(optional_fields):
                     raise AssertionError()
             if not qd:
                 raise ValueError
@@ -188,7 +294,7 @@ class WSGIApplication:
             msg = e.args[0]
 
         if headers and isinstance(headers[0], HTTPStatus):
-            headers = headers[1:]
+            headers = list(headers[1])
         self.modify_error_response_headers(e, headers)
         rc.orig_start_response(status, headers, sys.exc_info())
 
@@ -196,18 +302,28 @@ class WSGIApplication:
 
     def start_response_giveaway(self, result):
         rc = self.resp_ctxt
-        env, headers_set, headers_sent = rc.env, rc.headers_set, rc.headers_sent
+        headers_set, headers_sent = rc.headers_set, rc.headers_sent
         for datapiece in result:
             if not headers_set:
                 raise AssertionError('Write before start_response()')
+            # response may be given out in many pieces, headers are sent only before the first one
             if not headers_sent:
-                status, headers_sent = headers_set[:]
-                self.modify_headers(env, headers_sent)
-                if not isinstance(status, HTTPStatus):
-                    raise AssertionError('Status supposed to be an HTTPStatus enum member here')
-                rc.orig_start_response(self.process_status(status), list(headers_set))
+                self._send_headers()
             yield self.process_data(datapiece)
 
+        # response of no pieces (e.g. rows of an empty table given out one at a time)
+        if headers_set and not headers_sent:
+            self._send_headers()
+
+    def _send_headers(self):
+        rc = self.resp_ctxt
+        status, headers = rc.headers_set[:]
+        self.modify_headers(rc.env, headers)
+        if not isinstance(status, HTTPStatus):
+            raise AssertionError('Status supposed to be an HTTPStatus enum member here')
+        rc.orig_start_response(self.process_status(status), list(headers))
+        rc.headers_sent[:] = status, headers
+
     def set_new_response_context(self, env, start_response):
         headers_set = []
         headers_sent = []
@@ -1,28 +1,54 @@
+import datetime
+import json
 import sys
-import urllib.error
+import threading
 from http import HTTPStatus
-from http.client import HTTPException
 from io import BytesIO
 from typing import Callable
+from urllib.parse import parse_qs
 import logging.config
 import web.apploggers as apploggers
 
 import app.main
-from web.data_objects import ExchangeRate, ConvertedExchangeRate
+from web.data_objects import ExchangeRate, ConvertedExchangeRate, ExchangeRateHistory
 from web.wsgi_app_bases.wsgi_application_base import WSGIApplication, ResponseProcessingError
 import app as coresrv
 from app.data_objects import Currency, CurrencyRate
-from web.updaters import get_er_updaters
-from web.views import CurrencyExchangeAppViewLayer
+from web.updaters import get_er_updaters, RatesRefresher
+from web.views import CurrencyExchangeAppViewLayer, STREAM_ROWS_ENV_KEY
 
 ER_UPDATERS = get_er_updaters()
 
+# rates are kept up-to-date by a background thread, which is started on the first request
+REFRESH_RATES_IN_BACKGROUND = True
+
+RATES_REFRESHER = None
+_rates_refresher_lock = threading.Lock()
+
+# most of items that one batch conversion request may carry
+BATCH_ITEMS_LIMIT = 100_000
+# most bytes that body of one batch conversion request may take
+BATCH_BODY_LIMIT = 16 * 1024 * 1024
+
+RATE_FIND_STRATEGY = (app.main.FIND_RATE_BY_RECIPROCAL | app.main.FIND_RATE_BY_COMMON_TARGET |
+                      app.main.FIND_RATE_BY_PATH)
+
 logging.config.dictConfig(apploggers.logconfig)
 
 
+def parse_currency_pair(value: str) -> tuple:
+    if len(value) != 6:
+        raise ValueError('Currency pair should be given in form XXXXXX')
+    return value[:3].upper(), value[3:].upper()
+
+
 class CurrencyExchangeRatesWSGIApp(WSGIApplication):
     _logger = logging.getLogger(apploggers.APP_LOGGER_NAME)
 
+    # codes are checked by data objects, so that the client is told what is wrong with them
+    path_param_types = {**WSGIApplication.path_param_types, 'currency_code': str.upper,
+                        'currency_pair': parse_currency_pair}
+
     def __call__(self, env, start_response):
         self._logger.debug(
             '=Request arrived at {}=\nEnvironment:{}'
@@ -32,11 +58,7 @@ class CurrencyExchangeRatesWSGIApp(WSGIApplication):
             f'Starting response (current handler: for {env["SCRIPT_NAME"]}). Request at {env["PATH_INFO"]}'
         )
 
-        if env['REQUEST_METHOD'] == 'GET' and env['SCRIPT_NAME'].casefold() == '/exchangeRates'.casefold():
-            try:
-                self.refresh_data()
-            except urllib.error.URLError:
-                pass
+        self.refresh_data_on_request(env)
 
         res = super().__call__(env, start_response)
 
@@ -53,28 +75,72 @@ class CurrencyExchangeRatesWSGIApp(WSGIApplication):
         self._logger.error(msg='', exc_info=sys.exc_info())
         return super().do_error_response(e)
 
+    def refresh_data_on_request(self, env):
+        """Makes sure rates are being refreshed. Doesn't block: sources are appealed to in the background"""
+        if REFRESH_RATES_IN_BACKGROUND and RATES_REFRESHER is None:
+            self.start_rates_refresher()
+
+    def start_rates_refresher(self):
+        global RATES_REFRESHER
+
+        with _rates_refresher_lock:
+            if RATES_REFRESHER is None:
+                RATES_REFRESHER = RatesRefresher(
+                    ER_UPDATERS, coresrv.pool, on_nonexist_exc=app.main.NoRecordToModify, logger=self._logger
+                )
+                RATES_REFRESHER.start()
+                self._logger.info('Rates refresher was started')
+
+        return RATES_REFRESHER
+
+    def stop_rates_refresher(self, timeout=None):
+        global RATES_REFRESHER
+
+        with _rates_refresher_lock:
+            refresher, RATES_REFRESHER = RATES_REFRESHER, None
+        if refresher is not None:
+            refresher.stop(timeout)
+            self._logger.info('Rates refresher was stopped')
+
     def refresh_data(self):
-        for updr in ER_UPDATERS:
-            try:
-                do_update = updr.update_is_needed()
-            except TypeError:
-                do_update = True
-            if do_update:
-                try:
-                    updr.update(app.main.NoRecordToModify, commit_last_appeal_record=True)
-                except HTTPException as e:
-                    self._logger.info(
-                        f'Update is needed ({updr.source_id}), but were not able to accomplish it due to problem: {e}'
-                    )
-                self._logger.info('Rates were updated successfully')
-            else:
-                self._logger.debug('Update not needed')
+        """Synchronously updates rates of the sources which are out of date"""
+        refresher = RATES_REFRESHER or RatesRefresher(
+            ER_UPDATERS, coresrv.pool, on_nonexist_exc=app.main.NoRecordToModify, logger=self._logger
+        )
+        refresher.refresh_all()
 
     def set_logging_level(self, level):
         self._logger.setLevel(level)
 
+    def log_db_settings(self):
+        for name, (configured, effective, match) in coresrv.pool.check_settings().items():
+            if match:
+                self._logger.info(f'DB setting {name} = {effective}')
+            else:
+                self._logger.warning(f'DB setting {name} = {effective}, though {configured} is configured')
+
+    @staticmethod
+    def _parse_moment(value: str | None, upper=False):
+        """Parses ISO date or datetime. Upper bound given as date includes the whole day"""
+        if not value:
+            return None
+
+        try:
+            if len(value) == 10:
+                date = datetime.date.fromisoformat(value)
+                return datetime.datetime.combine(date + datetime.timedelta(days=1) if upper else date, datetime.time())
+
+            moment = datetime.datetime.fromisoformat(value)
+        except ValueError:
+            raise ResponseProcessingError(HTTPStatus.BAD_REQUEST, f'Invalid date or datetime: {value}')
+
+        # the upper bound is inclusive
+        return moment + datetime.timedelta(microseconds=1) if upper else moment
+
 core_application = CurrencyExchangeRatesWSGIApp()
 
+core_application.log_db_settings()
+
 
 application = CurrencyExchangeAppViewLayer(underlying_app=core_application)
 
@@ -86,7 +152,11 @@ class CurrenciesHandler(CurrencyExchangeRatesWSGIApp):
         env, start_response = self.resp_ctxt.env, self.resp_ctxt.own_start_response
         self._logger.debug(f'Serving GET (current handler: for {self.resp_ctxt.env["SCRIPT_NAME"]})')
         start_response(HTTPStatus.OK, ())
-        yield coresrv.get_all_currencies()
+
+        if STREAM_ROWS_ENV_KEY in env:
+            yield from coresrv.get_all_currencies()
+        else:
+            yield coresrv.get_all_currencies()
 
     def doPOST(self):
         env = self.resp_ctxt.env
@@ -111,7 +181,7 @@ class CurrenciesHandler(CurrencyExchangeRatesWSGIApp):
         yield added_curr
 
 
-@core_application.at_route('/currency')
+@core_application.at_route('/currency/{code:currency_code}')
 class CurrencyHandler(CurrencyExchangeRatesWSGIApp):
 
     def __call__(self, env, start_response):
@@ -124,17 +194,15 @@ class CurrencyHandler(CurrencyExchangeRatesWSGIApp):
     def doGET(self):
         env, start_response = self.resp_ctxt.env, self.resp_ctxt.own_start_response
         self._logger.debug(f'Serving GET (current handler: for {env["SCRIPT_NAME"]})')
-        path_comps = self._get_path_components(env)
+        curr_code = self.get_request(env).params.get('code')
 
-        if len(path_comps) != 2:
+        if curr_code is None:
 
             raise ResponseProcessingError(
                 HTTPStatus.BAD_REQUEST,
                 'Exactly one currency code should be provided as an endpoint of this resource'
             )
 
-        curr_code = path_comps[1].upper()
-
         try:
             curr_query_obj = Currency(None, curr_code, None, None)
         except ValueError:
@@ -160,23 +228,25 @@ class ExchangeRatesHandler(CurrencyExchangeRatesWSGIApp):
     def doGET(self):
         env, start_response = self.resp_ctxt.env, self.resp_ctxt.own_start_response
         self._logger.debug(f'Serving GET (current handler: for {env["SCRIPT_NAME"]})')
+        # rows are given out one at a time, if they're requested so, otherwise as one list
+        stream_rows = STREAM_ROWS_ENV_KEY in env
+
         try:
-            rates = coresrv.get_all_exchange_rates()
+            if stream_rows:
+                rates = coresrv.iter_exchange_rates_expanded()
+            else:
+                rates = coresrv.get_all_exchange_rates_expanded()
         except app.main.sqlite3.Error as e:
             raise ResponseProcessingError(HTTPStatus.INTERNAL_SERVER_ERROR, e.args[0])
 
-        er_list = []
-        for rate in rates:
-            bcurr = coresrv.get_currency(Currency(None, rate.base_currency_code, None, None))
-            tcurr = coresrv.get_currency(Currency(None, rate.target_currency_code, None, None))
-
-            er = ExchangeRate(rate.id, bcurr, tcurr, round(rate.rate, 2))
-
-            er_list.append(er)
+        ers = (ExchangeRate(rate.id, bcurr, tcurr, round(rate.rate, 2)) for rate, bcurr, tcurr in rates)
 
         start_response(HTTPStatus.OK, ())
 
-        yield er_list
+        if stream_rows:
+            yield from ers
+        else:
+            yield list(ers)
 
     def doPOST(self):
         env, start_response = self.resp_ctxt.env, self.resp_ctxt.own_start_response
@@ -205,12 +275,8 @@ class ExchangeRatesHandler(CurrencyExchangeRatesWSGIApp):
 
         new_er = ExchangeRate(
             new_er.id,
-            coresrv.get_currency(
-                Currency(None, new_er.base_currency_code, None, None)
-            ),
-            coresrv.get_currency(
-                Currency(None, new_er.target_currency_code, None, None)
-            ),
+            coresrv.get_currency_by_code(new_er.base_currency_code),
+            coresrv.get_currency_by_code(new_er.target_currency_code),
             round(new_er.rate, 2)
         )
 
@@ -219,7 +285,8 @@ class ExchangeRatesHandler(CurrencyExchangeRatesWSGIApp):
         yield new_er
 
 
-@core_application.at_route('/exchangeRate')
+@core_application.at_route('/exchangeRate/{pair:currency_pair}')
+@core_application.at_route('/exchangeRate/{pair:currency_pair}/history')
 class ExchangeRateHandler(CurrencyExchangeRatesWSGIApp):
 
     def __call__(self, env, start_response):
@@ -232,10 +299,15 @@ class ExchangeRateHandler(CurrencyExchangeRatesWSGIApp):
         env, start_response = self.resp_ctxt.env, self.resp_ctxt.own_start_response
         self._logger.debug(f'Serving GET (current handler: for {env["SCRIPT_NAME"]})')
 
+        path_comps = self.get_request(env).components
+        if len(path_comps) == 3 and path_comps[2].casefold() == 'history':
+            yield from self._get_rate_history(env)
+            return
+
         query_rate = self._get_query_rate_from_url(env)
 
         rate = coresrv.get_exchange_rate(
-            query_rate, strategy=app.main.FIND_RATE_BY_RECIPROCAL | app.main.FIND_RATE_BY_COMMON_TARGET
+            query_rate, strategy=RATE_FIND_STRATEGY
         )
 
         if not rate:
@@ -244,8 +316,8 @@ class ExchangeRateHandler(CurrencyExchangeRatesWSGIApp):
                 f'Rate for {query_rate.base_currency_code} - {query_rate.target_currency_code} not found'
             )
 
-        bcurr = coresrv.get_currency(Currency(None, rate.base_currency_code, None, None))
-        tcurr = coresrv.get_currency(Currency(None, rate.target_currency_code, None, None))
+        bcurr = coresrv.get_currency_by_code(rate.base_currency_code)
+        tcurr = coresrv.get_currency_by_code(rate.target_currency_code)
 
         er = ExchangeRate(rate.id, bcurr, tcurr, round(rate.rate, 2))
 
@@ -276,12 +348,8 @@ class ExchangeRateHandler(CurrencyExchangeRatesWSGIApp):
 
         updated_er = ExchangeRate(
             updated_er.id,
-            coresrv.get_currency(
-                Currency(None, updated_er.base_currency_code, None, None)
-            ),
-            coresrv.get_currency(
-                Currency(None, updated_er.target_currency_code, None, None)
-            ),
+            coresrv.get_currency_by_code(updated_er.base_currency_code),
+            coresrv.get_currency_by_code(updated_er.target_currency_code),
             round(updated_er.rate, 2)
         )
 
@@ -289,14 +357,36 @@ class ExchangeRateHandler(CurrencyExchangeRatesWSGIApp):
 
         yield updated_er
 
-    def _get_query_rate_from_url(self, env):
-        path_comps = self._get_path_components(env)
+    def _get_rate_history(self, env):
+        start_response = self.resp_ctxt.own_start_response
+        query_rate = self._get_query_rate_from_url(env, history=True)
+
+        qd = parse_qs(env.get('QUERY_STRING', ''))
+        since = self._parse_moment(qd.get('from', [None])[0])
+        until = self._parse_moment(qd.get('to', [None])[0], upper=True)
+
+        points = coresrv.get_exchange_rate_history(
+            query_rate.base_currency_code, query_rate.target_currency_code, since, until
+        )
+
+        if points is None:
+            raise ResponseProcessingError(HTTPStatus.NOT_FOUND, 'One or more currencies is not present')
+
+        bcurr = coresrv.get_currency_by_code(query_rate.base_currency_code)
+        tcurr = coresrv.get_currency_by_code(query_rate.target_currency_code)
+
+        start_response(HTTPStatus.OK, ())
+
+        yield ExchangeRateHistory(bcurr, tcurr, ((valid_from, round(rate, 2)) for valid_from, rate in points))
+
+    def _get_query_rate_from_url(self, env, history=False):
+        request = self.get_request(env)
 
-        if len(path_comps) != 2 or len(path_comps[1]) != 6:
+        if 'pair' not in request.params or len(request.components) != (3 if history else 2):
             msg = 'Exactly 1 currency pair in form XXXXXX should be provided as an endpoint for this resource'
             raise ResponseProcessingError(HTTPStatus.BAD_REQUEST, msg)
 
-        bcode, tcode = path_comps[1][:3].upper(), path_comps[1][3:].upper()
+        bcode, tcode = request.params['pair']
 
         try:
             query_rate = CurrencyRate(None, bcode, tcode, None, None, None)
@@ -317,13 +407,16 @@ class ExchangeHandler(CurrencyExchangeRatesWSGIApp):
                 'wsgi.input': BytesIO(env['QUERY_STRING'].encode()),
                 'CONTENT_TYPE': 'application/x-www-form-urlencoded'
             },
-            ('from', 'to', 'amount')
+            ('from', 'to', 'amount'),
+            optional_fields=('date',)
         )
+        # rate valid at the moment (at the end of the day, if date is given) is taken
+        as_of = self._parse_moment(qd.get('date'), upper=True)
 
         try:
             rate = coresrv.get_exchange_rate(
                 CurrencyRate(None, qd['from'], qd['to'], None, None, None),
-                strategy=app.main.FIND_RATE_BY_RECIPROCAL | app.main.FIND_RATE_BY_COMMON_TARGET
+                strategy=RATE_FIND_STRATEGY, as_of=as_of
             )
         except ValueError as e:
             raise ResponseProcessingError(HTTPStatus.BAD_REQUEST, f'Invalid currency codes: {e.args[0]}')
@@ -331,8 +424,8 @@ class ExchangeHandler(CurrencyExchangeRatesWSGIApp):
         if not rate:
             raise ResponseProcessingError(HTTPStatus.NOT_FOUND, 'No such exchange_rate')
 
-        bcurr = coresrv.get_currency(Currency(None, rate.base_currency_code, None, None))
-        tcurr = coresrv.get_currency(Currency(None, rate.target_currency_code, None, None))
+        bcurr = coresrv.get_currency_by_code(rate.base_currency_code)
+        tcurr = coresrv.get_currency_by_code(rate.target_currency_code)
 
         try:
             amount = float(qd['amount'])
@@ -344,3 +437,104 @@ class ExchangeHandler(CurrencyExchangeRatesWSGIApp):
         start_response(HTTPStatus.OK, ())
 
         yield ConvertedExchangeRate(bcurr, tcurr, round(rate.rate, 2), round(amount, 2), round(conv_amount, 2))
+
+    def doPOST(self):
+        env, start_response = self.resp_ctxt.env, self.resp_ctxt.own_start_response
+        self._logger.debug(f'Serving POST (current handler: for {env["SCRIPT_NAME"]})')
+        path_comps = self.get_request(env).components
+
+        if len(path_comps) != 2 or path_comps[1].casefold() != 'batch':
+            raise ResponseProcessingError(HTTPStatus.NOT_FOUND, 'Conversions may be posted only to /exchange/batch')
+
+        items = self._parse_batch(env)
+
+        # every distinct pair is resolved once, however many items refer to it
+        rates = {}
+        for item in items:
+            pair = (item['from'], item['to'])
+            if pair not in rates:
+                rates[pair] = self._get_batch_rate(*pair)
+
+        def convert(item):
+            rate, bcurr, tcurr = rates[item['from'], item['to']]
+            amount = item['amount']
+            return ConvertedExchangeRate(bcurr, tcurr, round(rate.rate, 2), round(amount, 2),
+                                         round(rate.reduced_rate * amount, 2))
+
+        start_response(HTTPStatus.OK, ())
+
+        if STREAM_ROWS_ENV_KEY in env:
+            yield from map(convert, items)
+        else:
+            yield [convert(item) for item in items]
+
+    @staticmethod
+    def _parse_batch(env) -> list:
+        """Reads items of batch conversion given either as JSON array or as NDJSON (one item per line)"""
+        content_type = env.get('CONTENT_TYPE', '').split(';')[0].strip()
+
+        content_length = env.get('CONTENT_LENGTH')
+        if content_length and not (content_length.isascii() and content_length.isdigit()):
+            raise ResponseProcessingError(HTTPStatus.BAD_REQUEST, 'Invalid Content-Length')
+
+        if content_length:
+            body = env['wsgi.input'].read(int(content_length)) if int(content_length) <= BATCH_BODY_LIMIT else None
+        else:
+            # body of unknown length is read until it turns out to be too large
+            body = env['wsgi.input'].read(BATCH_BODY_LIMIT + 1)
+
+        if body is None or len(body) > BATCH_BODY_LIMIT:
+            raise ResponseProcessingError(
+                HTTPStatus.REQUEST_ENTITY_TOO_LARGE, f'Body of no more than {BATCH_BODY_LIMIT} bytes is accepted'
+            )
+
+        try:
+            body = body.decode()
+            if content_type == 'application/json':
+                items = json.loads(body)
+            elif content_type == 'application/x-ndjson':
+                items = [json.loads(line) for line in body.splitlines() if line.strip()]
+            else:
+                raise ResponseProcessingError(
+                    HTTPStatus.UNSUPPORTED_MEDIA_TYPE, 'Required application/json or application/x-ndjson'
+                )
+        except UnicodeDecodeError:
+            raise ResponseProcessingError(HTTPStatus.UNPROCESSABLE_ENTITY, 'Was not able to decode body')
+        except ValueError:
+            raise ResponseProcessingError(HTTPStatus.BAD_REQUEST, 'Bad JSON')
+
+        if not isinstance(items, list) or not items:
+            raise ResponseProcessingError(HTTPStatus.BAD_REQUEST, 'Non-empty array of conversions is required')
+        if len(items) > BATCH_ITEMS_LIMIT:
+            raise ResponseProcessingError(
+                HTTPStatus.REQUEST_ENTITY_TOO_LARGE, f'No more than {BATCH_ITEMS_LIMIT} conversions at once'
+            )
+
+        for i, item in enumerate(items):
+            if not isinstance(item, dict) or set(item) != {'from', 'to', 'amount'}:
+                raise ResponseProcessingError(
+                    HTTPStatus.BAD_REQUEST, f'Item {i}: exactly from, to and amount fields are required'
+                )
+            try:
+                item['amount'] = float(item['amount'])
+                item['from'], item['to'] = item['from'].upper(), item['to'].upper()
+            except (TypeError, ValueError, AttributeError):
+                raise ResponseProcessingError(
+                    HTTPStatus.BAD_REQUEST, f'Item {i}: amount should be a numeric value, codes should be strings'
+                )
+
+        return items
+
+    @staticmethod
+    def _get_batch_rate(bcode, tcode):
+        try:
+            rate = coresrv.get_exchange_rate(
+                CurrencyRate(None, bcode, tcode, None, None, None), strategy=RATE_FIND_STRATEGY
+            )
+        except ValueError as e:
+            raise ResponseProcessingError(HTTPStatus.BAD_REQUEST, f'Invalid currency codes: {e.args[0]}')
+
+        if not rate:
+            raise ResponseProcessingError(HTTPStatus.NOT_FOUND, f'No such exchange_rate: {bcode}{tcode}')
+
+        return rate, coresrv.get_currency_by_code(bcode), coresrv.get_currency_by_code(tcode)
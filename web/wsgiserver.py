@@ -1,34 +1,236 @@
+import argparse
+import selectors
+import signal
+import socket
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from http import HTTPStatus
 from http.server import HTTPServer, BaseHTTPRequestHandler
-from urllib.parse import urlparse
+from urllib.parse import urlsplit, unquote
+
+DEFAULT_WORKERS = 16
+
+# kept-alive connection which doesn't send the next request for that many seconds is closed
+KEEP_ALIVE_TIMEOUT = 15
+
+# how often idle connections are checked for having expired
+POLL_INTERVAL = 0.5
+
+# most of the request body left unread by the application, which is read off to keep the connection alive
+MAX_UNREAD_BODY = 64 * 1024
+
+# longest line of chunk size (with extensions) or of trailer of the chunked request body
+MAX_CHUNK_LINE = 1024
+
+HEX_DIGITS = b'0123456789abcdefABCDEF'
+
+
+class RequestBody:
+    """Input stream of the request, which doesn't let the application read past the body"""
+
+    def __init__(self, rfile, length: int):
+        self._rfile = rfile
+        self._left = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self._left:
+            size = self._left
+        data = self._rfile.read(size) if size else b''
+        self._left -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self._left:
+            size = self._left
+        data = self._rfile.readline(size) if size else b''
+        self._left -= len(data)
+        return data
+
+    def readlines(self, hint=-1):
+        return list(self)
+
+    def __iter__(self):
+        while line := self.readline():
+            yield line
+
+    def skip_rest(self) -> bool:
+        """Reads off what is left of the body, unless there is too much of it"""
+        if self._left > MAX_UNREAD_BODY:
+            return False
+        while self.read(8192):
+            pass
+        return not self._left
+
+
+class ChunkedRequestBody(RequestBody):
+    """Input stream of the request, body of which is sent in chunks (Transfer-Encoding: chunked), decoded"""
+
+    def __init__(self, rfile):
+        super().__init__(rfile, 0)
+        self._in_chunk = False
+        self._finished = False
+
+    def _has_data(self) -> bool:
+        """Moves on to the next chunk once the current one is read, tells whether any of the body is left"""
+        if self._left or self._finished:
+            return bool(self._left)
+
+        if self._in_chunk and self._rfile.readline(MAX_CHUNK_LINE) not in (b'\r\n', b'\n'):
+            raise ValueError('Chunk of the request body is not followed by line break')
+
+        # int() would take signs, underscores and 0x prefix as well, which proxies may read otherwise
+        size_field = self._rfile.readline(MAX_CHUNK_LINE).split(b';', 1)[0].strip()
+        if not size_field or size_field.strip(HEX_DIGITS):
+            raise ValueError('Invalid chunk size in the request body')
+        size = int(size_field, 16)
+
+        if size == 0:
+            # trailer fields are of no use to the application
+            while self._rfile.readline(MAX_CHUNK_LINE) not in (b'\r\n', b'\n', b''):
+                pass
+            self._finished = True
+            return False
+
+        self._left, self._in_chunk = size, True
+        return True
+
+    def read(self, size=-1):
+        whole = size is None or size < 0
+        pieces, got = [], 0
+        while (whole or got < size) and self._has_data():
+            piece = super().read(-1 if whole else size - got)
+            if not piece:
+                break
+            pieces.append(piece)
+            got += len(piece)
+        return b''.join(pieces)
+
+    def readline(self, size=-1):
+        whole = size is None or size < 0
+        pieces, got = [], 0
+        while (whole or got < size) and self._has_data():
+            piece = super().readline(-1 if whole else size - got)
+            if not piece:
+                break
+            pieces.append(piece)
+            got += len(piece)
+            if piece.endswith(b'\n'):
+                break
+        return b''.join(pieces)
+
+    def skip_rest(self) -> bool:
+        skipped = 0
+        try:
+            while skipped <= MAX_UNREAD_BODY and (data := self.read(8192)):
+                skipped += len(data)
+        except ValueError:
+            return False
+        return self._finished
 
 
 class WSGIServerRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'CurrencyExchangeWSGIServer/1.0'
+    # seconds given to the client to send the request once it has started
+    timeout = 60
+    # headers and body are written separately, waiting for acknowledgement of the former would delay the latter
+    disable_nagle_algorithm = True
+    # kept-alive connection waits for the next request, it's watched by the server meanwhile
+    idle = False
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        self.handle_pipelined()
+
+    def resume(self):
+        """Handles the request which has arrived on the idle connection"""
+        self.idle = False
+        try:
+            self.handle_one_request()
+            self.handle_pipelined()
+        finally:
+            self.finish()
+
+    def handle_pipelined(self):
+        """Handles requests sent ahead of responses, the connection is left idle when there are no more of them"""
+        while not self.close_connection:
+            if not self.has_buffered_request():
+                self.idle = True
+                return
+            self.handle_one_request()
+
+    def has_buffered_request(self) -> bool:
+        self.connection.settimeout(0)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            self.close_connection = True
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def finish(self):
+        # files of the idle connection are needed for the next request
+        if not self.idle:
+            super().finish()
+
+    def handle_request(self):
+        codings = [coding.strip().lower() for value in self.headers.get_all('Transfer-Encoding', ())
+                   for coding in value.split(',')]
+        if codings and codings != ['chunked']:
+            # body can't be told from the next request
+            self.close_connection = True
+            self.send_error(HTTPStatus.NOT_IMPLEMENTED, 'Only chunked transfer coding of request body is supported')
+            return
+
+        self.run_with_cgi(self.server.application)
+
+    do_GET = do_HEAD = do_POST = do_PUT = do_PATCH = do_DELETE = do_OPTIONS = handle_request
 
     def build_environment(self):
-        url_components = urlparse(self.path)
+        url_components = urlsplit(self.path)
+
+        if 'Transfer-Encoding' in self.headers:
+            # Content-Length is ignored then, the message may have passed a proxy that took it otherwise
+            if 'Content-Length' in self.headers:
+                self.close_connection = True
+            content_length = ''
+            body = ChunkedRequestBody(self.rfile)
+        else:
+            content_length = self.headers.get('Content-Length', '')
+            try:
+                body = RequestBody(self.rfile, max(int(content_length or 0), 0))
+            except ValueError:
+                body = RequestBody(self.rfile, 0)
 
         env = {
             'REQUEST_METHOD': self.command,
-            'CONTENT_LENGTH': self.headers.get('Content-Length', ''),
+            'CONTENT_LENGTH': content_length,
             'CONTENT_TYPE': self.headers.get('Content-Type', ''),
             'SCRIPT_NAME': '',
-            'PATH_INFO': self.path,
+            'PATH_INFO': unquote(url_components.path, 'latin-1'),
             'QUERY_STRING': url_components.query,
-            'SERVER_NAME': 'Python http.server',
-            'SERVER_PORT': f'{self.server.server_address[0]}:{self.server.server_address[1]}',
-            'SERVER_PROTOCOL': self.protocol_version,
+            'SERVER_NAME': self.server.server_name,
+            'SERVER_PORT': str(self.server.server_port),
+            'SERVER_PROTOCOL': self.request_version,
+            'REMOTE_ADDR': self.client_address[0],
             'wsgi.version': (1, 0),
             'wsgi.url_scheme': 'http',
-            'wsgi.input': self.rfile,
+            'wsgi.input': body,
             'wsgi.errors': sys.stderr,
-            'wsgi.multithread': False,
+            'wsgi.multithread': True,
             'wsgi.multiprocess': False,
-            'wsgi_run_once': False
+            'wsgi.run_once': False
         }
 
         for kw, val in self.headers.items():
-            env[f'HTTP_{kw.upper().replace("-", "_")}'] = val
+            key = f'HTTP_{kw.upper().replace("-", "_")}'
+            if key in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+                continue
+            env[key] = f'{env[key]},{val}' if key in env else val
 
         return env
 
@@ -38,32 +240,52 @@ class WSGIServerRequestHandler(BaseHTTPRequestHandler):
 
         headers_stored = []
         headers_sent = []
+        chunked = False
 
-        def write(data: bytes):
+        def send_headers():
+            nonlocal chunked
 
-            if not headers_stored:
-                raise AssertionError("write() before start_response()")
+            status, response_headers = headers_stored
+            code, msg = status.split(' ', 1)
+            code = int(code)
 
-            nonlocal headers_sent
+            if self.server.is_shutting_down:
+                self.close_connection = True
 
-            out = self.wfile
+            self.send_response(code, msg)
+            for kw, value in response_headers:
+                self.send_header(kw, value)
 
-            if not headers_sent:
-                status, response_headers = headers_stored
-                headers_sent = headers_stored
-                code, msg = status.split()
-                code = int(code)
-                if code >= 400:
-                    self.send_error(code, msg)
+            # body of unknown length is sent in chunks, or till the connection is closed for HTTP/1.0 clients
+            has_body = self.command != 'HEAD' and code >= 200 and code not in (204, 304)
+            if has_body and not any(kw.lower() == 'content-length' for kw, _ in response_headers):
+                if self.request_version == 'HTTP/1.1':
+                    chunked = True
+                    self.send_header('Transfer-Encoding', 'chunked')
                 else:
-                    self.send_response(code, msg)
+                    self.close_connection = True
 
-                for kw, value in response_headers:
-                    self.send_header(kw, value)
+            if self.close_connection:
+                self.send_header('Connection', 'close')
 
-                self.end_headers()
+            self.end_headers()
+            headers_sent[:] = headers_stored
 
-            out.write(data)
+        def write(data: bytes):
+
+            if not headers_stored:
+                raise AssertionError("write() before start_response()")
+
+            if not headers_sent:
+                send_headers()
+
+            if not data or self.command == 'HEAD':
+                return
+
+            if chunked:
+                self.wfile.write(b'%X\r\n%s\r\n' % (len(data), data))
+            else:
+                self.wfile.write(data)
 
         def start_response(status, headers, exc_info=None):
 
@@ -73,14 +295,12 @@ class WSGIServerRequestHandler(BaseHTTPRequestHandler):
                         raise exc_info[1].with_traceback(exc_info[2])
                 finally:
                     exc_info = None
-
-            if headers_stored:
+            elif headers_stored:
                 raise AssertionError(
                     'Headers already set. Second call to start_response() should provide an exception.'
                 )
 
-            headers_stored.append(status)
-            headers_stored.append(headers)
+            headers_stored[:] = status, headers
 
             return write
 
@@ -92,26 +312,194 @@ class WSGIServerRequestHandler(BaseHTTPRequestHandler):
                     write(data)
             if not headers_sent:
                 write(b'')
+            if chunked:
+                self.wfile.write(b'0\r\n\r\n')
         finally:
             if hasattr(response, 'close'):
                 response.close()
 
-    def do_GET(self):
-        self.send_response(200, 'OK')
-        self.send_header('Content-Type', 'text/plain')
-        response = repr(self.build_environment()).encode()
-
-        self.send_header('Content-Length', str(len(response)))
-
-        self.end_headers()
+        # next request can be read off the connection only after the whole body of this one
+        if not env['wsgi.input'].skip_rest():
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class WSGIServer(HTTPServer):
+    """
+    HTTP/1.1 server of WSGI application. Requests are served by the pool of threads, those waiting for a free thread
+    are queued. Idle kept-alive connections don't hold threads: they are watched by a single one, which hands
+    a connection over to the pool once the next request arrives on it, or closes it after keep_alive_timeout.
+    """
+    request_queue_size = 128
+
+    def __init__(self, server_address, application, *, workers=DEFAULT_WORKERS, keep_alive_timeout=KEEP_ALIVE_TIMEOUT,
+                 verbose=False):
+        super().__init__(server_address, WSGIServerRequestHandler)
+        self.application = application
+        self.keep_alive_timeout = keep_alive_timeout
+        self.verbose = verbose
+        self.is_shutting_down = False
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='wsgi-worker')
+        self._tasks = set()
+        self._tasks_lock = threading.Lock()
+
+        self._idle = []
+        self._idle_lock = threading.Lock()
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._wakeup_writer.setblocking(False)
+        self._idle_thread = threading.Thread(target=self._watch_idle_connections, name='wsgi-idle', daemon=True)
+        self._idle_thread.start()
+
+    def process_request(self, request, client_address):
+        self._submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            handler = self.RequestHandlerClass(request, client_address, self)
+        except Exception:
+            self.handle_error(request, client_address)
+            self.shutdown_request(request)
+        else:
+            self._keep_or_close(handler)
+
+    def resume_request_thread(self, handler):
+        try:
+            handler.resume()
+        except Exception:
+            self.handle_error(handler.request, handler.client_address)
+            self.shutdown_request(handler.request)
+        else:
+            self._keep_or_close(handler)
+
+    def _submit(self, fn, *args):
+        future = self._executor.submit(fn, *args)
+        with self._tasks_lock:
+            self._tasks.add(future)
+        future.add_done_callback(self._forget_task)
+
+    def _forget_task(self, future):
+        with self._tasks_lock:
+            self._tasks.discard(future)
+
+    def _keep_or_close(self, handler):
+        if handler.idle:
+            with self._idle_lock:
+                if not self.is_shutting_down:
+                    self._idle.append(handler)
+                    self._wake_idle_thread()
+                    return
+        self._close(handler)
+
+    def _close(self, handler):
+        handler.idle = False
+        try:
+            handler.finish()
+        finally:
+            self.shutdown_request(handler.request)
 
-        self.wfile.write(response)
+    def _wake_idle_thread(self):
+        try:
+            self._wakeup_writer.send(b'\0')
+        except OSError:
+            # pending wakeup is enough
+            pass
+
+    def _watch_idle_connections(self):
+        deadlines = {}
+        with selectors.DefaultSelector() as selector:
+            selector.register(self._wakeup_reader, selectors.EVENT_READ)
+            while True:
+                with self._idle_lock:
+                    idle, self._idle = self._idle, []
+                    is_shutting_down = self.is_shutting_down
+
+                deadline = time.monotonic() + self.keep_alive_timeout
+                for handler in idle:
+                    selector.register(handler.connection, selectors.EVENT_READ, handler)
+                    deadlines[handler] = deadline
+
+                if is_shutting_down:
+                    break
+
+                for key, _ in selector.select(POLL_INTERVAL):
+                    if key.data is None:
+                        self._wakeup_reader.recv(4096)
+                        continue
+                    # request has arrived, or the client has closed the connection
+                    selector.unregister(key.fileobj)
+                    del deadlines[key.data]
+                    self._submit(self.resume_request_thread, key.data)
+
+                now = time.monotonic()
+                for handler in [handler for handler, deadline in deadlines.items() if deadline <= now]:
+                    selector.unregister(handler.connection)
+                    del deadlines[handler]
+                    self._close(handler)
+
+        for handler in deadlines:
+            self._close(handler)
+
+    def shutdown_gracefully(self, timeout=30):
+        """
+        Stops accepting connections and lets the requests being processed finish within timeout.
+        Kept-alive connections are closed after the current request. Must not be called from serve_forever thread
+        """
+        with self._idle_lock:
+            self.is_shutting_down = True
+        self._wake_idle_thread()
+        self.shutdown()
+        self.server_close()
+
+        self._idle_thread.join(timeout)
+        with self._tasks_lock:
+            tasks = list(self._tasks)
+        wait(tasks, timeout)
+
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._wakeup_reader.close()
+        self._wakeup_writer.close()
+
+
+def serve(host='localhost', port=80, *, workers=DEFAULT_WORKERS, keep_alive_timeout=KEEP_ALIVE_TIMEOUT,
+          shutdown_timeout=30, verbose=False):
+    import web.wsgi_application as wsgi_application
+
+    server = WSGIServer((host, port), wsgi_application.application, workers=workers,
+                        keep_alive_timeout=keep_alive_timeout, verbose=verbose)
+
+    shutdown_thread = None
+
+    def on_signal(signum, frame):
+        nonlocal shutdown_thread
+        if shutdown_thread is None:
+            shutdown_thread = threading.Thread(target=server.shutdown_gracefully, args=(shutdown_timeout,))
+            shutdown_thread.start()
+
+    signal.signal(signal.SIGINT, on_signal)
+    signal.signal(signal.SIGTERM, on_signal)
+
+    print(f'serving at: {server.socket.getsockname()} with {workers} workers')
+    server.serve_forever()
 
+    if shutdown_thread:
+        shutdown_thread.join()
+    wsgi_application.core_application.stop_rates_refresher(shutdown_timeout)
+    print('server is stopped')
 
 
 if __name__ == '__main__':
-    server = HTTPServer(('localhost', 80), WSGIServerRequestHandler)
-    print(f'serving at: {server.socket.getsockname()}')
-    server.serve_forever()
-
-
+    parser = argparse.ArgumentParser(description='Serves currency exchange application over HTTP')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=80)
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='number of connections served at once')
+    parser.add_argument('--keep-alive-timeout', type=float, default=KEEP_ALIVE_TIMEOUT)
+    parser.add_argument('--shutdown-timeout', type=float, default=30,
+                        help='seconds the requests being processed are given to finish on shutdown')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    args = parser.parse_args()
+
+    serve(args.host, args.port, workers=args.workers, keep_alive_timeout=args.keep_alive_timeout,
+          shutdown_timeout=args.shutdown_timeout, verbose=args.verbose)